@@ -14,32 +14,275 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
    
+import array
+import bisect
 import calendar
 import datetime
+import mmap
+import multiprocessing
+import re
+import threading
+import time
 import unicodedata
 import sys
 from xml import sax
+from xml.parsers import expat
+from xml.sax import saxutils
 
 import tilutil.systemutils as su
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 APPLE_BASE = calendar.timegm((2001, 1, 1, 0, 0, 0, 0, 0, -1))
 APPLE_BASE2 = datetime.datetime.fromtimestamp(calendar.timegm((2001, 1, 1, 0, 0, 0)))
 
+# Number of bytes read_applexml_streaming() reads and feeds to the parser at a
+# time.
+_READ_CHUNK_SIZE = 1024 * 1024
+
+# Size of the character data buffer of the expat engine. Large enough to
+# receive most <data> blobs in a single callback.
+_EXPAT_BUFFER_SIZE = 64 * 1024
+
+# Parser engines: the xml.sax based AppleXMLHandler, or the pyexpat based
+# AppleXMLParser (default).
+SAX_ENGINE = 'sax'
+EXPAT_ENGINE = 'expat'
+
+# Marks a key in a projection whose value is not parsed.
+SKIP = True
+
+# Number of chunks per worker process read_applexml_parallel() splits a
+# <dict> into, so that workers that finish early pick up more work.
+_CHUNKS_PER_PROCESS = 4
+
+# Smallest chunk read_applexml_parallel() hands to a worker process.
+_MIN_PARALLEL_CHUNK_SIZE = 256 * 1024
+
+_NAN = float('nan')
+_INFINITY = float('inf')
+
+# Bytes read_application_version() reads from the start of a file.
+_HEADER_SIZE = 4096
+
+_APPLICATION_VERSION_PATTERN = re.compile(
+    r'<key>Application Version</key>\s*<string>([^<]*)</string>')
+
+_DICT_TAG_PATTERN = re.compile(r'<(/?)dict>')
+_DICT_START_PATTERN = re.compile(r'\s*<dict>')
+
 
 def getappletime(value):
     '''Converts a numeric Apple time stamp into a date and time'''
     try:
-        # datetime.datetime.fromtimestamp() takes only int, which limits it to 12/13/1901
-        # as the earliest possible date. Use an alternate calculation for earlier dates.
-        # This one however adjusts for daylight savings time, so summer times are off by an
-        # hour from the time recorded in iPhoto.
-        if APPLE_BASE + float(value) < -sys.maxint:
-            return APPLE_BASE2 + datetime.timedelta(seconds=float(value))
-        return datetime.datetime.fromtimestamp(APPLE_BASE + float(value))
+        return _get_datetime(APPLE_BASE + float(value))
     except (TypeError, ValueError) as _e:
         # bad time stamp in database, default to "now"
         return datetime.datetime.now()
 
+def _get_datetime(timestamp):
+    '''Converts a POSIX time stamp into a date and time'''
+    # datetime.datetime.fromtimestamp() takes only int, which limits it to 12/13/1901
+    # as the earliest possible date. Use an alternate calculation for earlier dates.
+    # This one however adjusts for daylight savings time, so summer times are off by an
+    # hour from the time recorded in iPhoto.
+    if timestamp < -sys.maxint:
+        return APPLE_BASE2 + datetime.timedelta(seconds=timestamp - APPLE_BASE)
+    return datetime.datetime.fromtimestamp(timestamp)
+
+def _get_posix_time(value):
+    '''Converts a local datetime object into a POSIX time stamp, or NaN if it
+    is out of range.'''
+    try:
+        return time.mktime(value.timetuple()) + value.microsecond / 1000000.0
+    except (OverflowError, ValueError) as _e:
+        return _NAN
+
+def _get_timestamp(value):
+    '''Converts a numeric Apple time stamp into a POSIX time stamp, or NaN if
+    the value is missing or bad.'''
+    try:
+        return APPLE_BASE + float(value)
+    except (TypeError, ValueError) as _e:
+        return _NAN
+
+
+class AppleTimeTable(object):
+    '''A packed table of time stamps, for many images or containers.
+
+    add() collects the raw Apple time stamps (seconds since 1/1/2001, as read
+    from the XML file) without converting them. They are converted into POSIX
+    time stamps in bulk (with NumPy, if available) the first time the table is
+    read, and stored in a single array of doubles. getdatetime() builds a
+    datetime object for a single entry, and sort() and select() work on the
+    time stamps without building any.
+
+    Missing or bad time stamps are stored as NaN. Like getappletime(),
+    getdatetime() returns the current time for those; sort() puts them last,
+    and select() never returns them.
+    '''
+
+    def __init__(self):
+        self._timestamps = array.array('d')
+        self._raw_values = []
+
+    def __getstate__(self):
+        self.convert()
+        return {'_timestamps': self._timestamps.tostring()}
+
+    def __setstate__(self, state):
+        self._timestamps = array.array('d')
+        self._timestamps.fromstring(state['_timestamps'])
+        self._raw_values = []
+
+    def __len__(self):
+        return len(self._timestamps) + len(self._raw_values)
+
+    def add(self, value):
+        '''Adds a raw Apple time stamp (a string, a number, or None). Returns
+        the index of the new entry.'''
+        self._raw_values.append(value)
+        return len(self) - 1
+
+    def add_datetime(self, value):
+        '''Adds a datetime object (or None). Returns the index of the new
+        entry.'''
+        if value is None:
+            return self.add(None)
+        return self.add(_get_posix_time(value) - APPLE_BASE)
+
+    def convert(self):
+        '''Converts all raw time stamps added since the last conversion.'''
+        raw_values = self._raw_values
+        if not raw_values:
+            return
+        self._raw_values = []
+        if numpy:
+            try:
+                timestamps = numpy.array(
+                    [_NAN if value is None else value for value in raw_values],
+                    dtype=numpy.float64) + APPLE_BASE
+                self._timestamps.fromstring(timestamps.tostring())
+                return
+            except (TypeError, ValueError):
+                # Bad values; convert them one by one below.
+                pass
+        self._timestamps.extend([_get_timestamp(value) for value in raw_values])
+
+    def gettimestamp(self, index):
+        '''Returns the POSIX time stamp of an entry, or NaN.'''
+        if self._raw_values:
+            self.convert()
+        return self._timestamps[index]
+
+    def getdatetime(self, index):
+        '''Builds the datetime object for an entry.'''
+        timestamp = self.gettimestamp(index)
+        if timestamp != timestamp:
+            return datetime.datetime.now()
+        try:
+            return _get_datetime(timestamp)
+        except ValueError:
+            return datetime.datetime.now()
+
+    def _take(self, indices):
+        '''Returns the time stamps of the entries, as a NumPy array if NumPy is
+        available, or as a list otherwise.'''
+        if self._raw_values:
+            self.convert()
+        if numpy:
+            return numpy.frombuffer(self._timestamps, dtype=numpy.float64)[
+                numpy.asarray(indices, dtype=numpy.intp)]
+        timestamps = self._timestamps
+        return [timestamps[index] for index in indices]
+
+    def sort(self, indices):
+        '''Returns the positions in indices, ordered by the time stamps of the
+        entries they refer to (oldest first, NaN last).'''
+        if not indices:
+            return []
+        timestamps = self._take(indices)
+        if numpy:
+            return numpy.argsort(timestamps, kind='mergesort').tolist()
+        return sorted(xrange(len(indices)), key=lambda position: (
+            timestamps[position] != timestamps[position], timestamps[position]))
+
+    def select(self, indices, start=None, end=None):
+        '''Returns the positions in indices that refer to entries with a time
+        stamp in [start, end). start and end are datetime objects, or None for
+        no limit.'''
+        if not indices:
+            return []
+        low = -_INFINITY if start is None else _get_posix_time(start)
+        high = _INFINITY if end is None else _get_posix_time(end)
+        timestamps = self._take(indices)
+        if numpy:
+            return numpy.flatnonzero((timestamps >= low) &
+                                     (timestamps < high)).tolist()
+        return [position for (position, timestamp) in enumerate(timestamps)
+                if low <= timestamp < high]
+
+    def argmin(self, indices):
+        '''Returns the position in indices of the oldest entry, or None if all
+        entries are NaN.'''
+        if not indices:
+            return None
+        timestamps = self._take(indices)
+        if numpy:
+            if numpy.isnan(timestamps).all():
+                return None
+            return int(numpy.nanargmin(timestamps))
+        position = None
+        for (i, timestamp) in enumerate(timestamps):
+            if timestamp == timestamp and (
+                position is None or timestamp < timestamps[position]):
+                position = i
+        return position
+
+    def argmax(self, indices):
+        '''Returns the position in indices of the newest entry, or None if all
+        entries are NaN.'''
+        if not indices:
+            return None
+        timestamps = self._take(indices)
+        if numpy:
+            if numpy.isnan(timestamps).all():
+                return None
+            return int(numpy.nanargmax(timestamps))
+        position = None
+        for (i, timestamp) in enumerate(timestamps):
+            if timestamp == timestamp and (
+                position is None or timestamp > timestamps[position]):
+                position = i
+        return position
+
+def make_projection(excluded_paths):
+    '''Builds a projection, which tells the expat engine which parts of an
+    Apple XML file to skip without building them.
+
+    Args:
+      excluded_paths: list of key paths to skip, starting below the top level
+          <dict>. None in a path matches any key of a <dict>, or any element of
+          an <array>. For example, ("Master Image List", None, "Faces") skips
+          the "Faces" of all images.
+
+    Returns:
+      The projection, as a tree of dictionaries, or None if nothing is
+      excluded.
+    '''
+    if not excluded_paths:
+        return None
+    projection = {}
+    for path in excluded_paths:
+        node = projection
+        for key in path[:-1]:
+            node = node.setdefault(key, {})
+        node[path[-1]] = SKIP
+    return projection
+
 class AppleXMLResolver(sax.handler.EntityResolver): #IGNORE:W0232
     '''Helper to deal with XML entity resolving'''
 
@@ -140,31 +383,601 @@ class AppleXMLHandler(sax.handler.ContentHandler):
         return self.top_node[0]
 
 
-def read_applexml(filename):
+class AppleXMLParser(object):
+    '''Parses an Apple XML file, as generated by iPhoto and iTunes, using
+    pyexpat directly. Builds the same data tree as AppleXMLHandler, but skips
+    the xml.sax layer, lets expat buffer character data, and dispatches
+    elements through lookup tables.
+
+    An optional projection (see make_projection()) names parts of the file
+    that are skipped without being built.'''
+
+    def __init__(self, projection=None):
+        self._parser = expat.ParserCreate()
+        self._parser.buffer_text = True
+        self._parser.buffer_size = _EXPAT_BUFFER_SIZE
+        self._parser.StartElementHandler = self._start_element
+        self._parser.EndElementHandler = self._end_element
+        self._parser.CharacterDataHandler = self._characters
+        self.chars = []
+        self.key = None
+        self.parse_stack = []
+        self.top_node = None
+        self._projection = projection
+        # Projections for the containers on parse_stack.
+        self._projection_stack = []
+        self._child_projection = None
+        # Nesting depth within a skipped element.
+        self._skip_depth = 0
+        self._start_handlers = {
+            'key': self._start_value,
+            'date': self._start_value,
+            'string': self._start_value,
+            'integer': self._start_value,
+            'real': self._start_value,
+            'false': self._start_value,
+            'true': self._start_value,
+            'data': self._start_value,
+            'dict': self._start_dict,
+            'array': self._start_array,
+            'plist': self._start_plist,
+        }
+        self._end_handlers = {
+            'key': self._end_key,
+            'string': self._end_string,
+            'integer': self._end_value,
+            'real': self._end_value,
+            'date': self._end_value,
+            'true': self._end_true,
+            'false': self._end_false,
+            'data': self._end_data,
+            'dict': self._end_container,
+            'array': self._end_container,
+            'plist': self._end_plist,
+        }
+
+    def add_object(self, xml_object):
+        '''Adds an object to the current container, which can be a list or a
+        map.
+        '''
+        current_top = self.parse_stack[-1]
+        if isinstance(current_top, list):
+            current_top.append(xml_object)
+        else:
+            current_top[self.key] = xml_object
+
+    def _text(self):
+        '''Returns the character data collected for the current element, or
+        None if there was none.'''
+        if not self.chars:
+            return None
+        if len(self.chars) == 1:
+            return self.chars[0]
+        return u''.join(self.chars)
+
+    def _start_element(self, name, _attributes):
+        if self._skip_depth:
+            self._skip_depth += 1
+            return
+        self._child_projection = None
+        if name != 'key' and self._projection_stack:
+            projection = self._projection_stack[-1]
+            if projection:
+                if isinstance(self.parse_stack[-1], list):
+                    child_projection = projection.get(None)
+                else:
+                    child_projection = projection.get(self.key,
+                                                      projection.get(None))
+                if child_projection is SKIP:
+                    self._skip_depth = 1
+                    return
+                self._child_projection = child_projection
+        handler = self._start_handlers.get(name)
+        if handler:
+            handler()
+        else:
+            print "unrecognized element in XML data: " + name
+        self.chars = []
+
+    def _start_value(self):
+        pass
+
+    def _start_dict(self):
+        new_dict = {}
+        self.add_object(new_dict)
+        self.parse_stack.append(new_dict)
+        self._projection_stack.append(self._child_projection)
+
+    def _start_array(self):
+        new_array = []
+        self.add_object(new_array)
+        self.parse_stack.append(new_array)
+        self._projection_stack.append(self._child_projection)
+
+    def _start_plist(self):
+        self.parse_stack.append([])
+        # The projection applies to the entries of the top level value.
+        self._projection_stack.append(
+            {None: self._projection} if self._projection else None)
+
+    def _characters(self, data):
+        if not self._skip_depth:
+            self.chars.append(data)
+
+    def _end_element(self, name):
+        if self._skip_depth:
+            self._skip_depth -= 1
+            if not self._skip_depth:
+                self.chars = []
+            return
+        handler = self._end_handlers.get(name)
+        if handler:
+            handler()
+        else:
+            print "unrecognized element in XML data: " + name
+        self.chars = []
+
+    def _end_key(self):
+        self.key = self._text()
+
+    def _end_string(self):
+        self.add_object(
+            unicodedata.normalize("NFC", su.unicode_string(self._text())))
+
+    def _end_value(self):
+        self.add_object(self._text())
+
+    def _end_true(self):
+        self.add_object(True)
+
+    def _end_false(self):
+        self.add_object(False)
+
+    def _end_data(self):
+        # Base64 data is spread over several lines; drop all the white space.
+        text = self._text()
+        if text is not None:
+            text = ''.join(text.split())
+        self.add_object(text)
+
+    def _end_container(self):
+        self.parse_stack.pop()
+        self._projection_stack.pop()
+
+    def _end_plist(self):
+        self.top_node = self.parse_stack.pop()
+        self._projection_stack.pop()
+
+    def feed(self, data):
+        '''Parses the next chunk of XML data.'''
+        self._parser.Parse(data, False)
+
+    def close(self):
+        '''Signals the end of the XML data.'''
+        self._parser.Parse('', True)
+
+    def parse_file(self, xml_file):
+        '''Parses all XML data from an open file.'''
+        self._parser.ParseFile(xml_file)
+
+    def gettopnode(self):
+        '''Returns the root of the parsed data tree'''
+        return self.top_node[0]
+
+
+def parse_applexml_fragment(data, projection=None):
+    '''Parses a single value element (like a <dict>...</dict>) cut out of an
+    Apple XML file. Returns the value. The projection applies to the entries of
+    the value.'''
+    parser = AppleXMLParser(projection)
+    parser.feed('<plist>')
+    parser.feed(data)
+    parser.feed('</plist>')
+    parser.close()
+    return parser.gettopnode()
+
+
+class LazyPlistDict(object):
+    '''A read-only dictionary for a large <dict> of an Apple XML file. Only
+    the byte ranges of the entries in the memory-mapped file are kept, and an
+    entry is parsed the first time it is looked up; the parsed value is then
+    kept in place of its range.
+
+    Entries can be looked up by several threads. Every entry is either in
+    _ranges or in _values; the lock guards moving it from one to the other.'''
+
+    def __init__(self, mapped_file, entry_projection=None):
+        self._mapped_file = mapped_file
+        self._entry_projection = entry_projection
+        self._ranges = {}  # key -> (start, end) byte offsets of the value
+        self._values = {}  # key -> value, for parsed and non-<dict> entries
+        self._lock = threading.Lock()
+
+    def add_range(self, key, start, end):
+        '''Records the byte range of the value of an entry.'''
+        self._ranges[key] = (start, end)
+
+    def __setitem__(self, key, value):
+        self._values[key] = value
+
+    def get(self, key, default=None):
+        '''Returns the value for key, or default, parsing it on first use.'''
+        self._lock.acquire()
+        try:
+            key_range = self._ranges.get(key)
+            if key_range is None:
+                return self._values.get(key, default)
+        finally:
+            self._lock.release()
+        data = self._mapped_file[key_range[0]:key_range[1]]
+        value = parse_applexml_fragment(data.replace('\000', ''),
+                                        self._entry_projection)
+        self._lock.acquire()
+        try:
+            if self._ranges.pop(key, None) is None:
+                # Another thread parsed the same entry meanwhile; share its
+                # value.
+                return self._values[key]
+            self._values[key] = value
+            return value
+        finally:
+            self._lock.release()
+
+    def __getitem__(self, key):
+        if not key in self:
+            raise KeyError(key)
+        return self.get(key)
+
+    def __contains__(self, key):
+        self._lock.acquire()
+        try:
+            return key in self._ranges or key in self._values
+        finally:
+            self._lock.release()
+
+    def has_key(self, key):
+        '''Tests if key is in the dictionary.'''
+        return key in self
+
+    def keys(self):
+        '''Returns the list of keys, without parsing any values.'''
+        self._lock.acquire()
+        try:
+            return self._ranges.keys() + self._values.keys()
+        finally:
+            self._lock.release()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        self._lock.acquire()
+        try:
+            return len(self._ranges) + len(self._values)
+        finally:
+            self._lock.release()
+
+    def values(self):
+        '''Parses and returns all values.'''
+        return [self.get(key) for key in self.keys()]
+
+    def items(self):
+        '''Parses and returns all (key, value) pairs.'''
+        return [(key, self.get(key)) for key in self.keys()]
+
+
+class AppleXMLIndexer(AppleXMLParser):
+    '''Parses an Apple XML file like AppleXMLParser, except for the <dict>
+    stored under indexed_key in the top level <dict>. That one becomes a
+    LazyPlistDict: the <dict> entries it contains are skipped, and only their
+    byte ranges are recorded.
+
+    The input may contain 0x00 characters; feed() strips them, and maps the
+    byte ranges back to offsets in the mapped file.'''
+
+    def __init__(self, indexed_key, mapped_file, projection=None):
+        AppleXMLParser.__init__(self, projection)
+        self._indexed_key = indexed_key
+        self._mapped_file = mapped_file
+        self._index = None
+        # Nesting depth within an indexed entry.
+        self._entry_depth = 0
+        self._entry_key = None
+        self._entry_start = 0
+        # Positions in the stripped input stream where 0x00 characters were
+        # removed, in order.
+        self._nul_positions = []
+        self._fed_bytes = 0
+
+    def feed(self, data):
+        '''Parses the next chunk of data, stripping any 0x00 characters.'''
+        nul = data.find('\000')
+        if nul != -1:
+            removed = 0
+            while nul != -1:
+                self._nul_positions.append(self._fed_bytes + nul - removed)
+                removed += 1
+                nul = data.find('\000', nul + 1)
+            data = data.replace('\000', '')
+        self._fed_bytes += len(data)
+        AppleXMLParser.feed(self, data)
+
+    def _get_file_offset(self, stream_offset):
+        '''Converts an offset in the stripped input to a file offset.'''
+        return stream_offset + bisect.bisect_right(self._nul_positions,
+                                                   stream_offset)
+
+    def _start_element(self, name, attributes):
+        if self._entry_depth:
+            self._entry_depth += 1
+            return
+        if self._skip_depth:
+            pass
+        elif self._index is not None and self.parse_stack[-1] is self._index:
+            # Skipped entries are left to AppleXMLParser._start_element().
+            if name == 'dict' and not self._is_skipped(self.key):
+                self._entry_key = self.key
+                self._entry_start = self._parser.CurrentByteIndex
+                self._entry_depth = 1
+                return
+        elif (name == 'dict' and len(self.parse_stack) == 2 and
+              self.key == self._indexed_key and
+              not self._is_skipped(self._indexed_key)):
+            projection = None
+            if self._projection:
+                projection = self._projection.get(self._indexed_key)
+            entry_projection = projection.get(None) if projection else None
+            self._index = LazyPlistDict(self._mapped_file, entry_projection)
+            self.add_object(self._index)
+            self.parse_stack.append(self._index)
+            self._projection_stack.append(projection)
+            self.chars = []
+            return
+        AppleXMLParser._start_element(self, name, attributes)
+
+    def _is_skipped(self, key):
+        '''Tests if the projection of the current <dict> skips the value of
+        key.'''
+        projection = self._projection_stack and self._projection_stack[-1]
+        return bool(projection) and projection.get(
+            key, projection.get(None)) is SKIP
+
+    def _characters(self, data):
+        if not self._entry_depth and not self._skip_depth:
+            self.chars.append(data)
+
+    def _end_element(self, name):
+        if self._entry_depth:
+            self._entry_depth -= 1
+            if not self._entry_depth:
+                start = self._get_file_offset(self._entry_start)
+                end = self._get_file_offset(self._parser.CurrentByteIndex)
+                # End of "</dict>", or "<dict/>".
+                end = self._mapped_file.find('>', end) + 1
+                self._index.add_range(self._entry_key, start, end)
+                self.chars = []
+            return
+        AppleXMLParser._end_element(self, name)
+
+
+def _create_parser(engine, projection=None):
+    '''Creates an incremental parser. Returns a (parser, handler) tuple, where
+    parser supports feed() and close(), and handler supports gettopnode().'''
+    if engine == EXPAT_ENGINE:
+        parser = AppleXMLParser(projection)
+        return (parser, parser)
+    if engine == SAX_ENGINE:
+        if projection:
+            raise ValueError, 'Projections require the %s engine' % (EXPAT_ENGINE)
+        parser = sax.make_parser()
+        handler = AppleXMLHandler()
+        parser.setContentHandler(handler)
+        return (parser, handler)
+    raise ValueError, 'Unknown XML parser engine %s' % (engine)
+
+def read_applexml(filename, engine=EXPAT_ENGINE, projection=None):
     '''Reads the named file, and parses it as an Apple XML file. Returns the
-    top node.'''
-    parser = sax.make_parser()
-    handler = AppleXMLHandler()
-    parser.setContentHandler(handler)
+    top node. If set, the projection (see make_projection()) names the parts of
+    the file that are skipped.'''
+    if engine == EXPAT_ENGINE:
+        parser = AppleXMLParser(projection)
+        f = open(filename, 'rb')
+        try:
+            parser.parse_file(f)
+        finally:
+            f.close()
+        return parser.gettopnode()
+    (parser, handler) = _create_parser(engine, projection)
     parser.setEntityResolver(AppleXMLResolver())
     parser.parse(filename)
     return handler.gettopnode()
 
-def read_applexml_fixed(filename):
+def read_applexml_fixed(filename, engine=EXPAT_ENGINE, projection=None):
     '''Reads the named file, and parses it as an Apple XML file. Returns the
     top node. Replaces bad characters in the input file. Sometimes AlbumData.xml
     contains 0x00 characters!'''
     f = open(filename, buffering=16384)
     data = f.read().replace('\000', '')
     f.close()
-    return read_applexml_string(data)
+    return read_applexml_string(data, engine, projection)
 
-def read_applexml_string(data):
+def read_applexml_streaming(filename, chunk_size=_READ_CHUNK_SIZE,
+                            engine=EXPAT_ENGINE, projection=None):
+    '''Reads the named file, and parses it as an Apple XML file. Returns the
+    top node. Like read_applexml_fixed(), strips any 0x00 characters from the
+    input, but does so chunk by chunk while feeding an incremental parser, so
+    the raw file is never held in memory as a whole.'''
+    (parser, handler) = _create_parser(engine, projection)
+    f = open(filename, 'rb')
+    try:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            parser.feed(chunk.replace('\000', ''))
+        parser.close()
+    finally:
+        f.close()
+    return handler.gettopnode()
+
+def read_application_version(filename):
+    '''Returns the "Application Version" of an Apple XML file, without parsing
+    the file, or None if it is not near the start of the file (where iPhoto
+    and Aperture write it).'''
+    f = open(filename, 'rb')
+    try:
+        header = f.read(_HEADER_SIZE).replace('\000', '')
+    finally:
+        f.close()
+    match = _APPLICATION_VERSION_PATTERN.search(header)
+    if not match:
+        return None
+    return saxutils.unescape(match.group(1)).decode('utf-8')
+
+def read_applexml_indexed(filename, indexed_key, chunk_size=_READ_CHUNK_SIZE,
+                          projection=None):
+    '''Reads the named file, and parses it as an Apple XML file. Returns the
+    top node. The <dict> under indexed_key in the top node is returned as a
+    LazyPlistDict, which parses its entries from a memory-mapped copy of the
+    file when they are looked up.'''
+    f = open(filename, 'rb')
+    try:
+        mapped_file = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+    parser = AppleXMLIndexer(indexed_key, mapped_file, projection)
+    for offset in xrange(0, len(mapped_file), chunk_size):
+        parser.feed(mapped_file[offset:offset + chunk_size])
+    parser.close()
+    return parser.gettopnode()
+
+def _find_dict_entries(mapped_file, key, chunk_size):
+    '''Finds the <dict> stored under key in the top level <dict> of a
+    memory-mapped Apple XML file, and splits its content into chunks of about
+    chunk_size bytes, on the boundaries between its entries.
+
+    Returns: a (start, end, chunks) tuple, where start and end are the offsets
+    of the content of the <dict> (between "<dict>" and "</dict>"), and chunks
+    is a list of (start, end) offsets that each hold complete entries. Returns
+    None if there is no such <dict>.
+    '''
+    key_tag = '<key>%s</key>' % (saxutils.escape(key))
+    position = 0
+    # <dict> nesting depth at the scanned offset. Only keys directly in the top
+    # level <dict> (depth 1) count.
+    depth = 0
+    scanned = 0
+    while True:
+        position = mapped_file.find(key_tag, position)
+        if position == -1:
+            return None
+        for match in _DICT_TAG_PATTERN.finditer(mapped_file, scanned, position):
+            depth += -1 if match.group(1) else 1
+        scanned = position
+        if depth == 1:
+            break
+        position += len(key_tag)
+    match = _DICT_START_PATTERN.match(mapped_file, position + len(key_tag))
+    if not match:
+        return None
+    start = match.end()
+    # Track the <dict> nesting depth; an entry ends whenever the depth returns
+    # to 1, and the <dict> ends when it drops to 0.
+    chunks = []
+    chunk_start = start
+    depth = 1
+    for match in _DICT_TAG_PATTERN.finditer(mapped_file, start):
+        if not match.group(1):
+            depth += 1
+            continue
+        depth -= 1
+        if not depth:
+            end = match.start()
+            if end > chunk_start:
+                chunks.append((chunk_start, end))
+            return (start, end, chunks)
+        if depth == 1 and match.end() - chunk_start >= chunk_size:
+            chunks.append((chunk_start, match.end()))
+            chunk_start = match.end()
+    return None
+
+def _parse_dict_chunk(args):
+    '''Parses the <dict> entries in a byte range of a file, and returns them
+    as a dictionary. Runs in the worker processes of
+    read_applexml_parallel().'''
+    (filename, start, end, projection) = args
+    f = open(filename, 'rb')
+    try:
+        f.seek(start)
+        data = f.read(end - start)
+    finally:
+        f.close()
+    return parse_applexml_fragment(
+        '<dict>%s</dict>' % (data.replace('\000', '')), projection)
+
+def read_applexml_parallel(filename, split_key, processes=None,
+                           chunk_size=None, projection=None):
+    '''Reads the named file, and parses it as an Apple XML file. Returns the
+    top node. The entries of the <dict> under split_key in the top node are
+    split into chunks, which are parsed in parallel by a pool of worker
+    processes (one per CPU by default), and merged back into a single
+    dictionary. Like read_applexml_streaming(), strips any 0x00 characters.
+    '''
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    split_projection = projection.get(split_key) if projection else None
+    if processes <= 1 or split_projection is SKIP:
+        return read_applexml_streaming(filename, projection=projection)
+    f = open(filename, 'rb')
+    try:
+        mapped_file = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+    try:
+        if not chunk_size:
+            chunk_size = max(_MIN_PARALLEL_CHUNK_SIZE, len(mapped_file) / (
+                processes * _CHUNKS_PER_PROCESS))
+        split = _find_dict_entries(mapped_file, split_key, chunk_size)
+        if not split or len(split[2]) <= 1:
+            return read_applexml_streaming(filename, projection=projection)
+        (start, end, chunks) = split
+
+        pool = multiprocessing.Pool(min(processes, len(chunks)))
+        try:
+            results = pool.imap(_parse_dict_chunk, [
+                (filename, chunk_start, chunk_end, split_projection)
+                for (chunk_start, chunk_end) in chunks])
+            # Parse everything else while the workers are busy, with the split
+            # <dict> left empty.
+            parser = AppleXMLParser(projection)
+            for (range_start, range_end) in ((0, start), (end, len(mapped_file))):
+                for offset in xrange(range_start, range_end, _READ_CHUNK_SIZE):
+                    parser.feed(mapped_file[offset:min(
+                        offset + _READ_CHUNK_SIZE, range_end)].replace('\000', ''))
+            parser.close()
+            top_node = parser.gettopnode()
+            entries = top_node[split_key]
+            for chunk_entries in results:
+                entries.update(chunk_entries)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        return top_node
+    finally:
+        mapped_file.close()
+
+def read_applexml_string(data, engine=EXPAT_ENGINE, projection=None):
     '''Parses the data as Apple XML format. Returns the top node.'''
-    #parser = sax.make_parser()
-    handler = AppleXMLHandler()
+    if engine == EXPAT_ENGINE:
+        parser = AppleXMLParser(projection)
+        parser.feed(data)
+        parser.close()
+        return parser.gettopnode()
+    (_, handler) = _create_parser(engine, projection)
     #parser.setContentHandler(handler)
     #parser.setEntityResolver(AppleXMLResolver())
     sax.parseString(data, handler)
     return handler.gettopnode()
-
@@ -0,0 +1,175 @@
+"""Measures the applexml parser on a synthetic plist.
+
+Compares the parse time of the parser engines and of parallel parsing, and
+the parse time and peak memory of the projections used for common Phoshare
+option combinations.
+
+Every configuration is measured --repeat times, and the minimum and median
+times are reported, as single runs are too noisy to compare.
+
+Usage: python -m appledata.applexml_benchmark [--images N] [--blob_lines N]
+       [--repeat N] (see appledata.librarygen for more options)
+"""
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import cPickle
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+from optparse import OptionParser
+
+import appledata.applexml as applexml
+import appledata.librarygen as librarygen
+import phoshare.phoshare_main as phoshare_main
+
+# Option combinations to measure projections for. The first one matches
+# CopyLibraryToDrive.sh.
+_OPTION_SETS = (
+    ['-e', '.*', '--facealbums', '--face_keywords', '-f'],
+    ['-e', '.*'],
+    ['-e', '.*', '-a', '.'],
+    ['-e', '.*', '-a', '.', '-f'],
+)
+
+
+def _get_max_rss_mb(who):
+    """Returns the peak resident memory in MB of this process
+    (resource.RUSAGE_SELF), or of the largest of its terminated child
+    processes (resource.RUSAGE_CHILDREN)."""
+    max_rss = resource.getrusage(who).ru_maxrss
+    # ru_maxrss is in bytes on Mac OS X, and in kilobytes on Linux.
+    if sys.platform != 'darwin':
+        max_rss *= 1024
+    return max_rss / 1024.0 / 1024.0
+
+
+def _measure(function):
+    """Runs function in a child process, and returns the elapsed time in
+    seconds, the peak resident memory in MB of the child, and the peak
+    resident memory in MB of the largest process the child started (0 if it
+    started none)."""
+    (read_fd, write_fd) = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        start = time.time()
+        function()
+        elapsed = time.time() - start
+        os.write(write_fd, cPickle.dumps((
+            elapsed, _get_max_rss_mb(resource.RUSAGE_SELF),
+            _get_max_rss_mb(resource.RUSAGE_CHILDREN))))
+        os._exit(0)
+    os.close(write_fd)
+    result = ''
+    while True:
+        data = os.read(read_fd, 4096)
+        if not data:
+            break
+        result += data
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    return cPickle.loads(result)
+
+
+def _measure_repeated(function, repeat):
+    """Runs _measure() repeat times. Returns the minimum and the median
+    elapsed time in seconds, and the median peak memory in MB."""
+    runs = [_measure(function) for _ in xrange(repeat)]
+    times = sorted([run[0] for run in runs])
+    memory = sorted([run[1] for run in runs])
+    return (times[0], _median(times), _median(memory))
+
+
+def _median(values):
+    """Returns the median of a sorted list."""
+    middle = len(values) / 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def main(args):
+    parser = OptionParser()
+    parser.add_option('--images', type='int', default=100000,
+                      help='Number of images in the synthetic plist.')
+    librarygen.add_spec_options(parser)
+    parser.set_defaults(blob_lines=4)
+    parser.add_option('--processes', type='int', default=0,
+                      help='Number of parallel parser processes (0: per CPU).')
+    parser.add_option('--repeat', type='int', default=5,
+                      help='Number of runs of every configuration.')
+    (options, _) = parser.parse_args(args)
+
+    (handle, xml_file) = tempfile.mkstemp(suffix='.xml')
+    out = os.fdopen(handle, 'w')
+    try:
+        librarygen.write_library(out, librarygen.get_spec(options,
+                                                          options.images))
+        out.close()
+        print 'Synthetic plist: %d images, %.1f MB' % (
+            options.images, os.path.getsize(xml_file) / 1024.0 / 1024.0)
+
+        print 'Engines (%d runs):' % (options.repeat)
+        results = {}
+        for engine in (applexml.SAX_ENGINE, applexml.EXPAT_ENGINE):
+            results[engine] = _measure_repeated(
+                lambda: applexml.read_applexml_streaming(xml_file, engine=engine),
+                options.repeat)
+            print '  %-6s min %8.2f s, median %8.2f s %8.1f MB' % (
+                (engine,) + results[engine])
+        (sax_min, sax_median, _) = results[applexml.SAX_ENGINE]
+        (expat_min, expat_median, _) = results[applexml.EXPAT_ENGINE]
+        print '  Speedup: %.2fx (min), %.2fx (median)' % (
+            sax_min / expat_min, sax_median / expat_median)
+
+        processes = options.processes or multiprocessing.cpu_count()
+        (elapsed, memory, worker_memory) = _measure(
+            lambda: applexml.read_applexml_parallel(
+                xml_file, 'Master Image List', processes=processes))
+        # The workers run at the same time, so the total peak can be up to
+        # the parent's plus processes times the largest worker's.
+        print ('Parallel (%d processes): %8.2f s %8.1f MB, largest worker '
+               '%.1f MB' % (processes, elapsed, memory, worker_memory))
+        print '  Speedup: %.2fx' % (expat_median / elapsed)
+
+        print 'Projections (expat engine, %d runs, vs. the full parse):' % (
+            options.repeat)
+        (full_min, full_time, full_memory) = results[applexml.EXPAT_ENGINE]
+        option_parser = phoshare_main.get_option_parser()
+        for option_set in _OPTION_SETS:
+            (phoshare_options, _) = option_parser.parse_args(option_set)
+            projection = applexml.make_projection(
+                phoshare_main.get_excluded_xml_paths(phoshare_options,
+                                                     options.aperture))
+            (elapsed_min, elapsed, memory) = _measure_repeated(
+                lambda: applexml.read_applexml_streaming(
+                    xml_file, projection=projection), options.repeat)
+            print ('  %-40s min %6.2f s (%+5.1f%%), median %6.2f s (%+5.1f%%), '
+                   '%7.1f MB (%+5.1f%%)' % (
+                       ' '.join(option_set), elapsed_min,
+                       (elapsed_min - full_min) * 100.0 / full_min, elapsed,
+                       (elapsed - full_time) * 100.0 / full_time, memory,
+                       (memory - full_memory) * 100.0 / full_memory))
+    finally:
+        os.remove(xml_file)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
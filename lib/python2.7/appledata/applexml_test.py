@@ -0,0 +1,250 @@
+"""This module tests appledata/applexml.py."""
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import cPickle
+import datetime
+import os
+import tempfile
+import unittest
+
+import appledata.applexml as applexml
+
+_TEST_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<plist version="1.0">
+<dict>
+\t<key>Application Version</key>
+\t<string>9.4.3 (9.4.3)</string>
+\t<key>List of Keywords</key>
+\t<dict>
+\t\t<key>1</key>
+\t\t<string>Caf\xc3\xa9\000</string>
+\t</dict>
+\t<key>Master Image List</key>
+\t<dict>
+\t\t<key>42</key>
+\t\t<dict>
+\t\t\t<key>Caption</key>
+\t\t\t<string>Tom &amp; Jerry\000\000</string>
+\t\t\t<key>DateAsTimerInterval</key>
+\t\t\t<real>317329526.000000</real>
+\t\t\t<key>Rating</key>
+\t\t\t<integer>3</integer>
+\t\t\t<key>Keywords</key>
+\t\t\t<array>
+\t\t\t\t<string>1</string>
+\t\t\t</array>
+\t\t\t<key>RotationIsOnlyEdit</key>
+\t\t\t<false/>
+\t\t\t<key>Blob</key>
+\t\t\t<data>
+\t\t\tAQEAAwAAAAIAAAAZAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA
+\t\t\tAAAAAA==
+\t\t\t</data>
+\t\t</dict>
+\t</dict>
+</dict>
+</plist>
+'''
+
+
+class AppleXmlTest(unittest.TestCase):
+    """Unit tests for applexml.py code."""
+
+    def setUp(self):
+        (handle, self.xml_file) = tempfile.mkstemp(suffix='.xml')
+        os.write(handle, _TEST_XML)
+        os.close(handle)
+
+    def tearDown(self):
+        os.remove(self.xml_file)
+
+    def test_read_applexml_fixed(self):
+        """Tests applexml.read_applexml_fixed()."""
+        top_node = applexml.read_applexml_fixed(self.xml_file)
+        self.assertEquals(u'Caf\xe9', top_node['List of Keywords']['1'])
+        image = top_node['Master Image List']['42']
+        self.assertEquals(u'Tom & Jerry', image['Caption'])
+        self.assertEquals('3', image['Rating'])
+        self.assertEquals(['1'], image['Keywords'])
+        self.assertEquals(False, image['RotationIsOnlyEdit'])
+        self.assertEquals('AQEAAwAAAAIAAAAZAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA'
+                          'AAAAAA==', image['Blob'])
+
+    def test_read_applexml_streaming(self):
+        """Tests applexml.read_applexml_streaming() against
+        read_applexml_fixed(), using chunk sizes that split tags and multi-byte
+        characters."""
+        expected = applexml.read_applexml_fixed(self.xml_file)
+        for chunk_size in (1, 7, 64, 1024 * 1024):
+            self.assertEquals(expected, applexml.read_applexml_streaming(
+                self.xml_file, chunk_size=chunk_size))
+
+    def test_expat_engine(self):
+        """Tests that the expat engine builds the same tree as the SAX
+        handler."""
+        expected = applexml.read_applexml_fixed(self.xml_file,
+                                                engine=applexml.SAX_ENGINE)
+        self.assertEquals(expected, applexml.read_applexml_fixed(
+            self.xml_file, engine=applexml.EXPAT_ENGINE))
+        self.assertEquals(expected, applexml.read_applexml_string(
+            _TEST_XML.replace('\000', ''), engine=applexml.EXPAT_ENGINE))
+        for chunk_size in (1, 7, 1024 * 1024):
+            self.assertEquals(expected, applexml.read_applexml_streaming(
+                self.xml_file, chunk_size=chunk_size,
+                engine=applexml.EXPAT_ENGINE))
+
+    def test_read_application_version(self):
+        """Tests reading the application version from the start of a
+        file."""
+        self.assertEquals(u'9.4.3 (9.4.3)',
+                          applexml.read_application_version(self.xml_file))
+        out = open(self.xml_file, 'w')
+        out.write('<plist version="1.0">\n<dict>\n</dict>\n</plist>\n')
+        out.close()
+        self.assertEquals(None,
+                          applexml.read_application_version(self.xml_file))
+
+    def test_read_applexml_indexed(self):
+        """Tests that applexml.read_applexml_indexed() finds the same entries
+        as read_applexml_fixed(), despite 0x00 characters in the file."""
+        expected = applexml.read_applexml_fixed(self.xml_file)
+        for chunk_size in (7, 1024 * 1024):
+            top_node = applexml.read_applexml_indexed(
+                self.xml_file, 'Master Image List', chunk_size=chunk_size)
+            images = top_node['Master Image List']
+            self.assertTrue(isinstance(images, applexml.LazyPlistDict))
+            self.assertEquals(expected['List of Keywords'],
+                              top_node['List of Keywords'])
+            self.assertEquals([u'42'], images.keys())
+            self.assertTrue(images.has_key('42'))
+            self.assertEquals(expected['Master Image List']['42'],
+                              images.get('42'))
+            self.assertEquals(None, images.get('43'))
+            # A parsed entry is kept, and not parsed again.
+            self.assertTrue(images.get('42') is images['42'])
+            self.assertEquals([u'42'], images.keys())
+            self.assertEquals(1, len(images))
+            self.assertTrue('42' in images)
+
+    def test_projection(self):
+        """Tests that a projection skips the excluded values."""
+        projection = applexml.make_projection([
+            ('Master Image List', None, 'Keywords'),
+            ('Master Image List', None, 'Blob'),
+            ('List of Keywords',)])
+        expected = applexml.read_applexml_fixed(self.xml_file)
+        del expected['List of Keywords']
+        expected_image = expected['Master Image List']['42']
+        del expected_image['Keywords']
+        del expected_image['Blob']
+        self.assertEquals(expected, applexml.read_applexml_fixed(
+            self.xml_file, projection=projection))
+        self.assertEquals(expected, applexml.read_applexml_streaming(
+            self.xml_file, chunk_size=7, projection=projection))
+        top_node = applexml.read_applexml_indexed(
+            self.xml_file, 'Master Image List', projection=projection)
+        self.assertFalse('List of Keywords' in top_node)
+        self.assertEquals(expected_image, top_node['Master Image List']['42'])
+        # The indexed <dict>, or all its entries, can be skipped too.
+        for path in (('Master Image List',), ('Master Image List', None)):
+            projection = applexml.make_projection([path])
+            expected = applexml.read_applexml_fixed(self.xml_file,
+                                                    projection=projection)
+            top_node = applexml.read_applexml_indexed(
+                self.xml_file, 'Master Image List', projection=projection)
+            self.assertEquals(sorted(expected.keys()), sorted(top_node.keys()))
+            if 'Master Image List' in expected:
+                self.assertEquals(expected['Master Image List'],
+                                  dict(top_node['Master Image List'].items()))
+        self.assertEquals(None, applexml.make_projection([]))
+        self.assertRaises(ValueError, applexml.read_applexml_fixed,
+                          self.xml_file, engine=applexml.SAX_ENGINE,
+                          projection=projection)
+
+    def test_read_applexml_parallel(self):
+        """Tests that applexml.read_applexml_parallel() builds the same tree as
+        read_applexml_fixed(), for a dictionary split into several chunks."""
+        entries = ''.join([
+            '<key>%d</key><dict><key>Caption</key><string>Image\000 %d</string>'
+            '<key>Faces</key><array><dict><key>face key</key>'
+            '<integer>1</integer></dict></array></dict>\n' % (i, i)
+            for i in xrange(20)])
+        out = open(self.xml_file, 'w')
+        out.write(_TEST_XML.replace('<key>42</key>', entries + '<key>42</key>'))
+        out.close()
+        expected = applexml.read_applexml_fixed(self.xml_file)
+        self.assertEquals(21, len(expected['Master Image List']))
+        for chunk_size in (1, 100, 1024 * 1024):
+            self.assertEquals(expected, applexml.read_applexml_parallel(
+                self.xml_file, 'Master Image List', processes=3,
+                chunk_size=chunk_size))
+        projection = applexml.make_projection([
+            ('Master Image List', None, 'Faces')])
+        self.assertEquals(
+            applexml.read_applexml_fixed(self.xml_file, projection=projection),
+            applexml.read_applexml_parallel(self.xml_file, 'Master Image List',
+                                            processes=3, chunk_size=100,
+                                            projection=projection))
+
+    def test_find_dict_entries(self):
+        """Tests that applexml._find_dict_entries() only finds the key in the
+        top level <dict>."""
+        data = ('<plist><dict><key>A</key><dict><key>B</key><dict></dict>'
+                '</dict><key>C</key><array><dict><key>B</key><dict><key>x'
+                '</key><dict/></dict></dict></array><key>B</key><dict>'
+                '<key>1</key><dict></dict><key>2</key><dict></dict></dict>'
+                '</dict></plist>')
+        (start, end, chunks) = applexml._find_dict_entries(data, 'B', 1)
+        self.assertEquals('<key>1</key><dict></dict><key>2</key><dict></dict>',
+                          data[start:end])
+        self.assertEquals(['<key>1</key><dict></dict>',
+                           '<key>2</key><dict></dict>'],
+                          [data[s:e] for (s, e) in chunks])
+        self.assertEquals(None, applexml._find_dict_entries(data, 'x', 1))
+
+    def test_apple_time_table(self):
+        """Tests applexml.AppleTimeTable against applexml.getappletime()."""
+        table = applexml.AppleTimeTable()
+        values = ['317329526.000000', u'100.5', None, 'bad', '-100.0']
+        indices = [table.add(value) for value in values]
+        indices.append(table.add_datetime(datetime.datetime(2005, 1, 2)))
+        for index in (0, 1, 4):
+            self.assertEquals(applexml.getappletime(values[index]),
+                              table.getdatetime(indices[index]))
+        self.assertEquals([4, 1, 5, 0, 2, 3], table.sort(indices))
+        self.assertEquals([0, 5], table.select(
+            indices, start=datetime.datetime(2005, 1, 2)))
+        self.assertEquals([1, 4], table.select(
+            indices, end=datetime.datetime(2005, 1, 2)))
+        self.assertEquals(4, table.argmin(indices))
+        self.assertEquals(None, table.argmin(indices[2:4]))
+        self.assertEquals(0, table.argmax(indices))
+        self.assertEquals(None, table.argmax(indices[2:4]))
+        # Missing and bad time stamps are "now".
+        self.assertTrue(table.getdatetime(3) > datetime.datetime(2020, 1, 1))
+
+        copied = cPickle.loads(cPickle.dumps(table, cPickle.HIGHEST_PROTOCOL))
+        self.assertEquals(len(table), len(copied))
+        self.assertEquals(table.getdatetime(0), copied.getdatetime(0))
+
+    def test_unknown_engine(self):
+        """Tests that an unknown engine is rejected."""
+        self.assertRaises(ValueError, applexml.read_applexml_streaming,
+                          self.xml_file, engine='dom')
+
+
+if __name__ == '__main__':
+    unittest.main()
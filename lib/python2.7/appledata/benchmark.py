@@ -0,0 +1,216 @@
+"""Load benchmark suite for iPhoto and Aperture libraries.
+
+Generates synthetic libraries (see librarygen.py) at one or more scales, and
+times and memory-profiles the stages of loading them:
+
+  read_applexml_fixed     parsing the XML file
+  IPhotoData              building the object graph from the parsed data
+  getfacealbums           building the face albums
+  get_lookup_index        building the image lookup index
+
+Each library is loaded in a child process, so every measurement starts with a
+fresh heap. The results are written as JSON, and can be compared with the
+results of a previous run (for example, of a previous version) with
+--compare.
+
+Usage: python -m appledata.benchmark [--images N[,N...]] [--output FILE]
+                                     [--compare FILE]
+"""
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import cPickle
+import json
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from optparse import OptionParser
+
+import appledata.applexml as applexml
+import appledata.iphotodata as iphotodata
+import appledata.librarygen as librarygen
+import phoshare.phoshare_version as phoshare_version
+
+# Version of the JSON result format.
+RESULTS_VERSION = 1
+
+
+def _get_max_rss():
+    """Returns the peak resident memory of this process in bytes."""
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on Mac OS X, and in kilobytes on Linux.
+    if sys.platform != 'darwin':
+        max_rss *= 1024
+    return max_rss
+
+
+def _run_stage(stages, name, function, *args):
+    """Runs one stage, and records its time and peak memory in stages."""
+    start = time.time()
+    result = function(*args)
+    stages.append({'name': name,
+                   'seconds': round(time.time() - start, 4),
+                   'max_rss_mb': round(_get_max_rss() / 1024.0 / 1024.0, 1)})
+    return result
+
+
+def _load_library(xml_file, aperture):
+    """Loads a library stage by stage. Returns the list of stage results."""
+    stages = []
+    album_xml = _run_stage(stages, 'read_applexml_fixed',
+                           applexml.read_applexml_fixed, xml_file)
+    data = _run_stage(stages, 'IPhotoData', iphotodata.IPhotoData, album_xml,
+                      None, None, aperture, None)
+    del album_xml
+    _run_stage(stages, 'getfacealbums', data.getfacealbums)
+    _run_stage(stages, 'get_lookup_index', data.get_lookup_index)
+    return stages
+
+
+def _run_in_child(function, *args):
+    """Runs function in a child process. Returns the result of function, which
+    must be picklable."""
+    (read_fd, write_fd) = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            result = (True, function(*args))
+        except Exception, ex:
+            result = (False, '%s: %s' % (type(ex).__name__, ex))
+        os.write(write_fd, cPickle.dumps(result, cPickle.HIGHEST_PROTOCOL))
+        os._exit(0)
+    os.close(write_fd)
+    data = ''
+    while True:
+        chunk = os.read(read_fd, 4096)
+        if not chunk:
+            break
+        data += chunk
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    if not data:
+        raise RuntimeError('Benchmark process died (out of memory?)')
+    (success, result) = cPickle.loads(data)
+    if not success:
+        raise RuntimeError(result)
+    return result
+
+
+def run_benchmark(spec, folder):
+    """Generates a library for spec in folder, and loads it. Returns the result
+    as a dictionary."""
+    xml_file = os.path.join(
+        folder, 'ApertureData.xml' if spec.aperture else 'AlbumData.xml')
+    out = open(xml_file, 'w')
+    try:
+        librarygen.write_library(out, spec)
+    finally:
+        out.close()
+    try:
+        return {'library': spec.todict(),
+                'file_size': os.path.getsize(xml_file),
+                'stages': _run_in_child(_load_library, xml_file, spec.aperture)}
+    finally:
+        os.remove(xml_file)
+
+
+def get_results_header():
+    """Returns the description of the environment the benchmark runs in."""
+    return {'results_version': RESULTS_VERSION,
+            'phoshare_version': phoshare_version.PHOSHARE_VERSION,
+            'python_version': platform.python_version(),
+            'platform': platform.platform(),
+            'numpy': applexml.numpy is not None,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def print_results(results, baseline=None):
+    """Prints the results as a table. If there is a baseline (results of a
+    previous run), prints the ratios to its times and memory."""
+    baseline_stages = {}
+    if baseline:
+        for result in baseline['results']:
+            for stage in result['stages']:
+                baseline_stages[(_get_library_key(result), stage['name'])] = stage
+    for result in results['results']:
+        library = result['library']
+        print '%d images, %d events, %d albums, %d faces (%s, %.1f MB):' % (
+            library['images'], library['events'], library['albums'],
+            library['faces'], 'Aperture' if library['aperture'] else 'iPhoto',
+            result['file_size'] / 1024.0 / 1024.0)
+        for stage in result['stages']:
+            line = '  %-24s %9.3f s %9.1f MB' % (stage['name'], stage['seconds'],
+                                                 stage['max_rss_mb'])
+            old_stage = baseline_stages.get((_get_library_key(result),
+                                             stage['name']))
+            if old_stage:
+                line += '   %6.2fx time %6.2fx memory' % (
+                    stage['seconds'] / max(old_stage['seconds'], 0.0001),
+                    stage['max_rss_mb'] / max(old_stage['max_rss_mb'], 0.1))
+            print line
+
+
+def _get_library_key(result):
+    """Returns a key that identifies the library of a result, for comparing
+    results between runs."""
+    return tuple(sorted(result['library'].items()))
+
+
+def main(args):
+    parser = OptionParser()
+    parser.add_option('--images', default='10000,100000',
+                      help='Comma separated list of library sizes to measure.')
+    librarygen.add_spec_options(parser)
+    parser.add_option('--output',
+                      help='Write the results as JSON to this file.')
+    parser.add_option('--compare',
+                      help='JSON results of a previous run to compare with.')
+    (options, _) = parser.parse_args(args)
+
+    baseline = None
+    if options.compare:
+        baseline_file = open(options.compare)
+        try:
+            baseline = json.load(baseline_file)
+        finally:
+            baseline_file.close()
+
+    results = get_results_header()
+    results['results'] = []
+    folder = tempfile.mkdtemp()
+    try:
+        for images in [int(size) for size in options.images.split(',')]:
+            results['results'].append(run_benchmark(
+                librarygen.get_spec(options, images), folder))
+    finally:
+        shutil.rmtree(folder)
+
+    print_results(results, baseline)
+    if options.output:
+        out = open(options.output, 'w')
+        try:
+            json.dump(results, out, indent=2, sort_keys=True)
+        finally:
+            out.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
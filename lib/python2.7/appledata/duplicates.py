@@ -0,0 +1,358 @@
+'''Finds images of a library whose files have the same content.
+
+Imports often add the same camera file to iPhoto more than once. Files are
+grouped by size first, and only files of the same size are read: a digest of
+the start and the end of the file separates most of them, and only the files
+that still match are read completely.
+
+Digests are remembered by device, inode, modification time and size of the
+file (see DigestMemo), and saved between runs, so files that did not change
+are not read again. The same digests tell an export with --content_digest
+whether a file changed.
+'''
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import cPickle
+import hashlib
+import os
+import threading
+import time
+
+import appledata.snapshot as snapshot
+import tilutil.systemutils as su
+
+# Bump up the version number when the digests change. Causes saved digests to
+# expire.
+MEMO_VERSION = "phoshare_digests_2"
+
+# Bytes read from the start and from the end of a file for its partial digest.
+PARTIAL_SIZE = 64 * 1024
+
+
+def _get_partial_digest(path, size):
+    """Returns the MD5 hex digest of the first and the last PARTIAL_SIZE bytes
+    of a file. For files of up to 2 * PARTIAL_SIZE bytes, this is the digest
+    of the whole file."""
+    digest = hashlib.md5()
+    f = open(path, 'rb')
+    try:
+        digest.update(f.read(PARTIAL_SIZE))
+        if size > PARTIAL_SIZE:
+            f.seek(max(PARTIAL_SIZE, size - PARTIAL_SIZE))
+            digest.update(f.read(PARTIAL_SIZE))
+    finally:
+        f.close()
+    return digest.hexdigest()
+
+
+def _get_key(file_stat):
+    """Returns the key of the digests of a file in a DigestMemo."""
+    return (file_stat.st_dev, file_stat.st_ino, file_stat.st_mtime,
+            file_stat.st_size)
+
+
+class DigestMemo(object):
+    """Remembers the digests of files by (device, inode, modification time,
+    size), so unchanged files are not read again, even if they were renamed.
+
+    The memo is shared by features that look up different files (e.g.,
+    --duplicates and --content_digest), so digests that were not looked up
+    are kept. save_memo() drops the digests of files that no longer exist or
+    changed (see prune()).
+
+    The digests can be looked up from several threads (e.g., while the
+    export manifest records files).
+    """
+
+    def __init__(self):
+        # key -> [partial digest, digest or None, path the file was read as]
+        self._digests = {}
+        self._init_counts()
+
+    def _init_counts(self):
+        self._used = set()  # keys looked up since the memo was loaded
+        self._lock = threading.Lock()
+        self.lookups = 0  # number of digests looked up
+        self.hits = 0  # number of digests that were known
+        self.reads = 0  # number of files read
+        self.read_bytes = 0
+        self.read_seconds = 0.0
+
+    def __getstate__(self):
+        return {'digests': self._digests}
+
+    def __setstate__(self, state):
+        self._digests = state['digests']
+        self._init_counts()
+
+    def __len__(self):
+        return len(self._digests)
+
+    def _get_entry(self, path, file_stat):
+        key = _get_key(file_stat)
+        self._lock.acquire()
+        try:
+            self._used.add(key)
+            self.lookups += 1
+            entry = self._digests.get(key)
+            if entry is None:
+                entry = [None, None, path]
+                self._digests[key] = entry
+            else:
+                # The file may have been renamed.
+                entry[2] = path
+            return entry
+        finally:
+            self._lock.release()
+
+    def prune(self, stat_cache=None):
+        """Drops the digests of files that no longer exist, or changed since
+        their digests were taken. Digests that were looked up since the memo
+        was loaded are kept without checking their files."""
+        if stat_cache is None:
+            stat_cache = su.get_stat_cache()
+        for (key, entry) in self._digests.items():
+            if key in self._used:
+                continue
+            file_stat = stat_cache.stat(entry[2])
+            if not file_stat or _get_key(file_stat) != key:
+                del self._digests[key]
+
+    def _count_read(self, size, start):
+        self._lock.acquire()
+        try:
+            self.reads += 1
+            self.read_bytes += size
+            self.read_seconds += time.time() - start
+        finally:
+            self._lock.release()
+
+    def _count_hit(self):
+        self._lock.acquire()
+        try:
+            self.hits += 1
+        finally:
+            self._lock.release()
+
+    def get_partial_digest(self, path, file_stat):
+        """Returns the partial digest of a file, or None if it cannot be
+        read."""
+        entry = self._get_entry(path, file_stat)
+        if entry[0] is not None:
+            self._count_hit()
+            return entry[0]
+        start = time.time()
+        try:
+            digest = _get_partial_digest(path, file_stat.st_size)
+        except IOError, ex:
+            su.perr(u'Could not read %s: %s' % (path, unicode(ex)))
+            return None
+        self._count_read(min(file_stat.st_size, 2 * PARTIAL_SIZE), start)
+        if file_stat.st_size <= 2 * PARTIAL_SIZE:
+            entry[1] = digest
+        entry[0] = digest
+        return digest
+
+    def get_digest(self, path, file_stat):
+        """Returns the digest of the content of a file, or None if it cannot
+        be read."""
+        entry = self._get_entry(path, file_stat)
+        if entry[1] is not None:
+            self._count_hit()
+            return entry[1]
+        start = time.time()
+        try:
+            digest = snapshot.get_file_digest(path)
+        except IOError, ex:
+            su.perr(u'Could not read %s: %s' % (path, unicode(ex)))
+            return None
+        self._count_read(file_stat.st_size, start)
+        entry[1] = digest
+        return digest
+
+    def get_summary(self):
+        """Returns the number of digests that were known, and the hashing
+        throughput, as text."""
+        megabytes = self.read_bytes / 1024.0 / 1024.0
+        return (u'%d of %d digests known (%.0f%%), read %d files (%.1f MB in '
+                u'%.1f s, %.1f MB/s)' % (
+                    self.hits, self.lookups,
+                    100.0 * self.hits / max(self.lookups, 1), self.reads,
+                    megabytes, self.read_seconds,
+                    megabytes / max(self.read_seconds, 1e-6)))
+
+
+def get_memo_path(snapshot_folder=None):
+    """Returns the path of the file with the saved digests."""
+    if not snapshot_folder:
+        snapshot_folder = su.expand_home_folder(snapshot.SNAPSHOT_FOLDER)
+    return os.path.join(snapshot_folder, 'digests.memo')
+
+
+def load_memo(memo_path):
+    """Loads the saved digests. Returns an empty DigestMemo if there are
+    none."""
+    if not os.path.exists(memo_path):
+        return DigestMemo()
+    memo_file = None
+    try:
+        memo_file = open(memo_path, 'rb')
+        if cPickle.load(memo_file) == MEMO_VERSION:
+            memo = cPickle.load(memo_file)
+            if isinstance(memo, DigestMemo):
+                return memo
+    except Exception, ex:
+        su.perr(u"Could not read file digests from %s: %s." % (
+            memo_path, unicode(ex)))
+    finally:
+        if memo_file:
+            memo_file.close()
+    return DigestMemo()
+
+
+def save_memo(memo_path, memo, stat_cache=None):
+    """Saves the digests of a DigestMemo, without the digests of files that
+    no longer exist or changed (see DigestMemo.prune())."""
+    memo.prune(stat_cache)
+    temp_path = memo_path + '.tmp'
+    try:
+        memo_folder = os.path.dirname(memo_path)
+        if not os.path.exists(memo_folder):
+            os.makedirs(memo_folder)
+        out = open(temp_path, 'wb')
+        try:
+            cPickle.dump(MEMO_VERSION, out, cPickle.HIGHEST_PROTOCOL)
+            cPickle.dump(memo, out, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            out.close()
+        os.rename(temp_path, memo_path)
+    except Exception, ex:
+        su.perr(u"Could not save file digests to %s: %s." % (
+            memo_path, unicode(ex)))
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def _group_by_digest(candidates, get_digest):
+    """Splits a list of (image, stat result) into the groups of at least two
+    with the same digest, keeping the order of the list."""
+    groups = {}
+    digests = []
+    for (image, file_stat) in candidates:
+        digest = get_digest(image.image_path, file_stat)
+        if digest is None:
+            continue
+        group = groups.get(digest)
+        if group is None:
+            group = []
+            groups[digest] = group
+            digests.append(digest)
+        group.append((image, file_stat))
+    return [groups[digest] for digest in digests if len(groups[digest]) > 1]
+
+
+class DuplicateIndex(object):
+    """Groups of images whose files have the same content.
+
+    The export uses it to skip or link duplicates, and counts what that
+    saved.
+    """
+
+    def __init__(self, groups, sizes):
+        self.groups = groups  # lists of images, in the order they were given
+        self.sizes = sizes  # file size of the images of each group
+        self._numbers = {}  # image id -> group number
+        for (number, group) in enumerate(groups):
+            for image in group:
+                self._numbers[image.id] = number
+        self._exports = {}  # group number -> path of an exported file
+        self.skipped = 0
+        self.linked = 0
+        self.saved_bytes = 0
+
+    def getgroup(self, image):
+        """Returns the group number of an image, or None if it has no
+        duplicates."""
+        return self._numbers.get(image.id)
+
+    def get_duplicate_count(self):
+        """Returns the number of images that duplicate another one."""
+        return sum([len(group) - 1 for group in self.groups])
+
+    def get_duplicate_bytes(self):
+        """Returns the size of the files of the images that duplicate another
+        one."""
+        return sum([(len(group) - 1) * size
+                    for (group, size) in zip(self.groups, self.sizes)])
+
+    def add_skipped(self, group):
+        """Counts an image of a group that was not exported."""
+        self.skipped += 1
+        self.saved_bytes += self.sizes[group]
+
+    def add_linked(self, group):
+        """Counts an exported file that is a link to a duplicate."""
+        self.linked += 1
+        self.saved_bytes += self.sizes[group]
+
+    def get_export(self, group):
+        """Returns the path of a file exported for an image of a group, or
+        None."""
+        return self._exports.get(group)
+
+    def set_export(self, group, path):
+        """Records the path of a file exported for an image of a group, if
+        there is none yet."""
+        self._exports.setdefault(group, path)
+
+
+def find_duplicates(images, memo=None, stat_cache=None):
+    """Finds the images whose files have the same content.
+
+    Args:
+      images: list of IPhotoImage.
+      memo: DigestMemo with digests of previous runs.
+      stat_cache: systemutils.StatCache for the sizes of the files.
+    Returns:
+      DuplicateIndex.
+    """
+    if memo is None:
+        memo = DigestMemo()
+    if stat_cache is None:
+        stat_cache = su.StatCache()
+    stat_cache.prefetch([image.image_path for image in images])
+    candidates_by_size = {}
+    for image in images:
+        file_stat = stat_cache.stat(image.image_path)
+        if not file_stat or not file_stat.st_size:
+            continue
+        candidates_by_size.setdefault(file_stat.st_size, []).append(
+            (image, file_stat))
+    groups = []
+    sizes = []
+    for size in sorted(candidates_by_size):
+        candidates = candidates_by_size[size]
+        if len(candidates) < 2:
+            continue
+        for group in _group_by_digest(candidates, memo.get_partial_digest):
+            if size > 2 * PARTIAL_SIZE:
+                matches = _group_by_digest(group, memo.get_digest)
+            else:
+                matches = [group]
+            for match in matches:
+                groups.append([image for (image, _) in match])
+                sizes.append(size)
+    return DuplicateIndex(groups, sizes)
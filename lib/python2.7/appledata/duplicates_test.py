@@ -0,0 +1,173 @@
+"""This module tests appledata/duplicates.py."""
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import appledata.duplicates as duplicates
+import tilutil.systemutils as su
+
+
+class _Image(object):
+    """Just enough of an IPhotoImage for duplicates.find_duplicates()."""
+
+    def __init__(self, image_id, image_path):
+        self.id = image_id
+        self.image_path = image_path
+
+
+class DuplicatesTest(unittest.TestCase):
+    """Unit tests for duplicates.py code."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.images = []
+        large = 3 * duplicates.PARTIAL_SIZE
+        for (name, content) in (
+            ('a.jpg', 'a' * large),
+            ('b.jpg', 'b' * 100),
+            ('a copy.jpg', 'a' * large),
+            # Same size, start and end as a.jpg, but not the same file.
+            ('a edit.jpg', 'a' * (large / 2) + 'x' + 'a' * (large / 2 - 1)),
+            ('b copy.jpg', 'b' * 100),
+            ('c.jpg', 'c' * 100),
+            ('empty.jpg', ''),
+            ('empty copy.jpg', '')):
+            path = os.path.join(self.folder, name)
+            out = open(path, 'wb')
+            out.write(content)
+            out.close()
+            self.images.append(_Image(name, path))
+        self.images.append(_Image('missing.jpg',
+                                  os.path.join(self.folder, 'missing.jpg')))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_find_duplicates(self):
+        """Tests duplicates.find_duplicates(), and the memo of digests."""
+        memo = duplicates.DigestMemo()
+        duplicate_index = duplicates.find_duplicates(self.images, memo,
+                                                     su.StatCache())
+        self.assertEquals([['b.jpg', 'b copy.jpg'], ['a.jpg', 'a copy.jpg']],
+                          [[image.id for image in group]
+                           for group in duplicate_index.groups])
+        self.assertEquals([100, 3 * duplicates.PARTIAL_SIZE],
+                          duplicate_index.sizes)
+        self.assertEquals(2, duplicate_index.get_duplicate_count())
+        self.assertEquals(100 + 3 * duplicates.PARTIAL_SIZE,
+                          duplicate_index.get_duplicate_bytes())
+        self.assertEquals(1, duplicate_index.getgroup(self.images[2]))
+        self.assertEquals(None, duplicate_index.getgroup(self.images[5]))
+        # Partial digests of the six files of the same size as another one,
+        # and full digests of the three large ones.
+        self.assertEquals(9, memo.reads)
+        self.assertEquals(0, memo.hits)
+        self.assertEquals(3 * 100 + 3 * 2 * duplicates.PARTIAL_SIZE +
+                          3 * 3 * duplicates.PARTIAL_SIZE, memo.read_bytes)
+
+        memo_path = duplicates.get_memo_path(self.folder)
+        duplicates.save_memo(memo_path, memo)
+        memo = duplicates.load_memo(memo_path)
+        self.assertEquals(6, len(memo))
+        duplicates.find_duplicates(self.images, memo)
+        self.assertEquals(0, memo.reads)
+        self.assertEquals(memo.lookups, memo.hits)
+        self.assertEquals(0, memo.read_bytes)
+
+        # Changed files are read again.
+        path = self.images[2].image_path
+        mtime = os.path.getmtime(path)
+        out = open(path, 'r+b')
+        out.seek(-1, 2)
+        out.write('z')
+        out.close()
+        os.utime(path, (mtime + 10, mtime + 10))
+        duplicate_index = duplicates.find_duplicates(self.images, memo)
+        self.assertEquals(1, memo.reads)
+        self.assertEquals([['b.jpg', 'b copy.jpg']],
+                          [[image.id for image in group]
+                           for group in duplicate_index.groups])
+
+    def test_shared_memo(self):
+        """Tests that a memo used for other files keeps the digests of
+        find_duplicates(), unless their files are gone or changed."""
+        memo_path = duplicates.get_memo_path(self.folder)
+        memo = duplicates.DigestMemo()
+        duplicates.find_duplicates(self.images, memo, su.StatCache())
+        duplicates.save_memo(memo_path, memo, su.StatCache())
+
+        # Like --content_digest, looks up the digest of one file only.
+        memo = duplicates.load_memo(memo_path)
+        path = os.path.join(self.folder, 'export.jpg')
+        out = open(path, 'wb')
+        out.write('export')
+        out.close()
+        memo.get_digest(path, os.stat(path))
+        self.assertEquals(1, memo.reads)
+        duplicates.save_memo(memo_path, memo, su.StatCache())
+        memo = duplicates.load_memo(memo_path)
+        self.assertEquals(7, len(memo))
+        duplicates.find_duplicates(self.images, memo, su.StatCache())
+        self.assertEquals(0, memo.reads)
+
+        # The digests of deleted and changed files are dropped.
+        memo = duplicates.load_memo(memo_path)
+        os.remove(self.images[3].image_path)
+        path = self.images[4].image_path
+        mtime = os.path.getmtime(path)
+        os.utime(path, (mtime + 10, mtime + 10))
+        duplicates.save_memo(memo_path, memo, su.StatCache())
+        self.assertEquals(5, len(duplicates.load_memo(memo_path)))
+
+    def test_duplicate_index(self):
+        """Tests the export bookkeeping of a DuplicateIndex."""
+        duplicate_index = duplicates.find_duplicates(self.images)
+        self.assertEquals(None, duplicate_index.get_export(0))
+        duplicate_index.set_export(0, '/export/b.jpg')
+        duplicate_index.set_export(0, '/export/b copy.jpg')
+        self.assertEquals('/export/b.jpg', duplicate_index.get_export(0))
+        duplicate_index.add_skipped(0)
+        duplicate_index.add_linked(1)
+        self.assertEquals(1, duplicate_index.skipped)
+        self.assertEquals(1, duplicate_index.linked)
+        self.assertEquals(100 + 3 * duplicates.PARTIAL_SIZE,
+                          duplicate_index.saved_bytes)
+
+    def test_load_memo(self):
+        """Tests loading a missing or broken memo."""
+        memo_path = os.path.join(self.folder, 'digests.memo')
+        self.assertEquals(0, len(duplicates.load_memo(memo_path)))
+        out = open(memo_path, 'wb')
+        out.write('broken')
+        out.close()
+        self.assertEquals(0, len(duplicates.load_memo(memo_path)))
+
+    def test_save_memo_errors(self):
+        """Tests that a memo that can't be pickled is not saved."""
+        memo_path = os.path.join(self.folder, 'digests.memo')
+        memo = duplicates.DigestMemo()
+        memo.__getstate__ = lambda: [threading.Lock()]
+        duplicates.save_memo(memo_path, memo)
+        self.assertFalse(os.path.exists(memo_path))
+        self.assertFalse(os.path.exists(memo_path + '.tmp'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,262 @@
+'''Spatial index over the GPS locations of images.
+
+A GpsIndex puts the located images of a list into a grid of latitude and
+longitude cells, so bounding box and radius queries only look at the images
+in the cells that overlap the query, instead of at every image.
+
+It also clusters nearby images into places (see GpsIndex.cluster()), which
+IPhotoData.getplacealbums() turns into albums that can be exported like face
+albums.
+'''
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import array
+import math
+
+# Size of the grid cells in degrees (about 5.5 km of latitude).
+DEFAULT_CELL_SIZE = 0.05
+
+# Mean radius of the earth.
+_EARTH_RADIUS_KM = 6371.0
+_KM_PER_DEGREE = _EARTH_RADIUS_KM * math.pi / 180.0
+
+_NAN = float('nan')
+
+
+def get_distance_km(latitude1, longitude1, latitude2, longitude2):
+    """Returns the great circle distance between two locations, in km."""
+    latitude1 = math.radians(latitude1)
+    latitude2 = math.radians(latitude2)
+    sin_latitude = math.sin((latitude2 - latitude1) / 2.0)
+    sin_longitude = math.sin(math.radians(longitude2 - longitude1) / 2.0)
+    a = (sin_latitude * sin_latitude + math.cos(latitude1) *
+         math.cos(latitude2) * sin_longitude * sin_longitude)
+    return 2.0 * _EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def _get_longitude_span(latitude, radius_km):
+    """Returns how many degrees of longitude radius_km spans at a latitude, or
+    None if it spans all longitudes (near the poles)."""
+    cos_latitude = math.cos(math.radians(min(abs(latitude), 90.0)))
+    if cos_latitude * 180.0 * _KM_PER_DEGREE <= radius_km:
+        return None
+    return radius_km / (_KM_PER_DEGREE * cos_latitude)
+
+
+class GpsIndex(object):
+    """Grid index over the images of a list that have a GPS location.
+
+    Queries return positions in the list of images the index was built from.
+    """
+
+    def __init__(self, images, cell_size=DEFAULT_CELL_SIZE):
+        self.images = images
+        self.cell_size = cell_size
+        # Coordinates by position, NaN for images without a location.
+        self._latitudes = array.array('d')
+        self._longitudes = array.array('d')
+        self._count = 0
+        self._cells = {}  # (row, column) -> positions
+        for (position, image) in enumerate(images):
+            gps = image.gps
+            if not gps:
+                self._latitudes.append(_NAN)
+                self._longitudes.append(_NAN)
+                continue
+            self._latitudes.append(gps.latitude)
+            self._longitudes.append(gps.longitude)
+            self._count += 1
+            cell = self._get_cell(gps.latitude, gps.longitude)
+            positions = self._cells.get(cell)
+            if positions is None:
+                positions = array.array('i')
+                self._cells[cell] = positions
+            positions.append(position)
+
+    def __len__(self):
+        """Returns the number of located images."""
+        return self._count
+
+    def _get_cell(self, latitude, longitude):
+        return (int(math.floor(latitude / self.cell_size)),
+                int(math.floor(longitude / self.cell_size)))
+
+    def _get_box_positions(self, min_latitude, min_longitude, max_latitude,
+                           max_longitude):
+        """Returns the positions of the images in a box that does not cross
+        the date line, in no particular order."""
+        (min_row, min_column) = self._get_cell(min_latitude, min_longitude)
+        (max_row, max_column) = self._get_cell(max_latitude, max_longitude)
+        cells = self._cells
+        if (max_row - min_row + 1) * (max_column - min_column + 1) > len(cells):
+            # A big box: cheaper to check the cells that have images.
+            keys = [cell for cell in cells
+                    if min_row <= cell[0] <= max_row and
+                    min_column <= cell[1] <= max_column]
+        else:
+            keys = [(row, column) for row in xrange(min_row, max_row + 1)
+                    for column in xrange(min_column, max_column + 1)
+                    if (row, column) in cells]
+        latitudes = self._latitudes
+        longitudes = self._longitudes
+        result = []
+        for cell in keys:
+            (row, column) = cell
+            if (min_row < row < max_row and min_column < column < max_column):
+                # Inner cells are entirely in the box.
+                result.extend(cells[cell])
+                continue
+            for position in cells[cell]:
+                if (min_latitude <= latitudes[position] <= max_latitude and
+                    min_longitude <= longitudes[position] <= max_longitude):
+                    result.append(position)
+        return result
+
+    def query_box(self, min_latitude, min_longitude, max_latitude,
+                  max_longitude):
+        """Returns the sorted positions of the images in a bounding box. If
+        min_longitude is greater than max_longitude, the box crosses the date
+        line."""
+        if min_longitude <= max_longitude:
+            result = self._get_box_positions(min_latitude, min_longitude,
+                                             max_latitude, max_longitude)
+        else:
+            result = (self._get_box_positions(min_latitude, min_longitude,
+                                              max_latitude, 180.0) +
+                      self._get_box_positions(min_latitude, -180.0,
+                                              max_latitude, max_longitude))
+        result.sort()
+        return result
+
+    def query_radius(self, latitude, longitude, radius_km):
+        """Returns the sorted positions of the images within radius_km of a
+        location."""
+        latitude_span = radius_km / _KM_PER_DEGREE
+        min_latitude = max(-90.0, latitude - latitude_span)
+        max_latitude = min(90.0, latitude + latitude_span)
+        longitude_span = _get_longitude_span(
+            max(abs(min_latitude), abs(max_latitude)), radius_km)
+        if longitude_span is None:
+            candidates = self.query_box(min_latitude, -180.0, max_latitude,
+                                        180.0)
+        else:
+            min_longitude = longitude - longitude_span
+            max_longitude = longitude + longitude_span
+            if min_longitude < -180.0:
+                min_longitude += 360.0
+            if max_longitude > 180.0:
+                max_longitude -= 360.0
+            candidates = self.query_box(min_latitude, min_longitude,
+                                        max_latitude, max_longitude)
+        latitudes = self._latitudes
+        longitudes = self._longitudes
+        return [position for position in candidates
+                if get_distance_km(latitude, longitude, latitudes[position],
+                                   longitudes[position]) <= radius_km]
+
+    def get_images(self, positions):
+        """Returns the images for a list of positions."""
+        return [self.images[position] for position in positions]
+
+    def cluster(self, radius_km, min_images=1):
+        """Groups the located images into places.
+
+        The images are put into cells about radius_km wide, and the cells
+        that have images and touch each other form a place. Images that are
+        less than radius_km apart are always in the same place; images in a
+        place can be further apart if the place is a chain of cells.
+
+        Returns the places with at least min_images images, as lists of
+        positions, largest first.
+        """
+        step = max(radius_km / _KM_PER_DEGREE, 1e-6)
+        cells = {}  # (row, column) -> positions
+        row_steps = {}  # row -> longitude step
+        for (position, latitude) in enumerate(self._latitudes):
+            if latitude != latitude:
+                continue
+            row = int(math.floor(latitude / step))
+            row_step = row_steps.get(row)
+            if row_step is None:
+                row_step = self._get_row_step(row, step)
+                row_steps[row] = row_step
+            cell = (row, int(math.floor(
+                (self._longitudes[position] + 180.0) / row_step)))
+            positions = cells.get(cell)
+            if positions is None:
+                positions = []
+                cells[cell] = positions
+            positions.append(position)
+
+        # Union-find over the cells.
+        parents = dict([(cell, cell) for cell in cells])
+
+        def find(cell):
+            root = cell
+            while parents[root] != root:
+                root = parents[root]
+            while parents[cell] != root:
+                (parents[cell], cell) = (root, parents[cell])
+            return root
+
+        for cell in cells:
+            (row, column) = cell
+            row_step = row_steps[row]
+            for other_row in (row - 1, row, row + 1):
+                other_step = row_steps.get(other_row)
+                if other_step is None:
+                    continue
+                first = int(math.floor(column * row_step / other_step)) - 1
+                last = int(math.floor((column + 1) * row_step / other_step)) + 1
+                columns = int(math.ceil(360.0 / other_step))
+                for other_column in xrange(first, last + 1):
+                    other = (other_row, other_column % columns)
+                    if other in cells:
+                        root = find(cell)
+                        other_root = find(other)
+                        if root != other_root:
+                            parents[other_root] = root
+
+        places = {}
+        for (cell, positions) in cells.iteritems():
+            places.setdefault(find(cell), []).extend(positions)
+        result = [sorted(positions) for positions in places.values()
+                  if len(positions) >= min_images]
+        result.sort(key=lambda positions: (-len(positions), positions[0]))
+        return result
+
+    @staticmethod
+    def _get_row_step(row, step):
+        """Returns the longitude step of a row of clustering cells, so the
+        cells are at least as wide as they are high, even at the latitude of
+        the row that is closest to a pole."""
+        latitude = max(abs(row * step), abs((row + 1) * step))
+        cos_latitude = math.cos(math.radians(min(latitude, 90.0)))
+        # One cell per row near the poles.
+        return min(360.0, step / max(cos_latitude, step / 360.0))
+
+    def get_center(self, positions):
+        """Returns the mean (latitude, longitude) of images. Longitudes are
+        averaged relative to the first image, so places on the date line have
+        their center there too."""
+        latitudes = self._latitudes
+        longitudes = self._longitudes
+        first = longitudes[positions[0]]
+        latitude = sum([latitudes[p] for p in positions]) / len(positions)
+        longitude = first + sum(
+            [(longitudes[p] - first + 180.0) % 360.0 - 180.0
+             for p in positions]) / len(positions)
+        return (latitude, (longitude + 180.0) % 360.0 - 180.0)
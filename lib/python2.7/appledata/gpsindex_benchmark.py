@@ -0,0 +1,127 @@
+"""Measures the GPS index on synthetic geotagged images.
+
+Compares bounding box and radius queries of a GpsIndex with a scan of all
+images, and times building the index and clustering the images into places.
+The images are spread over a few hundred "cities", like the photos of a
+travelling photographer.
+
+Usage: python -m appledata.gpsindex_benchmark [--images N] [--queries N]
+"""
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import random
+import sys
+import time
+
+from optparse import OptionParser
+
+import appledata.gpsindex as gpsindex
+import tilutil.imageutils as imageutils
+
+
+class _Image(object):
+    """Just enough of an IPhotoImage for a GpsIndex."""
+    __slots__ = ('gps',)
+
+    def __init__(self, gps):
+        self.gps = gps
+
+
+def make_images(count, cities, seed=0):
+    """Returns count geotagged images around a number of cities."""
+    rand = random.Random(seed)
+    centers = [(rand.uniform(-60.0, 70.0), rand.uniform(-180.0, 180.0))
+               for _ in xrange(cities)]
+    images = []
+    for _ in xrange(count):
+        (latitude, longitude) = rand.choice(centers)
+        images.append(_Image(imageutils.GpsLocation(
+            latitude + rand.gauss(0.0, 0.05),
+            (longitude + rand.gauss(0.0, 0.05) + 180.0) % 360.0 - 180.0)))
+    return (images, centers)
+
+
+def _time(function, *args):
+    """Returns the result of function, and the seconds it took."""
+    start = time.time()
+    result = function(*args)
+    return (result, time.time() - start)
+
+
+def _scan_box(images, box):
+    (min_latitude, min_longitude, max_latitude, max_longitude) = box
+    return [position for (position, image) in enumerate(images)
+            if min_latitude <= image.gps.latitude <= max_latitude and
+            min_longitude <= image.gps.longitude <= max_longitude]
+
+
+def _scan_radius(images, center):
+    (latitude, longitude, radius_km) = center
+    return [position for (position, image) in enumerate(images)
+            if gpsindex.get_distance_km(latitude, longitude, image.gps.latitude,
+                                        image.gps.longitude) <= radius_km]
+
+
+def main(args):
+    parser = OptionParser()
+    parser.add_option('--images', type='int', default=500000,
+                      help='Number of geotagged images.')
+    parser.add_option('--cities', type='int', default=300,
+                      help='Number of areas the images are taken in.')
+    parser.add_option('--queries', type='int', default=20,
+                      help='Number of queries of each kind.')
+    parser.add_option('--radius', type='float', default=2.0,
+                      help='Radius (km) of the radius queries and places.')
+    (options, _) = parser.parse_args(args)
+
+    (images, centers) = make_images(options.images, options.cities)
+    print '%d geotagged images around %d cities' % (len(images), len(centers))
+    (index, elapsed) = _time(gpsindex.GpsIndex, images)
+    print 'Build index: %8.3f s' % (elapsed)
+
+    rand = random.Random(1)
+    boxes = []
+    circles = []
+    for _ in xrange(options.queries):
+        (latitude, longitude) = rand.choice(centers)
+        boxes.append((latitude - 0.02, longitude - 0.02, latitude + 0.02,
+                      longitude + 0.02))
+        circles.append((latitude, longitude, options.radius))
+    # Scans are slow; time a few of them only.
+    scans = max(1, options.queries / 10)
+    for (name, queries, query, scan) in (
+        ('Box', boxes, index.query_box, _scan_box),
+        ('Radius', circles, index.query_radius, _scan_radius)):
+        start = time.time()
+        found = 0
+        for arguments in queries:
+            found += len(query(*arguments))
+        index_time = (time.time() - start) / len(queries)
+        start = time.time()
+        for arguments in queries[:scans]:
+            scan(images, arguments)
+        scan_time = (time.time() - start) / scans
+        print '%-6s query: %10.6f s (scan: %8.3f s, %6.0fx), %d images/query' % (
+            name, index_time, scan_time, scan_time / max(index_time, 1e-9),
+            found / len(queries))
+
+    (places, elapsed) = _time(index.cluster, options.radius)
+    print 'Cluster: %8.3f s, %d places (%d with 100+ images)' % (
+        elapsed, len(places), len([p for p in places if len(p) >= 100]))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,120 @@
+"""This module tests appledata/gpsindex.py."""
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import random
+import unittest
+
+import appledata.gpsindex as gpsindex
+import tilutil.imageutils as imageutils
+
+
+class _Image(object):
+    """Just enough of an IPhotoImage for a GpsIndex."""
+
+    def __init__(self, latitude=None, longitude=None):
+        if latitude is None:
+            self.gps = None
+        else:
+            self.gps = imageutils.GpsLocation(latitude, longitude)
+
+
+class GpsIndexTest(unittest.TestCase):
+    """Unit tests for gpsindex.py code."""
+
+    def setUp(self):
+        rand = random.Random(1)
+        self.images = [_Image()]
+        for _ in xrange(2000):
+            self.images.append(_Image(rand.uniform(-90.0, 90.0),
+                                      rand.uniform(-180.0, 180.0)))
+        for _ in xrange(500):
+            # A dense area around San Francisco, and one on the date line.
+            self.images.append(_Image(37.7 + rand.random() * 0.2,
+                                      -122.5 + rand.random() * 0.2))
+            longitude = 179.9 + rand.random() * 0.2
+            if longitude > 180.0:
+                longitude -= 360.0
+            self.images.append(_Image(-17.0 + rand.random() * 0.2, longitude))
+            self.images.append(_Image())
+        self.index = gpsindex.GpsIndex(self.images)
+
+    def _scan(self, matches):
+        return [position for (position, image) in enumerate(self.images)
+                if image.gps and matches(image.gps)]
+
+    def test_query_box(self):
+        """Tests GpsIndex.query_box() against a scan of all images."""
+        self.assertEquals(3000, len(self.index))
+        for box in ((37.75, -122.45, 37.8, -122.4), (-60.0, -100.0, 70.0, 50.0),
+                    (-90.0, -180.0, 90.0, 180.0), (10.0, 10.0, 10.0, 10.0)):
+            (min_latitude, min_longitude, max_latitude, max_longitude) = box
+            self.assertEquals(
+                self._scan(lambda gps: (
+                    min_latitude <= gps.latitude <= max_latitude and
+                    min_longitude <= gps.longitude <= max_longitude)),
+                self.index.query_box(*box))
+        # Across the date line.
+        self.assertEquals(
+            self._scan(lambda gps: (-17.1 <= gps.latitude <= -16.9 and
+                                    (gps.longitude >= 179.95 or
+                                     gps.longitude <= -179.95))),
+            self.index.query_box(-17.1, 179.95, -16.9, -179.95))
+
+    def test_query_radius(self):
+        """Tests GpsIndex.query_radius() against a scan of all images."""
+        for (latitude, longitude, radius_km) in (
+            (37.8, -122.4, 5.0), (-17.0, 180.0, 10.0), (0.0, 0.0, 3000.0),
+            (89.9, 0.0, 500.0), (-45.0, 90.0, 0.0)):
+            self.assertEquals(
+                self._scan(lambda gps: gpsindex.get_distance_km(
+                    latitude, longitude, gps.latitude, gps.longitude) <=
+                           radius_km),
+                self.index.query_radius(latitude, longitude, radius_km))
+
+    def test_get_distance_km(self):
+        """Tests gpsindex.get_distance_km()."""
+        self.assertAlmostEquals(111.19, gpsindex.get_distance_km(0, 0, 1, 0), 2)
+        self.assertAlmostEquals(111.19, gpsindex.get_distance_km(0, 179.5, 0,
+                                                                 -179.5), 2)
+        self.assertEquals(0.0, gpsindex.get_distance_km(45, 45, 45, 45))
+
+    def test_cluster(self):
+        """Tests that GpsIndex.cluster() puts close images into one place."""
+        places = self.index.cluster(5.0, min_images=100)
+        self.assertEquals(2, len(places))
+        self.assertEquals(500, len(places[0]))
+        self.assertEquals(500, len(places[1]))
+        (latitude, longitude) = self.index.get_center(places[0])
+        self.assertTrue(37.7 <= latitude <= 37.9)
+        self.assertTrue(-122.5 <= longitude <= -122.3)
+        (latitude, longitude) = self.index.get_center(places[1])
+        self.assertTrue(abs(longitude) > 179.8)
+
+        all_places = self.index.cluster(500.0)
+        self.assertEquals(3000, sum([len(place) for place in all_places]))
+        place_of = {}
+        for (number, place) in enumerate(all_places):
+            for position in place:
+                place_of[position] = number
+        for position in place_of:
+            gps = self.images[position].gps
+            for other in self.index.query_radius(gps.latitude, gps.longitude,
+                                                 500.0):
+                self.assertEquals(place_of[position], place_of[other])
+
+
+if __name__ == '__main__':
+    unittest.main()
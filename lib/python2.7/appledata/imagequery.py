@@ -0,0 +1,295 @@
+'''Indexed queries over the images of an iPhoto or Aperture library.
+
+An ImageIndex numbers the images of a library in date order, and keeps
+precomputed indexes:
+
+  - the sorted time stamps of the images, so a date range is a range of
+    image numbers,
+  - inverted lists ("postings") of image numbers per keyword, face, rating,
+    and media type,
+  - a GpsIndex over the image locations.
+
+A query is answered by intersecting the postings of its criteria, starting
+with the shortest one, instead of testing every image of the library.
+
+Queries can also be written as text (see parse_query()), for example
+
+  after:2010-06-01 before:2010-09-01 keyword:Beach face:"Jane Doe" rating:4
+'''
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import array
+import bisect
+import datetime
+import shlex
+
+import appledata.applexml as applexml
+import appledata.gpsindex as gpsindex
+
+# Media types for the media_type criterion.
+MOVIE = 'movie'
+PHOTO = 'photo'
+
+# Date formats accepted by parse_query().
+_DATE_FORMATS = ('%Y-%m-%d', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S')
+
+
+class ImageIndex(object):
+    """Precomputed indexes over a list of images.
+
+    The index is a snapshot: images that are added to the library, or
+    keywords and faces that are added to images, after the index is built are
+    not seen by queries.
+    """
+
+    def __init__(self, images, time_table):
+        self.images = [images[position]
+                       for position in time_table.sort(
+                           [image.date_index for image in images])]
+        self._positions = {}  # image id -> number
+        self._timestamps = array.array('d')
+        self._dated_count = 0
+        self._keywords = {}
+        self._faces = {}
+        self._ratings = {}
+        self._media_types = {}
+
+        for (position, image) in enumerate(self.images):
+            self._positions[image.id] = position
+            timestamp = time_table.gettimestamp(image.date_index)
+            self._timestamps.append(timestamp)
+            if timestamp == timestamp:
+                self._dated_count = position + 1
+            for keyword in image.keywords:
+                _add_posting(self._keywords, keyword, position)
+            for face in image.getfaces():
+                _add_posting(self._faces, face, position)
+            if image.rating is not None:
+                _add_posting(self._ratings, image.rating, position)
+            _add_posting(self._media_types,
+                         MOVIE if image.ismovie() else PHOTO, position)
+        # Numbers the images like this index.
+        self.gps_index = gpsindex.GpsIndex(self.images)
+
+    def __len__(self):
+        return len(self.images)
+
+    def getposition(self, image):
+        """Returns the number of an image in the index, or None."""
+        return self._positions.get(image.id)
+
+    def _get_date_range(self, start, end):
+        """Returns the range of image numbers with a date in [start, end)."""
+        low = 0
+        high = self._dated_count
+        if start is not None:
+            low = bisect.bisect_left(self._timestamps,
+                                     applexml._get_posix_time(start), 0, high)
+        if end is not None:
+            high = bisect.bisect_left(self._timestamps,
+                                      applexml._get_posix_time(end), low, high)
+        return (low, high)
+
+    def _get_rating_postings(self, min_rating, max_rating):
+        """Returns the sorted image numbers with a rating in
+        [min_rating, max_rating]."""
+        buckets = [postings for (rating, postings) in self._ratings.items()
+                   if (min_rating is None or rating >= min_rating) and
+                   (max_rating is None or rating <= max_rating)]
+        if len(buckets) == 1:
+            return buckets[0]
+        merged = []
+        for postings in buckets:
+            merged.extend(postings)
+        merged.sort()
+        return merged
+
+    def _get_container_postings(self, container):
+        """Returns the sorted image numbers of the images in a container."""
+        positions = self._positions
+        return sorted([positions[image.id] for image in container.images
+                       if image.id in positions])
+
+    def query(self, start=None, end=None, min_rating=None, max_rating=None,
+              keywords=(), faces=(), media_type=None, gps_box=None, near=None,
+              containers=()):
+        """Returns the images that match all criteria, ordered by date.
+
+        Args:
+            start, end: datetime range [start, end) of the image dates.
+            min_rating, max_rating: inclusive range of the image ratings.
+            keywords: keywords that the images must all have.
+            faces: faces that the images must all have.
+            media_type: MOVIE or PHOTO.
+            gps_box: (min_latitude, min_longitude, max_latitude,
+                max_longitude) box that the image locations must be in.
+            near: (latitude, longitude, radius_km) circle that the image
+                locations must be in.
+            containers: albums, events or faces that must all contain the
+                images.
+        """
+        (low, high) = (0, len(self.images))
+        if start is not None or end is not None:
+            (low, high) = self._get_date_range(start, end)
+        postings = []
+        for keyword in keywords:
+            postings.append(self._keywords.get(keyword, ()))
+        for face in faces:
+            postings.append(self._faces.get(face, ()))
+        if min_rating is not None or max_rating is not None:
+            postings.append(self._get_rating_postings(min_rating, max_rating))
+        if media_type is not None:
+            postings.append(self._media_types.get(media_type, ()))
+        if gps_box is not None:
+            postings.append(self.gps_index.query_box(*gps_box))
+        if near is not None:
+            postings.append(self.gps_index.query_radius(*near))
+        for container in containers:
+            postings.append(self._get_container_postings(container))
+
+        if postings:
+            positions = _intersect(postings, low, high)
+        else:
+            positions = xrange(low, high)
+        return [self.images[position] for position in positions]
+
+
+def _add_posting(index, key, position):
+    """Appends an image number to the postings of key. Images are added in
+    order, so a repeated keyword or face is the last number."""
+    postings = index.get(key)
+    if postings is None:
+        postings = array.array('i')
+        index[key] = postings
+    elif postings[-1] == position:
+        return
+    postings.append(position)
+
+
+def _intersect(postings, low, high):
+    """Returns the sorted numbers in [low, high) that are in all postings.
+
+    Walks the shortest postings, and looks up its numbers in the others with a
+    binary search, so the cost depends on the shortest list only (times the
+    log of the longer ones)."""
+    postings = sorted(postings, key=len)
+    shortest = postings[0]
+    first = bisect.bisect_left(shortest, low)
+    last = bisect.bisect_left(shortest, high, first)
+    result = []
+    for position in shortest[first:last]:
+        for other in postings[1:]:
+            i = bisect.bisect_left(other, position)
+            if i == len(other) or other[i] != position:
+                break
+        else:
+            result.append(position)
+    return result
+
+
+def _parse_date(value):
+    """Parses a date of a query."""
+    for date_format in _DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, date_format)
+        except ValueError:
+            pass
+    raise ValueError('Invalid date "%s", use YYYY-MM-DD.' % (value))
+
+
+def _parse_rating(value):
+    """Parses a rating ("4") or rating range ("2-4") of a query."""
+    try:
+        if '-' in value:
+            (min_rating, max_rating) = value.split('-', 1)
+            return (int(min_rating), int(max_rating))
+        return (int(value), None)
+    except ValueError:
+        raise ValueError('Invalid rating "%s".' % (value))
+
+
+def _parse_numbers(value, count, usage):
+    """Parses a comma separated list of count numbers of a query."""
+    try:
+        numbers = [float(number) for number in value.split(',')]
+    except ValueError:
+        numbers = []
+    if len(numbers) != count:
+        raise ValueError('Invalid value "%s", use %s.' % (value, usage))
+    return numbers
+
+
+def _parse_gps_box(value):
+    """Parses a "lat1,lon1,lat2,lon2" box of a query."""
+    coordinates = _parse_numbers(value, 4, 'lat1,lon1,lat2,lon2')
+    return (min(coordinates[0], coordinates[2]),
+            min(coordinates[1], coordinates[3]),
+            max(coordinates[0], coordinates[2]),
+            max(coordinates[1], coordinates[3]))
+
+
+def parse_query(text):
+    """Parses a query written as text into a dictionary of criteria.
+
+    The query is a list of field:value terms; values with spaces must be
+    quoted. The fields are:
+
+      after:DATE       images taken on or after DATE (YYYY-MM-DD)
+      before:DATE      images taken before DATE
+      rating:N         images rated N or higher (rating:N-M for a range)
+      keyword:NAME     images with keyword NAME
+      face:NAME        images with face NAME
+      type:TYPE        "photo" or "movie"
+      gps:LAT,LON,LAT,LON  images located in this box
+      near:LAT,LON,KM  images located within KM km of LAT,LON
+      album:NAME       images in album NAME
+      event:NAME       images in event NAME
+
+    keyword, face, album and event can be repeated; images must match all of
+    them. album and event names are returned as the "albums" and "events"
+    criteria, and must be resolved into containers for ImageIndex.query()
+    (see IPhotoData.run_query()). Raises ValueError for invalid queries.
+    """
+    criteria = {}
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    for term in shlex.split(text):
+        if ':' not in term:
+            raise ValueError('Invalid query term "%s", use field:value.' % (
+                term))
+        (field, value) = term.split(':', 1)
+        value = value.decode('utf-8')
+        if field == 'after':
+            criteria['start'] = _parse_date(value)
+        elif field == 'before':
+            criteria['end'] = _parse_date(value)
+        elif field == 'rating':
+            (criteria['min_rating'], criteria['max_rating']) = _parse_rating(
+                value)
+        elif field == 'type':
+            if value not in (MOVIE, PHOTO):
+                raise ValueError('Invalid type "%s", use %s or %s.' % (
+                    value, PHOTO, MOVIE))
+            criteria['media_type'] = value
+        elif field == 'gps':
+            criteria['gps_box'] = _parse_gps_box(value)
+        elif field == 'near':
+            criteria['near'] = tuple(_parse_numbers(value, 3, 'lat,lon,km'))
+        elif field in ('keyword', 'face', 'album', 'event'):
+            criteria.setdefault(field + 's', []).append(value)
+        else:
+            raise ValueError('Unknown query field "%s".' % (field))
+    return criteria
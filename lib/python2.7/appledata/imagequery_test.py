@@ -0,0 +1,116 @@
+"""This module tests appledata/imagequery.py."""
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+import appledata.gpsindex as gpsindex
+import appledata.imagequery as imagequery
+import appledata.iphotodata as iphotodata
+import appledata.librarygen as librarygen
+
+
+class ImageQueryTest(unittest.TestCase):
+    """Unit tests for imagequery.py code."""
+
+    def setUp(self):
+        folder = tempfile.mkdtemp()
+        try:
+            xml_file = os.path.join(folder, 'AlbumData.xml')
+            out = open(xml_file, 'w')
+            librarygen.write_library(out, librarygen.LibrarySpec(
+                images=600, albums=4, faces=5, keywords=6))
+            out.close()
+            self.data = iphotodata.get_iphoto_data(xml_file)
+        finally:
+            shutil.rmtree(folder)
+
+    def _check_query(self, matches, **criteria):
+        """Checks a query against a scan of all images."""
+        expected = self.data.sort_images_by_date(
+            [image for image in self.data.images if matches(image)])
+        result = self.data.query(**criteria)
+        self.assertEquals([image.id for image in expected],
+                          [image.id for image in result])
+        return result
+
+    def test_query(self):
+        """Tests ImageIndex.query() against a scan of all images."""
+        start = datetime.datetime(2010, 7, 1)
+        end = datetime.datetime(2010, 7, 2)
+        album = [album for album in self.data.albums.values()
+                 if album.name == 'Album 1'][0]
+        self.assertTrue(self._check_query(
+            lambda image: start <= image.date < end, start=start, end=end))
+        self.assertTrue(self._check_query(
+            lambda image: 'Keyword 2' in image.keywords and image.rating >= 3,
+            keywords=['Keyword 2'], min_rating=3))
+        self._check_query(
+            lambda image: ('Keyword 1' in image.keywords and
+                           'Keyword 3' in image.keywords and
+                           'Person 0' in image.getfaces()),
+            keywords=['Keyword 1', 'Keyword 3'], faces=['Person 0'])
+        self.assertTrue(self._check_query(
+            lambda image: image.ismovie() and image.date >= start,
+            media_type=imagequery.MOVIE, start=start))
+        self.assertTrue(self._check_query(
+            lambda image: (image.gps and image.gps.latitude <= 37.5 and
+                           image in album.images and 2 <= image.rating <= 4),
+            gps_box=(37.0, -123.0, 37.5, -122.0), containers=[album],
+            min_rating=2, max_rating=4))
+        self.assertTrue(self._check_query(
+            lambda image: (image.gps and gpsindex.get_distance_km(
+                37.5, -122.5, image.gps.latitude, image.gps.longitude) <= 20.0),
+            near=(37.5, -122.5, 20.0)))
+        self.assertEquals([], self.data.query(keywords=['No such keyword']))
+        self.assertEquals(len(self.data.images), len(self.data.query()))
+
+    def test_run_query(self):
+        """Tests IPhotoData.run_query()."""
+        images = self.data.run_query(
+            'after:2010-07-01 keyword:"Keyword 2" event:"Event 1" type:photo')
+        self.assertTrue(images)
+        for image in images:
+            self.assertTrue(image.date >= datetime.datetime(2010, 7, 1))
+            self.assertTrue('Keyword 2' in image.keywords)
+            self.assertEquals('Event 1', self.data.getroll(image.roll).name)
+            self.assertFalse(image.ismovie())
+        self.assertRaises(ValueError, self.data.run_query, 'album:"No album"')
+
+    def test_parse_query(self):
+        """Tests imagequery.parse_query()."""
+        self.assertEquals(
+            {'start': datetime.datetime(2010, 6, 1),
+             'min_rating': 2, 'max_rating': 4,
+             'faces': [u'Jane Doe'], 'keywords': [u'Beach', u'Sun'],
+             'gps_box': (37.0, -123.0, 38.0, -122.0)},
+            imagequery.parse_query(u'after:2010-06-01 rating:2-4 '
+                                   u'face:"Jane Doe" keyword:Beach keyword:Sun '
+                                   u'gps:38,-122,37,-123'))
+        self.assertEquals({'min_rating': 4, 'max_rating': None},
+                          imagequery.parse_query('rating:4'))
+        self.assertEquals({'near': (37.5, -122.0, 2.5)},
+                          imagequery.parse_query('near:37.5,-122,2.5'))
+        for text in ('after:June', 'rating:high', 'type:song', 'gps:1,2,3',
+                     'near:1,2', 'color:red', 'Beach'):
+            self.assertRaises(ValueError, imagequery.parse_query, text)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -21,6 +21,10 @@ SpecialRoll -  "Last Import"
 Event - this type does not exist in the XML file, but we use it in this code
         to allow us to treat events just like any other album
 Face - Face album (does not exist in iPhoto, only in this code).
+Place - images taken close to each other (does not exist in iPhoto, only in
+        this code).
+Query - images selected by a query (does not exist in iPhoto, only in this
+        code).
 None - should not really happen
 '''
 
@@ -39,18 +43,30 @@ None - should not really happen
 #   limitations under the License.
 
 
+import array
 import datetime
 import os
 import re
 import sys
+import threading
 
 import appledata.applexml as applexml
+import appledata.imagequery as imagequery
 import tilutil.imageutils as imageutils
 import tilutil.systemutils as su
 
+from multiprocessing.pool import ThreadPool
+
 # List of extensions for image formats that are considered JPEG.
 _JPG_EXTENSIONS = ('jpg', 'jpeg')
 
+# Kinds of keys of an ImageLookupIndex.
+KEY_IMAGE_PATH = 0
+KEY_THUMB_PATH = 1
+KEY_ORIGINAL_PATH = 2
+KEY_FILE_NAME = 3
+KEY_BASE_NAME = 4
+
 
 # Convert Aperture numeric album types to iPhoto album type names.
 _APERTURE_ALBUM_TYPES = {
@@ -103,6 +119,105 @@ def _get_aperture_master_path(preview_path):
     return folder.replace('/Previews/', '/Masters/', 1)
 
 
+def _list_folder_trees(folders, stat_cache, threads):
+    """Lists the folder trees under folders, one level at a time: the folders
+    of a level are listed on a pool of threads, and their entries are stat'ed
+    with stat_cache.prefetch(), so finding the folders of the next level does
+    not wait for the disk.
+
+    Returns: folder -> names in the folder, for all folders that exist.
+    """
+    listings = {}
+    level = [folder for folder in folders if stat_cache.isdir(folder)]
+    pool = None
+    try:
+        while level:
+            if threads > 1 and len(level) > 1:
+                if pool is None:
+                    pool = ThreadPool(threads)
+                results = pool.map(su.os_listdir_unicode, level)
+            else:
+                results = map(su.os_listdir_unicode, level)
+            paths = []
+            for (folder, names) in zip(level, results):
+                listings[folder] = names
+                paths.extend([os.path.join(folder, name) for name in names])
+            stat_cache.prefetch(paths, threads)
+            level = [path for path in paths if stat_cache.isdir(path)]
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    return listings
+
+
+def _add_master_files(folder, listings, prefixes):
+    """Adds the files of a folder tree to a prefix index (see
+    ApertureMastersIndex). listings has the names in the folders of the tree
+    (see _list_folder_trees()). Files are visited in the order the old
+    recursive search visited them, so the first file for a prefix is the one
+    that search found."""
+    for name in listings[folder]:
+        path = os.path.join(folder, name)
+        if path in listings:
+            _add_master_files(path, listings, prefixes)
+            continue
+        position = name.find('.')
+        while position != -1:
+            prefixes.setdefault(name[:position], path)
+            position = name.find('.', position + 1)
+
+
+class ApertureMastersIndex(object):
+    """Index of the master files in the Masters folders of an Aperture
+    library.
+
+    Each folder is walked once, in parallel, through the shared stat cache,
+    and its files are indexed by every prefix of their name that ends before
+    a ".", so finding the master of an image is a lookup instead of a search
+    through the folder.
+    """
+
+    def __init__(self, master_paths, threads=su.DEFAULT_PREFETCH_THREADS,
+                 stat_cache=None):
+        if stat_cache is None:
+            stat_cache = su.get_stat_cache()
+        master_paths = sorted(set(master_paths))
+        listings = _list_folder_trees(master_paths, stat_cache, threads)
+        # master path -> (lower case name -> name, prefix -> path), or None if
+        # missing
+        self._folders = {}
+        for master_path in master_paths:
+            names = listings.get(master_path)
+            if names is None:
+                self._folders[master_path] = None
+                continue
+            prefixes = {}
+            _add_master_files(master_path, listings, prefixes)
+            lower_names = {}
+            for name in names:
+                lower_names.setdefault(name.lower(), name)
+            self._folders[master_path] = (lower_names, prefixes)
+
+    def has_folder(self, master_path):
+        """Tests if a Masters folder was indexed and exists."""
+        return self._folders.get(master_path) is not None
+
+    def find(self, master_path, basename):
+        """Returns the master file for an image base name in a Masters
+        folder: basename.jpg if it is in the folder itself (in any case, like
+        on HFS+), or else the first file in the folder tree whose name starts
+        with "basename.". Returns None if there is no such file."""
+        folder = self._folders.get(master_path)
+        if folder is None:
+            return None
+        (names, prefixes) = folder
+        name = names.get((basename + u'.jpg').lower())
+        if name is not None:
+            return os.path.join(master_path, name)
+        return prefixes.get(basename)
+
+
 class IPhotoData(object):
     """top level iPhoto data node."""
 
@@ -115,6 +230,7 @@ class IPhotoData(object):
 
         self.albums = {}
         self.face_albums = None
+        self.place_albums = {}  # (radius_km, min_images) -> place albums
 
         # Master map of keywords
         self.keywords = self.data2.get("List of Keywords")
@@ -129,59 +245,104 @@ class IPhotoData(object):
                 # Other keys in face_entry: image, key image face index,
                 # PhotoCount, Order
 
+        # Dates of all images and containers.
+        self.time_table = applexml.AppleTimeTable()
+        # Keywords and faces of all images.
+        self.name_table = NameTable()
+
         self.images_by_id = {}
+        # Images of every face. Built with the images, unless they are lazy.
+        self.face_index = None
         image_data = self.data.get("Master Image List")
-        if image_data:
+        if isinstance(image_data, applexml.LazyPlistDict):
+            # Image entries are parsed when an image is first used.
+            for key in image_data.keys():
+                self.images_by_id[key] = LazyIPhotoImage(
+                    key, image_data, self.keywords, self.face_names, aperture_data,
+                    self.time_table, self.name_table)
+        elif image_data:
+            self.face_index = FaceIndex(self.name_table)
             for key in image_data:
                 image = IPhotoImage(key, image_data.get(key), self.keywords,
-                                    self.face_names, aperture_data)
+                                    self.face_names, aperture_data,
+                                    self.time_table, self.name_table)
                 self.images_by_id[key] = image
+                self.face_index.add_image(image)
+            # The images keep what they need; drop the raw entries.
+            self.data = dict([(name, value) for (name, value) in self.data.items()
+                              if name != "Master Image List"])
+            if not xml_data2:
+                self.data2 = self.data
 
         album_data = self.data2.get("List of Albums")
 
         self.root_album = IPhotoContainer("", "Root", None, None, None)
         for data in album_data:
             album = IPhotoAlbum(data, self.images_by_id, ratings, self.albums,
-                                self.root_album, aperture_data)
+                                self.root_album, aperture_data, self.time_table)
             self.albums[album.albumid] = album
 
         self._rolls = {}
 	if not self.aperture:
             roll_data = self.data2.get("List of Rolls")
             if roll_data:
-                for roll in roll_data:
-                    roll = IPhotoRoll(roll, self.images_by_id, ratings, aperture_data)
-                    other_roll = self._rolls.get(roll.albumid)
-                    if other_roll:
-                        # iPhoto 9.1.2 issue: it splits rolls into many small rolls, each with a few
-                        # images. We'll merge the images back together into a single roll.
-                        other_roll.merge(roll)
-                    else:
-                        self._rolls[roll.albumid] = roll
-                        self.root_album.addalbum(roll)
-
-        self.images_by_base_name = None
-        self.images_by_file_name = None
-
-    def _build_image_name_list(self):
-        self.images_by_base_name = {}
-        self.images_by_file_name = {}
-
-        # build the basename map
-        for image in self.images_by_id.values():
-            base_name = image.getbasename()
-            other_images = self.images_by_base_name.get(base_name)
-            if other_images is None:
-                other_images = []
-                self.images_by_base_name[base_name] = other_images
-            other_images.append(image)
+                for roll in build_rolls(roll_data, self.images_by_id, ratings,
+                                        aperture_data, self.time_table):
+                    self._rolls[roll.albumid] = roll
+                    self.root_album.addalbum(roll)
+
+        # Built on first use, or carried over from the last incremental export
+        # (see update_lookup_index()).
+        self._lookup_index = None
+        self.time_table.convert()
+
+        # Albums and events of every image. Faces are added when their albums
+        # are built in getfacealbums().
+        self.membership = MembershipIndex()
+        for album in self.albums.values():
+            self.membership.add_container(album)
+        for roll in self._rolls.values():
+            self.membership.add_container(roll)
+
+        self._image_index = None
+
+    def __getstate__(self):
+        """Returns the state for pickling. The raw XML trees are only needed
+        while building the object graph, so only the application version is
+        kept."""
+        state = self.__dict__.copy()
+        state['data'] = {"Application Version": self.applicationVersion}
+        state['data2'] = state['data']
+        state['_image_index'] = None
+        return state
+
+    def get_lookup_index(self):
+        """Returns the ImageLookupIndex of the images, building it if
+        needed."""
+        if self._lookup_index is None:
+            self._lookup_index = ImageLookupIndex(self.images_by_id.values())
+        return self._lookup_index
+
+    def update_lookup_index(self, previous, diff):
+        """Takes over the lookup index of a previous generation of the
+        library, updating it for the changes in diff, instead of building a new
+        one.
+
+        Args:
+          previous: IPhotoData of the previous generation.
+          diff: LibraryDiff from self.get_diff(previous).
+        """
+        if self._lookup_index is not None or previous._lookup_index is None:
+            return
+        lookup_index = previous._lookup_index
+        lookup_index.update(self.images_by_id, diff)
+        # The previous generation must not use the index anymore.
+        previous._lookup_index = None
+        self._lookup_index = lookup_index
 
-            imagename = image.getimagename()
-            other_image_list = self.images_by_file_name.get(imagename)
-            if other_image_list is None:
-                other_image_list = []
-                self.images_by_file_name[imagename] = other_image_list
-            other_image_list.append(image)
+    def _get_lookup_images(self, kind, key):
+        return [self.images_by_id[image_id] for image_id in
+                self.get_lookup_index().getimageids(kind, key)]
 
 
     def _getapplicationversion(self):
@@ -199,30 +360,94 @@ class IPhotoData(object):
     def getroll(self, album_id):
         return self._rolls.get(album_id)    
 
+    def sort_images_by_date(self, images=None):
+        """Returns the images (default: all images) ordered by date, oldest
+        first. Images without a date come last."""
+        if images is None:
+            images = self.images_by_id.values()
+        positions = self.time_table.sort([image.date_index for image in images])
+        return [images[position] for position in positions]
+
+    def get_images_by_date(self, start=None, end=None, images=None):
+        """Returns the images (default: all images) with a date in [start, end),
+        ordered by date. start and end are datetime objects, or None for no
+        limit."""
+        if images is None:
+            images = self.images_by_id.values()
+        positions = self.time_table.select([image.date_index for image in images],
+                                           start, end)
+        return self.sort_images_by_date([images[position] for position in positions])
+
+    def get_image_index(self):
+        """Returns the ImageIndex for queries, building it on first use."""
+        if self._image_index is None:
+            self._image_index = imagequery.ImageIndex(self.images,
+                                                      self.time_table)
+        return self._image_index
+
+    def get_gps_index(self):
+        """Returns the GpsIndex over the image locations. Its positions are
+        the positions in get_image_index().images."""
+        return self.get_image_index().gps_index
+
+    def query(self, **criteria):
+        """Returns the images that match all criteria, ordered by date (see
+        imagequery.ImageIndex.query())."""
+        return self.get_image_index().query(**criteria)
+
+    def run_query(self, text):
+        """Returns the images that match a query written as text (see
+        imagequery.parse_query()), ordered by date. Raises ValueError for
+        invalid queries, and albums or events that do not exist."""
+        criteria = imagequery.parse_query(text)
+        containers = []
+        for name in criteria.pop('albums', ()):
+            containers.append(self._find_container(
+                name, [album for album in self.albums.values()
+                       if album.albumtype != "Event"]))
+        for name in criteria.pop('events', ()):
+            containers.append(self._find_container(
+                name, self._rolls.values() +
+                [album for album in self.albums.values()
+                 if album.albumtype == "Event"]))
+        return self.query(containers=containers, **criteria)
+
+    def _find_container(self, name, containers):
+        for container in containers:
+            if container.name == name:
+                return container
+        raise ValueError(u'No album or event named "%s".' % (name))
+
     def getbaseimages(self, base_name):
         """returns an IPhotoImage list of all images with a matching base name.
         """
-        if not self.images_by_base_name:
-            self._build_image_name_list()
-        return self.images_by_base_name.get(base_name)
+        return self._get_lookup_images(KEY_BASE_NAME, base_name) or None
 
     def getnamedimage(self, file_name):
         """returns an IPhotoImage for the given file name."""
-        if not self.images_by_file_name:
-            self._build_image_name_list()
-        image_list = self.images_by_file_name.get(file_name)
+        image_list = self._get_lookup_images(KEY_FILE_NAME, file_name)
         if image_list:
             return image_list[0]
         return None
 
+    def getpathimage(self, path):
+        """returns the IPhotoImage with the given image, thumbnail, or
+        original path, or None."""
+        lookup_index = self.get_lookup_index()
+        for kind in (KEY_IMAGE_PATH, KEY_THUMB_PATH, KEY_ORIGINAL_PATH):
+            image_ids = lookup_index.getimageids(kind, path)
+            if image_ids:
+                return self.images_by_id[image_ids[0]]
+        return None
+
     def getallimages(self):
-        """returns map from full path name to image."""
+        """returns map from full path name to image. Use getpathimage() to
+        look up single paths."""
+        lookup_index = self.get_lookup_index()
         image_map = {}
-        for image in self.images_by_id.values():
-            image_map[image.GetImagePath()] = image
-            image_map[image.thumbpath] = image
-            if image.originalpath is not None:
-                image_map[image.originalpath] = image
+        for kind in (KEY_ORIGINAL_PATH, KEY_THUMB_PATH, KEY_IMAGE_PATH):
+            for (path, image_ids) in lookup_index.getitems(kind):
+                image_map[path] = self.images_by_id[image_ids[0]]
         return image_map
 
     def checkalbumsizes(self, max_size):
@@ -276,8 +501,22 @@ class IPhotoData(object):
         if not self.aperture or self.aperture_data:
             return
         su.pout('Scanning for Originals...')
-        for image in self.images_by_id.values():
-            image.find_aperture_original()
+        images = self.images_by_id.values()
+        # Many images share a Masters folder; walk each folder once.
+        masters_index = ApertureMastersIndex(
+            [_get_aperture_master_path(image.image_path) for image in images])
+        unresolved = []
+        for image in images:
+            originalpath = image.originalpath
+            if not image.find_aperture_original(masters_index):
+                unresolved.append(image)
+            elif (self._lookup_index is not None and
+                  image.originalpath != originalpath):
+                self._lookup_index.update_image(image)
+        if unresolved:
+            su.pout(u'No master for %d images:' % (len(unresolved)))
+            for image_path in sorted([image.image_path for image in unresolved]):
+                su.pout(u'  %s' % (image_path))
 
 #  public void checkComments() {
 #    TreeSet<String> images = new TreeSet<String>();
@@ -294,49 +533,80 @@ class IPhotoData(object):
         """Checks that all images are in albums according to their events."""
         messages = []
         for image in self.images_by_id.values():
-            if image.IsHidden():
+            if image.ishidden():
                 continue
             roll_name = self._rolls[image.roll].name
             albums = []
             in_album = False
 
-            for album in image.GetAlbums():
+            for album in image.albums:
                 album_name = album.name
-                if album.GetAlbumType == "Regular":
+                if album.albumtype == "Regular":
                     albums.append(album.name)
                     in_album = True
                     if album_name != roll_name:
                         messages.append(image.caption + ": in wrong album (" +
                                         roll_name + " vs. " + album_name + ").")
-                elif (album.isSmart() and album_name.endswith(" Collection") or
+                elif (album.albumtype == "Smart" and
+                      album_name.endswith(" Collection") or
                       album_name == "People" or album_name == "Unorganized"):
                     in_album = True
             if not in_album:
                 messages.append(image.caption + ": not in any album.")
-            if albums:
+            if len(albums) > 1:
                 messages.append(image.caption + ": in more than one album: " +
                                 " ".join(albums))
         messages.sort()
         for message in messages:
             print message
 
+    def get_face_index(self):
+        """Returns the FaceIndex of the library. It is built with the images,
+        or on first use for lazy images."""
+        if self.face_index is None:
+            face_index = FaceIndex(self.name_table)
+            for image in self.images:
+                face_index.add_image(image)
+            self.face_index = face_index
+        return self.face_index
+
     def getfacealbums(self):
         """Returns a map of albums for faces."""
-        if self.face_albums:
+        if self.face_albums is not None:
             return self.face_albums.values()
 
         # Build the albums on first call
-        self.face_albums = {}
-
-        for image in self.images:
-            for face in image.getfaces():
-                face_album = self.face_albums.get(face)
-                if not face_album:
-                    face_album = IPhotoFace(face)
-                    self.face_albums[face] = face_album
-                face_album.addimage(image)
+        face_index = self.get_face_index()
+        face_albums = {}
+        for face in face_index.getfaces():
+            face_album = IPhotoFace(face)
+            face_album.images = list(face_index.getimages(face))
+            face_albums[face] = face_album
+            self.membership.add_container(face_album)
+        self.face_albums = face_albums
         return self.face_albums.values()
 
+    def getplacealbums(self, radius_km=1.0, min_images=1):
+        """Returns albums for places: groups of images that were taken close to
+        each other (see gpsindex.GpsIndex.cluster()), largest first.
+
+        The albums are kept for each radius_km and min_images, so asking
+        again does not add more containers to the MembershipIndex."""
+        key = (radius_km, min_images)
+        place_albums = self.place_albums.get(key)
+        if place_albums is not None:
+            return place_albums
+        gps_index = self.get_gps_index()
+        place_albums = []
+        for positions in gps_index.cluster(radius_km, min_images):
+            (latitude, longitude) = gps_index.get_center(positions)
+            place_album = IPhotoPlace(latitude, longitude,
+                                      gps_index.get_images(positions))
+            self.membership.add_container(place_album)
+            place_albums.append(place_album)
+        self.place_albums[key] = place_albums
+        return place_albums
+
     #def has_comments(self):
     #    """Returns True if at least one of the images has a comment."""
     #    for image in self.images_by_id.values():
@@ -344,36 +614,447 @@ class IPhotoData(object):
     #            return True
     #    return False
 
+    def get_diff(self, previous):
+        """Compares this library with a previous generation of it.
+
+        Args:
+          previous: IPhotoData of the previous generation, e.g. from a snapshot.
+
+        Returns:
+          LibraryDiff with the added, removed, and modified images, and the
+          changed albums, rolls (events), and faces.
+        """
+        diff = LibraryDiff()
+        for (image_id, image) in self.images_by_id.items():
+            old_image = previous.images_by_id.get(image_id)
+            if old_image is None:
+                diff.added_images.add(image_id)
+            elif _get_image_signature(image) != _get_image_signature(old_image):
+                diff.modified_images.add(image_id)
+        for image_id in previous.images_by_id:
+            if not image_id in self.images_by_id:
+                diff.removed_images.add(image_id)
+        diff.changed_albums = _get_changed_containers(self.albums,
+                                                      previous.albums)
+        diff.changed_rolls = _get_changed_containers(self._rolls,
+                                                     previous._rolls)
+        old_faces = previous._get_face_image_ids()
+        new_faces = self._get_face_image_ids()
+        for face in set(old_faces.keys()) | set(new_faces.keys()):
+            if old_faces.get(face) != new_faces.get(face):
+                diff.changed_faces.add(face)
+        return diff
+
+    def _get_face_image_ids(self):
+        """Returns a map from face name to the set of ids of its images."""
+        face_index = self.get_face_index()
+        return dict([(face, set([image.id for image in face_index.getimages(face)]))
+                     for face in face_index.getfaces()])
+
     def print_summary(self):
+        # Images are in several containers; stat each file once.
+        stat_cache = su.get_stat_cache()
+        stat_paths = []
+        for image in self.images_by_id.values():
+            stat_paths.append(image.image_path)
+            if image.originalpath:
+                stat_paths.append(image.originalpath)
+        stat_cache.prefetch(stat_paths)
         named_rolls = {}
         for roll in self._rolls.values():
             named_rolls[roll.name] = roll
         for roll in sorted(named_rolls.keys()):
-            named_rolls[roll].print_summary()
+            named_rolls[roll].print_summary(stat_cache)
         named_albums = {}
         for album in self.albums.values():
             named_albums[album.name] = album
         for album in sorted(named_albums):
-            named_albums[album].print_summary()
+            named_albums[album].print_summary(stat_cache)
+
+def _get_image_signature(image):
+    """Returns the image properties that a library diff compares. These
+    include all keys of the ImageLookupIndex."""
+    return (image.getmodtimestamp(), image.image_path, image.thumbpath,
+            image.originalpath, image.caption, image.keywords)
+
+def _get_container_signature(container):
+    """Returns the album or event properties that a library diff compares."""
+    return (container.name, container.albumtype, container.comment,
+            container.date, [image.id for image in container.images])
+
+def _get_changed_containers(containers, old_containers):
+    """Returns the set of ids of the containers that were added, removed, or
+    changed between two albumid -> container maps."""
+    changed = set()
+    for (albumid, container) in containers.items():
+        old_container = old_containers.get(albumid)
+        if (old_container is None or _get_container_signature(container) !=
+            _get_container_signature(old_container)):
+            changed.add(albumid)
+    for albumid in old_containers:
+        if not albumid in containers:
+            changed.add(albumid)
+    return changed
+
+
+class LibraryDiff(object):
+    """Differences between two generations of an iPhoto library."""
+
+    def __init__(self):
+        self.added_images = set()  # ids of new images
+        self.removed_images = set()  # ids of images that are gone
+        self.modified_images = set()  # ids of images with changes
+        self.changed_albums = set()  # albumids of changed albums
+        self.changed_rolls = set()  # albumids of changed events
+        self.changed_faces = set()  # names of faces with changed images
+
+    def _getchangedimages(self):
+        return self.added_images | self.modified_images
+    changed_images = property(_getchangedimages,
+                              doc="Ids of images that were added or modified")
+
+    def is_changed_container(self, container):
+        """Tests if an album, event, or face changed, and all of its images
+        need to be checked again."""
+        if container.albumtype == "Face":
+            return container.name in self.changed_faces
+        if container.albumtype in ("Place", "Query"):
+            # Any change can move images in or out of these.
+            return True
+        if container.albumtype == "Event":
+            return container.albumid in self.changed_rolls
+        return container.albumid in self.changed_albums
+
+    def is_changed_image(self, image):
+        """Tests if an image was added or modified."""
+        return image.id in self.added_images or image.id in self.modified_images
+
+    def print_summary(self):
+        """Prints the number of changes."""
+        su.pout(u"Library changes: %d added, %d removed, %d modified images, "
+                "%d albums, %d events, %d faces." % (
+                    len(self.added_images), len(self.removed_images),
+                    len(self.modified_images), len(self.changed_albums),
+                    len(self.changed_rolls), len(self.changed_faces)))
+
 
 _CAPTION_PATTERN = re.compile(
     r'([12][0-9][0-9][0-9])([01][0-9])([0123][0-9]) (.*)')
 
+class NameTable(object):
+    """Interns names (keywords and faces) for a library. Images refer to them
+    by their index in this table."""
+
+    def __init__(self):
+        self.names = []
+        self._indices = {}
+
+    def getindex(self, name):
+        """Returns the index of a name, adding it to the table if needed."""
+        index = self._indices.get(name)
+        if index is None:
+            index = len(self.names)
+            self.names.append(name)
+            self._indices[name] = index
+        return index
+
+    def findindex(self, name):
+        """Returns the index of a name, or None if it is not in the table."""
+        return self._indices.get(name)
+
+    def getindices(self, names):
+        """Returns the indices of a list of names, as an integer array (or an
+        empty tuple, which is shared)."""
+        if not names:
+            return ()
+        return array.array('i', [self.getindex(name) for name in names])
+
+    def intern(self, name):
+        """Returns the shared copy of a name."""
+        return self.names[self.getindex(name)]
+
+
+class ImageLookupIndex(object):
+    """Finds images by image path, thumbnail path, original path, file name,
+    or base name (see the KEY_ constants).
+
+    The index refers to images by id, not by object, so it can be saved with a
+    library snapshot and carried over to the next generation of the library
+    (see update()).
+    """
+
+    def __init__(self, images=()):
+        # Per kind of key: key -> image id, or list of image ids if several
+        # images have the key.
+        self._maps = ({}, {}, {}, {}, {})
+        self._keys = {}  # image id -> keys of the image, by kind
+        for image in images:
+            self.add_image(image)
+
+    def __len__(self):
+        """Returns the number of images in the index."""
+        return len(self._keys)
+
+    @staticmethod
+    def _get_keys(image):
+        return (image.image_path, image.thumbpath, image.originalpath,
+                image.getimagename(), image.getbasename())
+
+    def add_image(self, image):
+        """Adds an image, which must not be in the index yet."""
+        image_id = image.id
+        keys = self._get_keys(image)
+        self._keys[image_id] = keys
+        for (key_map, key) in zip(self._maps, keys):
+            if key is None:
+                continue
+            image_ids = key_map.get(key)
+            if image_ids is None:
+                key_map[key] = image_id
+            elif isinstance(image_ids, list):
+                image_ids.append(image_id)
+            else:
+                key_map[key] = [image_ids, image_id]
+
+    def remove_image(self, image_id):
+        """Removes an image, if it is in the index."""
+        keys = self._keys.pop(image_id, None)
+        if keys is None:
+            return
+        for (key_map, key) in zip(self._maps, keys):
+            if key is None:
+                continue
+            image_ids = key_map[key]
+            if not isinstance(image_ids, list):
+                del key_map[key]
+                continue
+            image_ids.remove(image_id)
+            if len(image_ids) == 1:
+                key_map[key] = image_ids[0]
+
+    def update_image(self, image):
+        """Updates the keys of an image that changed."""
+        self.remove_image(image.id)
+        self.add_image(image)
+
+    def update(self, images_by_id, diff):
+        """Updates the index for the changes of a LibraryDiff.
+
+        Args:
+          images_by_id: the images of the new generation of the library.
+          diff: the LibraryDiff between the generation this index was built
+              for and the new one.
+        """
+        for image_id in diff.removed_images | diff.modified_images:
+            self.remove_image(image_id)
+        for image_id in diff.added_images | diff.modified_images:
+            self.add_image(images_by_id[image_id])
+
+    def getimageids(self, kind, key):
+        """Returns the ids of the images with a key of a kind, as a sequence
+        (possibly empty)."""
+        image_ids = self._maps[kind].get(key)
+        if image_ids is None:
+            return ()
+        if isinstance(image_ids, list):
+            return image_ids
+        return (image_ids,)
+
+    def getitems(self, kind):
+        """Returns (key, image ids) for all keys of a kind."""
+        return [(key, image_ids if isinstance(image_ids, list) else (image_ids,))
+                for (key, image_ids) in self._maps[kind].iteritems()]
+
+
+class FaceIndex(object):
+    """Inverted index of the faces of a library: the images of every face, and
+    how many images every pair of faces appears in together.
+
+    Faces are kept as their index in the NameTable of the library.
+    """
+
+    def __init__(self, name_table):
+        self.name_table = name_table
+        self._images = {}  # face -> images
+        self._pairs = {}  # (face, face) -> number of images
+
+    def add_image(self, image):
+        """Adds the faces of an image."""
+        face_ids = image.getfaceids()
+        if not face_ids:
+            return
+        if len(face_ids) > 1:
+            face_ids = sorted(set(face_ids))
+        for (i, face_id) in enumerate(face_ids):
+            images = self._images.get(face_id)
+            if images is None:
+                images = []
+                self._images[face_id] = images
+            images.append(image)
+            for other_id in face_ids[i + 1:]:
+                pair = (face_id, other_id)
+                self._pairs[pair] = self._pairs.get(pair, 0) + 1
+
+    def getfaces(self):
+        """Returns the names of the faces that have images."""
+        names = self.name_table.names
+        return [names[face_id] for face_id in self._images]
+
+    def getimages(self, face):
+        """Returns the images of a face."""
+        return self._images.get(self.name_table.findindex(face), ())
+
+    def getcount(self, face):
+        """Returns the number of images of a face."""
+        return len(self.getimages(face))
+
+    def getcooccurrence(self, face, other_face):
+        """Returns the number of images that have both faces."""
+        face_id = self.name_table.findindex(face)
+        other_id = self.name_table.findindex(other_face)
+        return self._pairs.get((min(face_id, other_id), max(face_id, other_id)),
+                               0)
+
+    def getcooccurring(self, face):
+        """Returns the faces that appear in images with face, as (name, number
+        of images) pairs, most frequent first."""
+        face_id = self.name_table.findindex(face)
+        names = self.name_table.names
+        result = []
+        for ((first_id, second_id), count) in self._pairs.iteritems():
+            if first_id == face_id:
+                result.append((names[second_id], count))
+            elif second_id == face_id:
+                result.append((names[first_id], count))
+        result.sort(key=lambda (name, count): (-count, name))
+        return result
+
+
+class MembershipIndex(object):
+    """Maps images to the albums, events and faces that contain them.
+
+    Containers are numbered in the order they are added, and every image keeps
+    the numbers of its containers in an integer array, so finding the
+    containers of an image does not need a scan of all containers.
+    """
+
+    def __init__(self):
+        self.containers = []
+        self._numbers = {}  # id(container) -> number
+        self._export_counts = None  # image id -> number of exports
+
+    def __getstate__(self):
+        """Returns the state for pickling. Container numbers are keyed by
+        object identity, which does not survive pickling."""
+        return {'containers': self.containers,
+                'export_counts': self._export_counts}
+
+    def __setstate__(self, state):
+        self.containers = state['containers']
+        self._numbers = dict([(id(container), number) for (number, container)
+                              in enumerate(self.containers)])
+        self._export_counts = state['export_counts']
+
+    def getnumber(self, container):
+        """Returns the number of a container, adding it to the index if
+        needed."""
+        number = self._numbers.get(id(container))
+        if number is None:
+            number = len(self.containers)
+            self.containers.append(container)
+            self._numbers[id(container)] = number
+            self._export_counts = None
+        return number
+
+    def add_container(self, container):
+        """Adds a container, and records it for all of its images."""
+        number = self.getnumber(container)
+        for image in container.images:
+            self._add_number(image, number)
+
+    def add_image(self, image, container):
+        """Records that container contains image."""
+        self._add_number(image, self.getnumber(container))
+
+    def _add_number(self, image, number):
+        if image.membership is not self:
+            # Images only belong to one index; start over in this one.
+            image.membership = self
+            image.container_numbers = ()
+        numbers = image.container_numbers
+        if number in numbers:
+            return
+        if not numbers:
+            image.container_numbers = array.array('i', (number,))
+        else:
+            numbers.append(number)
+        self._export_counts = None
+
+    def get_containers(self, image):
+        """Returns the containers of an image."""
+        if image.membership is not self:
+            return []
+        return [self.containers[number] for number in image.container_numbers]
+
+    def set_exported(self, containers):
+        """Sets the containers that are exported, and counts for every image
+        how many of them contain it."""
+        counts = {}
+        for container in containers:
+            self.getnumber(container)
+            for image in container.images:
+                counts[image.id] = counts.get(image.id, 0) + 1
+        self._export_counts = counts
+
+    def get_export_count(self, image):
+        """Returns the number of exported containers (see set_exported) that
+        contain an image, which is the number of copies an export makes of
+        it. Without set_exported, all containers are counted."""
+        if self._export_counts is None:
+            if image.membership is not self:
+                return 0
+            return len(image.container_numbers)
+        return self._export_counts.get(image.id, 0)
+
+
 class IPhotoImage(object):
-    """Describes an image in the iPhoto database."""
+    """Describes an image in the iPhoto database.
+
+    There can be millions of images, so an image only keeps what it needs in
+    slots: keywords and faces are integer arrays into the NameTable of the
+    library, and the raw XML data is not retained.
+    """
 
-    def __init__(self, key, data, keyword_map, face_map, aperture_data):
+    __slots__ = ('id', '_caption', 'comment', 'time_table', '_date',
+                 '_date_loaded', 'date_index', '_mod_date', '_mod_date_index',
+                 'image_path', 'thumbpath', 'originalpath', 'rating', 'gps',
+                 'roll', 'name_table', '_keyword_ids', '_face_ids',
+                 '_face_rectangles', '_media_type', 'rotation_is_only_edit',
+                 'membership', 'container_numbers', 'event_name', 'event_index',
+                 'event_index0')
+
+    def __init__(self, key, data, keyword_map, face_map, aperture_data,
+                 time_table=None, name_table=None):
         self.id = key
-        self.data = data
+        if time_table is None:
+            time_table = applexml.AppleTimeTable()
+        self.time_table = time_table
+        if name_table is None:
+            name_table = NameTable()
+        self.name_table = name_table
         self._caption = su.nn_string(data.get("Caption")).strip()
         self.comment = su.nn_string(data.get("Comment")).strip()
         version = None
         if aperture_data:
             version = aperture_data.versions.get(key)
+        # The date is only converted into a datetime object when it is read
+        # (see _getdate()).
+        self._date = None
+        self._date_loaded = False
         if data.has_key("DateAsTimerInterval"):
-            self.date = applexml.getappletime(data.get("DateAsTimerInterval"))
+            self.date_index = time_table.add(data.get("DateAsTimerInterval"))
         elif version:
-            self.date = version.image_date
+            self._setdate(version.image_date)
         else:
             # Try to get the date from a the caption in "YYYYMMDD ..." format
             m = re.match(_CAPTION_PATTERN, self._caption)
@@ -385,12 +1066,17 @@ class IPhotoImage(object):
                 date = int(m.group(3))
                 if not date:
                     date = 1
-                self.date = datetime.datetime(year, month, date)
+                self._setdate(datetime.datetime(year, month, date))
             else:
-                self.date = None
-        self.mod_date = applexml.getappletime(
-            data.get("ModDateAsTimerInterval"))
+                self._setdate(None)
+        self._mod_date = None
+        self._mod_date_index = time_table.add(data.get("ModDateAsTimerInterval"))
         self.image_path = data.get("ImagePath")
+        self.thumbpath = data.get("ThumbPath")
+        self._media_type = data.get("MediaType")
+        if self._media_type is not None:
+            self._media_type = name_table.intern(self._media_type)
+        self.rotation_is_only_edit = data.get("RotationIsOnlyEdit")
         if data.has_key("Rating"):
             self.rating = int(data.get("Rating"))
         elif version:
@@ -406,13 +1092,13 @@ class IPhotoImage(object):
         else:
             self.gps = None
 
-        self.keywords = []
+        self._keyword_ids = ()
         keyword_list = data.get("Keywords")
         if keyword_list is not None:
-            for i in keyword_list:
-                self.keywords.append(keyword_map.get(i))
+            self._keyword_ids = name_table.getindices(
+                [keyword_map.get(i) for i in keyword_list])
         elif version:
-            self.keywords = version.keywords
+            self._keyword_ids = name_table.getindices(version.keywords)
 
         if version:
             self.originalpath = None # This is just a placeholder...
@@ -438,21 +1124,26 @@ class IPhotoImage(object):
         else:
             self.originalpath = data.get("OriginalPath")
         self.roll = data.get("Roll") 
+        if self.roll is not None:
+            self.roll = name_table.intern(self.roll)
 
-        self.albums = []  # list of albums that this image belongs to
-        self.faces = []
-        self.face_rectangles = []
+        # Albums, events and faces that contain this image, as numbers in the
+        # MembershipIndex of the library.
+        self.membership = None
+        self.container_numbers = ()
         self.event_name = '' # name of event (roll) that this image belongs to
         self.event_index = '' # index within event
         self.event_index0 = '' # index with event, left padded with 0
 
+        faces = []
+        face_rectangles = []
         face_list = data.get("Faces")
         if face_list:
             for face_entry in face_list:
                 face_key = face_entry.get("face key")
                 face_name = face_map.get(face_key)
                 if face_name:
-                    self.faces.append(face_name)
+                    faces.append(face_name)
                     # Rectangle is '{{x, y}, {width, height}}' as ratios,
                     # referencing the lower left corner of the face rectangle,
                     # with lower left corner of image as (0,0)
@@ -460,21 +1151,45 @@ class IPhotoImage(object):
                     # Convert to using center of area, relative to upper left corner of image
                     rectangle[0] += rectangle[2] / 2.0
                     rectangle[1] = max(0.0, 1.0 - rectangle[1] - rectangle[3] / 2.0)
-                    self.face_rectangles.append(rectangle)
+                    face_rectangles.append(rectangle)
                 # Other keys in face_entry: face index
 
                 # Now sort the faces left to right.
                 sorted_names = {}
                 sorted_rectangles = {}
-                for i in xrange(len(self.faces)):
-                    x = self.face_rectangles[i][0]
+                for i in xrange(len(faces)):
+                    x = face_rectangles[i][0]
                     while sorted_names.has_key(x):
                         x += 0.00001
-                    sorted_names[x] = self.faces[i]
-                    sorted_rectangles[x] = self.face_rectangles[i]
-                self.faces = [sorted_names[x] for x in sorted(sorted_names.keys())]
-                self.face_rectangles = [
+                    sorted_names[x] = faces[i]
+                    sorted_rectangles[x] = face_rectangles[i]
+                faces = [sorted_names[x] for x in sorted(sorted_names.keys())]
+                face_rectangles = [
                     sorted_rectangles[x] for x in sorted(sorted_rectangles.keys())]
+        self._face_ids = name_table.getindices(faces)
+        # Rectangles are packed as x, y, width, height for each face.
+        self._face_rectangles = ()
+        if face_rectangles:
+            self._face_rectangles = array.array(
+                'd', [value for rectangle in face_rectangles for value in rectangle])
+
+    def _setdate(self, date):
+        self._date = date
+        self._date_loaded = True
+        self.date_index = self.time_table.add_datetime(date)
+
+    def _getdate(self):
+        if not self._date_loaded:
+            self._date = self.time_table.getdatetime(self.date_index)
+            self._date_loaded = True
+        return self._date
+    date = property(_getdate, doc="Date of the image (or None)")
+
+    def _getmoddate(self):
+        if self._mod_date is None:
+            self._mod_date = self.time_table.getdatetime(self._mod_date_index)
+        return self._mod_date
+    mod_date = property(_getmoddate, doc="Modification date of the image")
 
     def getimagepath(self):
         """Returns the full path to this image.."""
@@ -497,78 +1212,165 @@ class IPhotoImage(object):
 
     def ismovie(self):
         """Tests if this image is a movie."""
-        return self.data.get("MediaType") == "Movie"
-
-    def addalbum(self, album):
-        """Adds an album to the list of albums for this image."""
-        self.albums.append(album)
+        return self._media_type == "Movie"
+
+    def addalbum(self, album, membership=None):
+        """Adds an album to the list of albums for this image, in the
+        MembershipIndex of the library (membership, or the one the image is
+        already in)."""
+        if membership is None:
+            membership = self.membership
+        if membership is None:
+            raise ValueError(u'Image %s is not in a MembershipIndex' % (
+                self.id))
+        membership.add_image(self, album)
+
+    def getcontainers(self):
+        """Returns the albums, events and faces that contain this image."""
+        if self.membership is None:
+            return []
+        return self.membership.get_containers(self)
+
+    def getcontainercount(self):
+        """Returns the number of albums, events and faces that contain this
+        image."""
+        return len(self.container_numbers)
+
+    def _getalbums(self):
+        return [container for container in self.getcontainers()
+                if isinstance(container, IPhotoAlbum)]
+    albums = property(_getalbums, doc="Albums that contain this image")
 
     def addface(self, name):
         """Adds a face (name) to the list of faces for this image."""
-        self.faces.append(name)
+        self._face_ids = array.array('i', self._face_ids)
+        self._face_ids.append(self.name_table.getindex(name))
+
+    def getfaceids(self):
+        """Gets the faces of this image, as indices in the NameTable."""
+        return self._face_ids
 
     def getfaces(self):
         """Gets the list of face tags for this image."""
-        return self.faces
+        names = self.name_table.names
+        return [names[i] for i in self._face_ids]
+    faces = property(getfaces, doc="Face tags (names) of the image")
+
+    def _getfacerectangles(self):
+        rectangles = self._face_rectangles
+        return [list(rectangles[i:i + 4]) for i in xrange(0, len(rectangles), 4)]
+    face_rectangles = property(_getfacerectangles,
+                               doc="Face rectangles [x, y, width, height]")
+
+    def _getkeywords(self):
+        names = self.name_table.names
+        return [names[i] for i in self._keyword_ids]
+    keywords = property(_getkeywords, doc="Keywords of the image")
 
     def ishidden(self):
         """Tests if the image is hidden (using keyword "Hidden")"""
         return "Hidden" in self.keywords
 
-    def _getthumbpath(self):
-        return self.data.get("ThumbPath")
-    thumbpath = property(_getthumbpath, doc="Path to thumbnail image")
-
-    def _getrotationisonlyedit(self):
-        return self.data.get("RotationIsOnlyEdit")
-    rotation_is_only_edit = property(_getrotationisonlyedit,
-                                     doc="Rotation is only edit.")
-
-    def _search_for_file(self, folder_path, basename):
-        """Scans recursively through a folder tree and returns the path to the
-           first file it finds that starts with "basename".
-        """
-        for file_name in su.os_listdir_unicode(folder_path):
-            path = os.path.join(folder_path, file_name)
-            if os.path.isdir(path):
-                path = self._search_for_file(path, basename)
-                if path:
-                    return path
-            elif file_name.startswith(basename):
-                return path
-        return None
+    def getmodtimestamp(self):
+        """Returns the modification time of the image as a POSIX time stamp,
+        or None if it is not known."""
+        timestamp = self.time_table.gettimestamp(self._mod_date_index)
+        return None if timestamp != timestamp else timestamp
 
-    def find_aperture_original(self):
-        """Attempts to locate the Aperture Master image. Works only for .jpg
+    def find_aperture_original(self, masters_index=None):
+        """Attempts to locate the Aperture Master image. Works only for
            masters that are stored in the Aperture library. Saves the result as
-           originalpath."""
+           originalpath.
+
+           Args:
+             masters_index: an ApertureMastersIndex that includes the Masters
+                 folder of the image. If None, the folder is indexed.
+           Returns:
+             False if the Masters folder exists, but has no master for the
+             image, True otherwise.
+        """
         master_path = _get_aperture_master_path(self.image_path)
-        if not os.path.exists(master_path):
-            return
-        basename = su.getfilebasename(self.image_path)
-        file_name = os.path.join(master_path, basename + '.jpg')
-        if os.path.exists(file_name):
-            self.originalpath = file_name
-            return
-        path = self._search_for_file(master_path, basename + '.')
+        if masters_index is None:
+            masters_index = ApertureMastersIndex([master_path])
+        if not masters_index.has_folder(master_path):
+            return True
+        path = masters_index.find(master_path,
+                                  su.getfilebasename(self.image_path))
         if path:
             self.originalpath = path
-            return
-        su.pout(u"No master for %s" % (self.image_path))
+            return True
+        return False
+
+
+# Serializes loading LazyIPhotoImage objects, which several threads can read
+# (e.g., the copy threads of an export). Reentrant, so reading a missing
+# attribute while an image loads raises AttributeError, without deadlocking.
+_LAZY_IMAGE_LOCK = threading.RLock()
+
+
+class LazyIPhotoImage(IPhotoImage):
+    """An IPhotoImage that parses its entry in the Master Image List only when
+    one of its attributes is first read.
+
+    Only the id, and the event and album assignments made by containers, are
+    available without parsing.
+    """
+
+    def __init__(self, key, image_data, keyword_map, face_map, aperture_data,
+                 time_table=None, name_table=None):
+        # Does not call IPhotoImage.__init__() - that happens in _load().
+        self.id = key
+        self._lazy_args = (image_data, keyword_map, face_map, aperture_data,
+                           time_table, name_table)
+        self.membership = None
+        self.container_numbers = ()
+        self.event_name = ''
+        self.event_index = ''
+        self.event_index0 = ''
+
+    def _load(self):
+        """Parses the image entry, and initializes the IPhotoImage. Called
+        with _LAZY_IMAGE_LOCK held."""
+        lazy_args = self.__dict__.pop('_lazy_args', None)
+        if lazy_args is None:
+            return  # Loaded by another thread.
+        (image_data, keyword_map, face_map, aperture_data, time_table,
+         name_table) = lazy_args
+        assigned = (self.membership, self.container_numbers, self.event_name,
+                    self.event_index, self.event_index0)
+        IPhotoImage.__init__(self, self.id, image_data.get(self.id), keyword_map,
+                             face_map, aperture_data, time_table, name_table)
+        (self.membership, self.container_numbers, self.event_name,
+         self.event_index, self.event_index0) = assigned
+
+    def __getattr__(self, name):
+        # Only called for attributes that are not set yet. Another thread may
+        # be loading the image, so wait for it before giving up.
+        _LAZY_IMAGE_LOCK.acquire()
+        try:
+            self._load()
+        finally:
+            _LAZY_IMAGE_LOCK.release()
+        return object.__getattribute__(self, name)
 
 
 class IPhotoContainer(object):
     """Base class for IPhotoAlbum and IPhotoRoll."""
 
-    def __init__(self, name, albumtype, data, images, ratings, aperture_data=None, verbose=False):
+    def __init__(self, name, albumtype, data, images, ratings, aperture_data=None, verbose=False,
+                 time_table=None, assign_names=True):
         self.name = name
         self._date = None
+        self._date_index = None
         self.uuid = None
         self.comment = None
 
         if data:
             if data.get("RollDateAsTimerInterval"):
-                self._date = applexml.getappletime(data.get("RollDateAsTimerInterval"))
+                if time_table is None:
+                    time_table = applexml.AppleTimeTable()
+                self._time_table = time_table
+                self._date_index = time_table.add(data.get("RollDateAsTimerInterval"))
             if data.get("uuid"):
                 self.uuid = data.get("uuid")
                 if self.uuid == 'lastImportAlbum':
@@ -614,6 +1416,7 @@ class IPhotoContainer(object):
         self.images = []
         self.albums = []
         self.master = False
+        self._stats = None
         hidden = 0
         if not self.isfolder() and data and (
             data.has_key("KeyList") or data.has_key("KeyListString")):
@@ -636,7 +1439,8 @@ class IPhotoContainer(object):
         if hidden:
             su.pout(u"%s: %d images not exported (probably hidden)." % (name, hidden))
 
-        self._assign_names()
+        if assign_names:
+            self._assign_names()
 
     def _assign_names(self):
         """Assigns sequential index values to all images if this container is an Event."""
@@ -651,8 +1455,13 @@ class IPhotoContainer(object):
             i += 1
 
     def merge(self, other_roll):
-        for image in other_roll.images:
-            self.images.append(image)
+        self.merge_all([other_roll])
+
+    def merge_all(self, other_rolls):
+        """Appends the images of other rolls, and numbers all images once."""
+        for other_roll in other_rolls:
+            self.images.extend(other_roll.images)
+        self._stats = None
         self._assign_names()
 
     def _getsize(self):
@@ -685,51 +1494,52 @@ class IPhotoContainer(object):
         self.albums.append(album)
 
     def _getdate(self):
-        # For containers that don't have a date, we calculate it from the image dates.
         if not self._date:
-            for image in self.images:
-                if image.date and (not self._date or image.date < self._date):
-                    self._date = image.date
+            if self._date_index is not None:
+                self._date = self._time_table.getdatetime(self._date_index)
+            else:
+                # For containers that don't have a date, we calculate it from the image
+                # dates.
+                self._date = self.getstats().min_date
         return self._date
     date = property(_getdate, doc='date of container (based on oldest image)')
 
+    def getstats(self, stat_cache=None):
+        """Returns the ContainerStats of this container. They are computed once,
+        and again if file sizes are asked for with a stat_cache."""
+        if self._stats is None or (stat_cache is not None and
+                                   not self._stats.has_sizes):
+            self._stats = ContainerStats(self.images, stat_cache)
+        return self._stats
+
     def tostring(self):
         """Gets a string that describes this album or event."""
         return "%s (%s)" % (self.name, self.albumtype)
 
-    def print_summary(self):
+    def print_summary(self, stat_cache=None):
         if self.albumtype != "Event":
             return
-        original_count = 0
-        file_size = 0
-        original_size = 0
-        face_count = 0
-        for image in self.images:
-            face_count += len(image.getfaces())
-            if image.originalpath:
-                original_count += 1
-                if os.path.exists(image.originalpath):
-                    original_size += os.path.getsize(image.originalpath)
-            if os.path.exists(image.image_path):
-                file_size += os.path.getsize(image.image_path)
-                if not image.originalpath:
-                    original_size += os.path.getsize(image.image_path)
-        file_size = file_size / 1024.0 / 1024.0
-        original_size = original_size / 1024.0 / 1024.0
+        if stat_cache is None:
+            stat_cache = su.get_stat_cache()
+        stats = self.getstats(stat_cache)
         su.pout(u"%-50s %4d images (%6.1f MB), %3d originals (%6.1f MB), %3d faces" % (
-            self.tostring(), len(self.images), file_size, original_count, original_size,
-            face_count))
+            self.tostring(), stats.image_count, stats.image_bytes / 1024.0 / 1024.0,
+            stats.original_count, stats.master_bytes / 1024.0 / 1024.0,
+            stats.face_count))
 
 
 class IPhotoRoll(IPhotoContainer):
     """Describes an iPhoto Roll or Event."""
 
-    def __init__(self, data, images, ratings, aperture_data):
+    def __init__(self, data, images, ratings, aperture_data, time_table=None,
+                 assign_names=True):
         IPhotoContainer.__init__(self,
                                  data.get("RollName")
                                  if data.has_key("RollName")
                                  else data.get("AlbumName"),
-                                 "Event", data, images, ratings, aperture_data)
+                                 "Event", data, images, ratings, aperture_data,
+                                 time_table=time_table,
+                                 assign_names=assign_names)
         self.albumid = data.get("RollID")
         if not self.albumid:
             self.albumid = data.get("AlbumId")
@@ -737,13 +1547,42 @@ class IPhotoRoll(IPhotoContainer):
        
 
 
+def build_rolls(roll_data, images, ratings, aperture_data, time_table=None):
+    """Builds the IPhotoRolls for the "List of Rolls" entries, in the order of
+    their first entry.
+
+    iPhoto 9.1.2 splits rolls into many small rolls with the same id, each
+    with a few images. The fragments are grouped by id first, and each group
+    is merged back into a single roll whose images are numbered once.
+    """
+    groups = {}
+    order = []
+    for data in roll_data:
+        roll = IPhotoRoll(data, images, ratings, aperture_data, time_table,
+                          assign_names=False)
+        fragments = groups.get(roll.albumid)
+        if fragments is None:
+            fragments = []
+            groups[roll.albumid] = fragments
+            order.append(roll.albumid)
+        fragments.append(roll)
+    rolls = []
+    for albumid in order:
+        fragments = groups[albumid]
+        fragments[0].merge_all(fragments[1:])
+        rolls.append(fragments[0])
+    return rolls
+
+
 class IPhotoAlbum(IPhotoContainer):
     """Describes an iPhoto Album."""
 
-    def __init__(self, data, images, ratings, album_map, root_album, aperture_data):
+    def __init__(self, data, images, ratings, album_map, root_album, aperture_data,
+                 time_table=None):
         IPhotoContainer.__init__(self, data.get("AlbumName"),
                                  data.get("Album Type") if data.has_key("Album Type") else "Regular",
-                                 data, images, ratings, aperture_data)
+                                 data, images, ratings, aperture_data,
+                                 time_table=time_table)
         self.albumid = data.get("AlbumId")
         if data.has_key("Master"):
             self.master = True
@@ -770,7 +1609,7 @@ class IPhotoFace(object):
         self.images = []
         self.albums = []
         self.comment = ""
-        self.date = datetime.datetime.now()
+        self._date = None
 
     def _getsize(self):
         return len(self.images)
@@ -791,15 +1630,123 @@ class IPhotoFace(object):
     def addimage(self, image):
         """Adds an image to this container."""
         self.images.append(image)
-        # Set the face date based on the earlierst image.
-        if image.date and image.date < self.date:
-            self.date = image.date
+        self._date = None
+
+    def getstats(self, stat_cache=None):
+        """Returns the ContainerStats of this face."""
+        return ContainerStats(self.images, stat_cache)
+
+    def _getdate(self):
+        # The face date is based on the earliest image, but never later than now.
+        if not self._date:
+            self._date = datetime.datetime.now()
+            image = get_oldest_image(self.images)
+            if image and image.date < self._date:
+                self._date = image.date
+        return self._date
+    date = property(_getdate, doc='date of face (based on oldest image)')
 
     def tostring(self):
         """Gets a string that describes this album or event."""
         return "%s (%s)" % (self.name, self.albumtype)
 
 
+class IPhotoQueryAlbum(IPhotoFace):
+    """An IPhotoContainer compatible class for the result of a query."""
+
+    def __init__(self, name, images):
+        IPhotoFace.__init__(self, name)
+        self.albumtype = "Query"
+        self.images = images
+
+
+class IPhotoPlace(IPhotoFace):
+    """An IPhotoContainer compatible class for a place."""
+
+    def __init__(self, latitude, longitude, images):
+        location = imageutils.GpsLocation(latitude, longitude)
+        IPhotoFace.__init__(self, u'%.3f %s %.3f %s' % (
+            abs(latitude), location.latitude_ref(), abs(longitude),
+            location.longitude_ref()))
+        self.albumtype = "Place"
+        self.location = location
+        self.images = images
+
+
+def get_oldest_image(images):
+    """Returns the image with the oldest date, or None if none of the images has
+    a date. Compares the packed time stamps if all images share a time table,
+    without building their datetime objects."""
+    return _get_date_extreme(images, newest=False)
+
+
+def get_newest_image(images):
+    """Returns the image with the newest date, or None if none of the images
+    has a date (see get_oldest_image())."""
+    return _get_date_extreme(images, newest=True)
+
+
+def _get_date_extreme(images, newest):
+    if not images:
+        return None
+    time_table = images[0].time_table
+    for image in images:
+        if image.time_table is not time_table:
+            break
+    else:
+        indices = [image.date_index for image in images]
+        if newest:
+            position = time_table.argmax(indices)
+        else:
+            position = time_table.argmin(indices)
+        return images[position] if position is not None else None
+    extreme = None
+    for image in images:
+        if image.date and (not extreme or (image.date > extreme.date if newest
+                                           else image.date < extreme.date)):
+            extreme = image
+    return extreme
+
+
+class ContainerStats(object):
+    """Statistics of the images of an album, event or face, computed in one
+    pass over the images.
+
+    File sizes are only computed with a StatCache (see
+    systemutils.StatCache), so a file that is in several containers is only
+    stat'ed once. Missing files count as 0 bytes.
+    """
+
+    def __init__(self, images, stat_cache=None):
+        self.image_count = len(images)
+        self.movie_count = 0
+        self.face_count = 0
+        self.original_count = 0
+        self.has_sizes = stat_cache is not None
+        self.image_bytes = 0  # all image files (edited versions, if any)
+        self.master_bytes = 0  # originals, or images that were not edited
+        self.preview_bytes = 0  # edited versions of images with originals
+        for image in images:
+            if image.ismovie():
+                self.movie_count += 1
+            self.face_count += len(image.getfaceids())
+            if image.originalpath:
+                self.original_count += 1
+            if stat_cache is None:
+                continue
+            image_size = stat_cache.getsize(image.image_path)
+            self.image_bytes += image_size
+            if image.originalpath:
+                self.master_bytes += stat_cache.getsize(image.originalpath)
+                self.preview_bytes += image_size
+            else:
+                self.master_bytes += image_size
+        oldest = get_oldest_image(images)
+        self.min_date = oldest.date if oldest else None
+        newest = get_newest_image(images)
+        self.max_date = newest.date if newest else None
+
+
 def get_album_xmlfile(library_dir):
     """Locates the iPhoto AlbumData.xml or Aperture ApertureData.xml file."""
     if os.path.exists(library_dir) and os.path.isdir(library_dir):
@@ -813,14 +1760,52 @@ def get_album_xmlfile(library_dir):
                        "library location.") % (library_dir)
 
 
-def get_iphoto_data(album_xml_file, ratings=None, verbose=False, aperture=False):
-    """reads the iPhoto database and converts it into an iPhotoData object."""
+def _is_aperture_version(application_version):
+    """Returns True if a library of an application version is read like an
+    Aperture library (Aperture 3, and iPhoto 9.x)."""
+    return (application_version.startswith('3.') or
+            application_version.startswith('9.'))
+
+
+def has_events_in_albums(album_xml_file, aperture=False):
+    """Returns True if a library lists its events in its "List of Albums",
+    like Aperture and iPhoto 9.x libraries, instead of in a "List of Rolls".
+    Only reads the start of the file; if the application version is not
+    there, returns True."""
+    if aperture or album_xml_file.endswith('ApertureData.xml'):
+        return True
+    application_version = applexml.read_application_version(album_xml_file)
+    return application_version is None or _is_aperture_version(
+        application_version)
+
+
+def get_iphoto_data(album_xml_file, ratings=None, verbose=False, aperture=False,
+                    lazy=False, projection=None, processes=1):
+    """reads the iPhoto database and converts it into an iPhotoData object.
+
+    If lazy is set, the entries of the Master Image List are only indexed, and
+    each image is parsed when it is first used (see LazyIPhotoImage). If set,
+    projection names the parts of the XML file that are not needed (see
+    applexml.make_projection()). If processes is not 1, the Master Image List
+    is parsed by that many worker processes (None for one per CPU).
+    """
     library_dir = os.path.dirname(album_xml_file)
     is_aperture = aperture or album_xml_file.endswith('ApertureData.xml')
     if verbose:
         print "Reading %s database from %s..." % (
             'Aperture' if is_aperture else 'iPhoto', album_xml_file)
-    album_xml = applexml.read_applexml_fixed(album_xml_file)
+    if lazy:
+        album_xml = applexml.read_applexml_indexed(album_xml_file,
+                                                   "Master Image List",
+                                                   projection=projection)
+    elif processes != 1:
+        album_xml = applexml.read_applexml_parallel(album_xml_file,
+                                                    "Master Image List",
+                                                    processes=processes,
+                                                    projection=projection)
+    else:
+        album_xml = applexml.read_applexml_streaming(album_xml_file,
+                                                     projection=projection)
 
     album_xml2 = None
     if is_aperture:
@@ -842,8 +1827,7 @@ def get_iphoto_data(album_xml_file, ratings=None, verbose=False, aperture=False)
     
     application_version = album_xml.get("Application Version")
         
-    if (application_version.startswith('3.')
-        or application_version.startswith('9.')):
+    if _is_aperture_version(application_version):
 	is_aperture = True
     data = IPhotoData(album_xml, album_xml2, ratings, is_aperture, aperture_data)
     if (not data.applicationVersion.startswith("9.") and
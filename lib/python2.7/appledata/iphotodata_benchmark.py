@@ -0,0 +1,147 @@
+"""Measures the memory used by IPhotoImage objects.
+
+Builds the images of a synthetic library in a child process, from Master Image
+List entries that are created one at a time and dropped right away, and
+reports the memory that the images keep (the total size of all objects
+reachable from them), and the peak resident memory of the process. For
+comparison, also reports the size of the raw entries.
+
+Usage: python -m appledata.iphotodata_benchmark [--images N[,N...]]
+"""
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import gc
+import os
+import random
+import resource
+import sys
+import time
+import types
+
+from optparse import OptionParser
+
+import appledata.applexml as applexml
+import appledata.iphotodata as iphotodata
+import appledata.librarygen as librarygen
+
+# Number of raw entries to measure the average size of a raw entry.
+_RAW_SAMPLE_SIZE = 1000
+
+# Objects that are shared with the rest of the program, and not counted.
+_SHARED_TYPES = (type, types.ClassType, types.ModuleType, types.FunctionType,
+                 types.BuiltinFunctionType)
+
+
+def _get_parsed_entry(value):
+    """Converts the numbers in a generated entry into strings, like
+    applexml.read_applexml() returns them."""
+    if isinstance(value, dict):
+        return dict([(key, _get_parsed_entry(item))
+                     for (key, item) in value.items()])
+    if isinstance(value, list):
+        return [_get_parsed_entry(item) for item in value]
+    if isinstance(value, (int, long, float)) and not isinstance(value, bool):
+        return unicode(value)
+    return value
+
+
+def get_object_graph_size(root):
+    """Returns the total size in bytes of all objects reachable from root."""
+    seen = set()
+    pending = [root]
+    size = 0
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen or isinstance(obj, _SHARED_TYPES):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        pending.extend(gc.get_referents(obj))
+    return size
+
+
+def _measure_images(images):
+    """Builds the IPhotoImage objects of a synthetic library. Returns the time
+    that took, the size of the images, and the peak resident memory, all in
+    bytes."""
+    spec = librarygen.LibrarySpec(images=images)
+    rand = random.Random(spec.seed)
+    keyword_map = dict([(unicode(i), u'Keyword %d' % (i))
+                        for i in xrange(spec.keywords)])
+    face_map = dict([(unicode(i), u'Person %d' % (i))
+                     for i in xrange(spec.faces)])
+    time_table = applexml.AppleTimeTable()
+    name_table = iphotodata.NameTable()
+    start = time.time()
+    image_list = []
+    for i in xrange(images):
+        image_list.append(iphotodata.IPhotoImage(
+            unicode(i), _get_parsed_entry(librarygen.make_image_entry(
+                spec, i, rand)), keyword_map, face_map, None, time_table,
+            name_table))
+    time_table.convert()
+    elapsed = time.time() - start
+    size = get_object_graph_size(image_list)
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on Mac OS X, and in kilobytes on Linux.
+    if sys.platform != 'darwin':
+        max_rss *= 1024
+    return (elapsed, size, max_rss)
+
+
+def _run_in_child(function, *args):
+    """Runs function in a child process, so each measurement starts with a
+    fresh heap. Returns the result of function."""
+    (read_fd, write_fd) = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        os.write(write_fd, repr(function(*args)))
+        os._exit(0)
+    os.close(write_fd)
+    result = ''
+    while True:
+        data = os.read(read_fd, 4096)
+        if not data:
+            break
+        result += data
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    return eval(result)
+
+
+def main(args):
+    parser = OptionParser()
+    parser.add_option('--images', default='100000,1000000',
+                      help='Comma separated list of library sizes to measure.')
+    (options, _) = parser.parse_args(args)
+
+    spec = librarygen.LibrarySpec(images=_RAW_SAMPLE_SIZE)
+    rand = random.Random(spec.seed)
+    raw_size = get_object_graph_size([
+        _get_parsed_entry(librarygen.make_image_entry(spec, i, rand))
+        for i in xrange(_RAW_SAMPLE_SIZE)])
+    print 'Raw Master Image List entry: %d bytes per image' % (
+        raw_size / _RAW_SAMPLE_SIZE)
+    for images in [int(size) for size in options.images.split(',')]:
+        (elapsed, size, max_rss) = _run_in_child(_measure_images, images)
+        print ('%8d images: %6.2f s, %8.1f MB (%5d bytes per image), '
+               '%8.1f MB peak' % (images, elapsed, size / 1024.0 / 1024.0,
+                                  size / images, max_rss / 1024.0 / 1024.0))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -14,9 +14,61 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import copy
+import datetime
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 
+import appledata.applexml as applexml
 import appledata.iphotodata as iphotodata
+import tilutil.systemutils as su
+
+def _make_image(caption, path, keywords=None, faces=None, mod_date='0'):
+    """Returns the AlbumData.xml dictionary for an image."""
+    image = {'Caption': caption, 'ImagePath': path,
+             'DateAsTimerInterval': '300000000.0',
+             'ModDateAsTimerInterval': mod_date}
+    if keywords:
+        image['Keywords'] = keywords
+    if faces:
+        image['Faces'] = [{'face key': face,
+                           'rectangle': '{{0.%d, 0.2}, {0.1, 0.1}}' % (i)}
+                          for (i, face) in enumerate(faces)]
+    return image
+
+def _make_library():
+    """Returns the AlbumData.xml data tree of a small library."""
+    return {
+        'Application Version': '8.1.2',
+        'List of Keywords': {'1': 'Beach', '2': 'Hidden'},
+        'List of Faces': {'f1': {'key': 'f1', 'name': 'Jane'},
+                          'f2': {'key': 'f2', 'name': 'John'}},
+        'Master Image List': {
+            '10': _make_image('a', '/L/Masters/a.jpg', ['1'], ['f1']),
+            '11': _make_image('b', '/L/Masters/b.jpg', None, ['f1', 'f2']),
+            '12': _make_image('c', '/L/Masters/c.mov'),
+            '13': _make_image('d', '/L/Masters/d.jpg', ['1', '2']),
+        },
+        'List of Albums': [
+            {'AlbumId': '1', 'AlbumName': 'Photos', 'Master': True,
+             'KeyList': ['10', '11', '12', '13']},
+            {'AlbumId': '2', 'AlbumName': 'Beach', 'Album Type': 'Regular',
+             'KeyList': ['10', '13']},
+        ],
+        'List of Rolls': [
+            {'RollID': '5', 'RollName': 'Summer', 'KeyList': ['10', '11']},
+            {'RollID': '6', 'RollName': 'Fall', 'KeyList': ['12', '13']},
+        ],
+    }
+
+def _make_iphoto_data(library):
+    """Returns an IPhotoData object for an AlbumData.xml data tree."""
+    return iphotodata.IPhotoData(library, None, None, False, None)
 
 class IPhotoDataTest(unittest.TestCase):
     """Unit tests for iphotodata.py code."""
@@ -40,5 +92,383 @@ class IPhotoDataTest(unittest.TestCase):
             '/Volumes/Backup750/Aperture Library.aplibrary/'
             'Masters/2010/11/25/20101125-003412')
 
+    def test_aperture_masters_index(self):
+        """Tests locating masters with an ApertureMastersIndex."""
+        folder = tempfile.mkdtemp()
+        try:
+            masters = os.path.join(folder, u'Masters')
+            for (path, name) in ((u'a', u'IMG_1.jpg'), (u'a', u'IMG_2.CR2'),
+                                 (u'a/x', u'IMG_3.tif'),
+                                 (u'a/y', u'IMG_3.psd'),
+                                 (u'a/y', u'IMG_1.jpg'),
+                                 (u'a', u'v1.2.nef'), (u'b', u'IMG_1.png'),
+                                 (u'a/x', u'IMG_4.tif'),
+                                 (u'a', u'IMG_4.JPG')):
+                path = os.path.join(masters, path)
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+                open(os.path.join(path, name), 'w').close()
+            a_path = os.path.join(masters, u'a')
+            b_path = os.path.join(masters, u'b')
+            missing_path = os.path.join(masters, u'c')
+            stat_cache = su.StatCache()
+            index = iphotodata.ApertureMastersIndex(
+                [a_path, b_path, missing_path, a_path], threads=2,
+                stat_cache=stat_cache)
+            # The folders and files were stat'ed through the cache.
+            syscalls = stat_cache.syscalls
+            self.assertTrue(syscalls > 0)
+            iphotodata.ApertureMastersIndex([a_path, b_path, missing_path],
+                                            stat_cache=stat_cache)
+            self.assertEquals(syscalls, stat_cache.syscalls)
+            self.assertEquals(os.path.join(a_path, u'IMG_1.jpg'),
+                              index.find(a_path, u'IMG_1'))
+            self.assertEquals(os.path.join(a_path, u'IMG_2.CR2'),
+                              index.find(a_path, u'IMG_2'))
+            # Subfolders are searched in order.
+            self.assertEquals(os.path.join(a_path, u'x', u'IMG_3.tif'),
+                              index.find(a_path, u'IMG_3'))
+            self.assertEquals(os.path.join(a_path, u'v1.2.nef'),
+                              index.find(a_path, u'v1'))
+            self.assertEquals(os.path.join(a_path, u'v1.2.nef'),
+                              index.find(a_path, u'v1.2'))
+            self.assertEquals(None, index.find(a_path, u'IMG'))
+            # .jpg masters are found in any case, like on HFS+.
+            self.assertEquals(os.path.join(a_path, u'IMG_4.JPG'),
+                              index.find(a_path, u'IMG_4'))
+            self.assertEquals(os.path.join(b_path, u'IMG_1.png'),
+                              index.find(b_path, u'IMG_1'))
+            self.assertTrue(index.has_folder(b_path))
+            self.assertFalse(index.has_folder(missing_path))
+            self.assertEquals(None, index.find(missing_path, u'IMG_1'))
+        finally:
+            shutil.rmtree(folder)
+
+    def test_get_diff(self):
+        """Tests IPhotoData.get_diff()."""
+        library = _make_library()
+        previous = _make_iphoto_data(copy.deepcopy(library))
+        diff = _make_iphoto_data(library).get_diff(previous)
+        self.assertEquals(set(), diff.changed_images)
+        self.assertEquals(set(), diff.changed_albums | diff.changed_rolls)
+
+        images = library['Master Image List']
+        images['11']['ModDateAsTimerInterval'] = '1'
+        images['13']['Keywords'] = ['2']
+        images['14'] = _make_image('e', '/L/Masters/e.jpg', None, ['f2'])
+        del images['12']
+        library['List of Albums'][0]['KeyList'] = ['10', '11', '13', '14']
+        library['List of Rolls'][1]['KeyList'] = ['13', '14']
+        data = _make_iphoto_data(library)
+        diff = data.get_diff(previous)
+        self.assertEquals(set(['14']), diff.added_images)
+        self.assertEquals(set(['12']), diff.removed_images)
+        self.assertEquals(set(['11', '13']), diff.modified_images)
+        self.assertEquals(set(['1']), diff.changed_albums)
+        self.assertEquals(set(['6']), diff.changed_rolls)
+        self.assertEquals(set([u'John']), diff.changed_faces)
+        self.assertTrue(diff.is_changed_container(data.getroll('6')))
+        self.assertFalse(diff.is_changed_container(data.getroll('5')))
+        self.assertTrue(diff.is_changed_image(data.images_by_id['11']))
+        self.assertFalse(diff.is_changed_image(data.images_by_id['10']))
+
+    def test_lookup_index(self):
+        """Tests the ImageLookupIndex, and updating it for a diff."""
+        library = _make_library()
+        images = library['Master Image List']
+        images['11']['ThumbPath'] = '/L/Thumbs/b.jpg'
+        images['12']['ImagePath'] = '/L/Masters/x/a.mov'
+        previous = _make_iphoto_data(copy.deepcopy(library))
+        self.assertEquals(['10', '12'], sorted(
+            [image.id for image in previous.getbaseimages(u'a')]))
+        self.assertEquals(None, previous.getbaseimages(u'z'))
+        self.assertEquals('13', previous.getnamedimage(u'd.jpg').id)
+        self.assertEquals('11', previous.getpathimage('/L/Thumbs/b.jpg').id)
+        self.assertEquals('10', previous.getpathimage('/L/Masters/a.jpg').id)
+        self.assertEquals(None, previous.getpathimage('/L/Masters/z.jpg'))
+        self.assertEquals(5, len(previous.getallimages()))
+        # Survives pickling, like in a snapshot.
+        previous = pickle.loads(pickle.dumps(previous, 2))
+
+        images['11']['ThumbPath'] = '/L/Thumbs/b2.jpg'
+        images['13']['ImagePath'] = '/L/Masters/a.png'
+        images['14'] = _make_image('e', '/L/Masters/e.jpg')
+        del images['12']
+        data = _make_iphoto_data(library)
+        data.update_lookup_index(previous, data.get_diff(previous))
+        updated = data.get_lookup_index()
+        expected = iphotodata.ImageLookupIndex(data.images_by_id.values())
+        self.assertEquals(len(expected), len(updated))
+        for kind in (iphotodata.KEY_IMAGE_PATH, iphotodata.KEY_THUMB_PATH,
+                     iphotodata.KEY_ORIGINAL_PATH, iphotodata.KEY_FILE_NAME,
+                     iphotodata.KEY_BASE_NAME):
+            self.assertEquals(
+                sorted([(key, sorted(ids)) for (key, ids) in
+                        expected.getitems(kind)]),
+                sorted([(key, sorted(ids)) for (key, ids) in
+                        updated.getitems(kind)]))
+        self.assertEquals(['10', '13'], sorted(
+            [image.id for image in data.getbaseimages(u'a')]))
+        self.assertEquals(None, data.getpathimage('/L/Thumbs/b.jpg'))
+        self.assertEquals('11', data.getpathimage('/L/Thumbs/b2.jpg').id)
+
+    def test_dates(self):
+        """Tests the packed image dates."""
+        library = _make_library()
+        images = library['Master Image List']
+        del images['10']['DateAsTimerInterval']
+        images['10']['Caption'] = '20050102 a'
+        images['11']['DateAsTimerInterval'] = '100.0'
+        images['12']['DateAsTimerInterval'] = 'bad'
+        data = _make_iphoto_data(library)
+        self.assertEquals(datetime.datetime(2005, 1, 2),
+                          data.images_by_id['10'].date)
+        self.assertEquals(datetime.datetime.fromtimestamp(
+            applexml.APPLE_BASE + 100), data.images_by_id['11'].date)
+        self.assertEquals(['11', '10', '13', '12'], [
+            image.id for image in data.sort_images_by_date()])
+        self.assertEquals(['10', '13'], [
+            image.id for image in data.get_images_by_date(
+                datetime.datetime(2005, 1, 2), datetime.datetime(2012, 1, 1))])
+        self.assertEquals(['11'], [
+            image.id for image in data.get_images_by_date(
+                end=datetime.datetime(2005, 1, 2))])
+        # Events without a date use their oldest image.
+        self.assertEquals(data.images_by_id['11'].date, data.getroll('5').date)
+        self.assertEquals(data.images_by_id['13'].date, data.getroll('6').date)
+
+    def test_compact_image(self):
+        """Tests that IPhotoImage keeps its data in slots, without the raw
+        entry."""
+        library = _make_library()
+        library['Master Image List']['12']['MediaType'] = 'Movie'
+        data = _make_iphoto_data(library)
+        image = data.images_by_id['11']
+        self.assertFalse(hasattr(image, '__dict__'))
+        self.assertFalse(hasattr(image, 'data'))
+        self.assertFalse('Master Image List' in data.data)
+        self.assertEquals([u'Jane', u'John'], image.getfaces())
+        self.assertEquals(2, len(image.face_rectangles))
+        self.assertEquals(4, len(image.face_rectangles[0]))
+        self.assertEquals(['Beach', 'Hidden'],
+                          data.images_by_id['13'].keywords)
+        self.assertTrue(data.images_by_id['13'].ishidden())
+        self.assertTrue(data.images_by_id['12'].ismovie())
+        self.assertFalse(image.ismovie())
+        image.addface(u'Jim')
+        self.assertEquals([u'Jane', u'John', u'Jim'], image.faces)
+
+        copied = pickle.loads(pickle.dumps(data, pickle.HIGHEST_PROTOCOL))
+        self.assertEquals(image.keywords, copied.images_by_id['11'].keywords)
+        self.assertEquals(image.faces, copied.images_by_id['11'].faces)
+        self.assertEquals(image.date, copied.images_by_id['11'].date)
+
+    def test_membership_index(self):
+        """Tests that images know the albums, events and faces that contain
+        them."""
+        data = _make_iphoto_data(_make_library())
+        image = data.images_by_id['10']
+        self.assertEquals(['Beach', 'Photos'],
+                          sorted([album.name for album in image.albums]))
+        self.assertEquals(['Beach', 'Photos', 'Summer'],
+                          sorted([c.name for c in image.getcontainers()]))
+        data.getfacealbums()
+        self.assertEquals(4, image.getcontainercount())
+        self.assertEquals(4, data.images_by_id['11'].getcontainercount())
+
+        exported = [data.getroll('5')] + [album for album in data.albums.values()
+                                          if album.name == 'Beach']
+        data.membership.set_exported(exported)
+        self.assertEquals(2, data.membership.get_export_count(image))
+        self.assertEquals(1, data.membership.get_export_count(
+            data.images_by_id['11']))
+        self.assertEquals(0, data.membership.get_export_count(
+            data.images_by_id['12']))
+
+        copied = pickle.loads(pickle.dumps(data, pickle.HIGHEST_PROTOCOL))
+        copied_image = copied.images_by_id['10']
+        self.assertEquals(4, copied_image.getcontainercount())
+        copied.membership.add_container(copied.getroll('5'))
+        self.assertEquals(4, copied_image.getcontainercount())
+
+    def test_container_stats(self):
+        """Tests IPhotoContainer.getstats()."""
+        folder = tempfile.mkdtemp()
+        try:
+            library = _make_library()
+            sizes = {'a.jpg': 100, 'b.jpg': 20, 'b-original.jpg': 300}
+            for (name, size) in sizes.items():
+                out = open(os.path.join(folder, name), 'w')
+                out.write('x' * size)
+                out.close()
+            images = library['Master Image List']
+            images['10']['ImagePath'] = os.path.join(folder, 'a.jpg')
+            images['11']['ImagePath'] = os.path.join(folder, 'b.jpg')
+            images['11']['OriginalPath'] = os.path.join(folder,
+                                                        'b-original.jpg')
+            images['10']['DateAsTimerInterval'] = '200000000.0'
+            images['12']['MediaType'] = 'Movie'
+            data = _make_iphoto_data(library)
+            stat_cache = su.StatCache()
+            summer = data.getroll('5')
+            stats = summer.getstats(stat_cache)
+            self.assertEquals(2, stats.image_count)
+            self.assertEquals(3, stats.face_count)
+            self.assertEquals(1, stats.original_count)
+            self.assertEquals(0, stats.movie_count)
+            self.assertEquals(120, stats.image_bytes)
+            self.assertEquals(400, stats.master_bytes)
+            self.assertEquals(20, stats.preview_bytes)
+            self.assertEquals(data.images_by_id['10'].date, stats.min_date)
+            self.assertEquals(data.images_by_id['11'].date, stats.max_date)
+            self.assertTrue(stats is summer.getstats())
+            self.assertEquals(1, data.getroll('6').getstats().movie_count)
+
+            # The cache has the sizes; the files are not stat'ed again.
+            for name in sizes:
+                os.remove(os.path.join(folder, name))
+            self.assertEquals(400, iphotodata.ContainerStats(
+                summer.images, stat_cache).master_bytes)
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    def test_split_rolls(self):
+        """Tests that rolls split by iPhoto 9.1.2 are merged, with the images
+        numbered once."""
+        library = _make_library()
+        library['List of Rolls'] = [
+            {'RollID': '5', 'RollName': 'Summer', 'KeyList': ['10']},
+            {'RollID': '6', 'RollName': 'Fall', 'KeyList': ['12']},
+            {'RollID': '5', 'RollName': 'Summer', 'KeyList': ['11']},
+            {'RollID': '5', 'RollName': 'Summer', 'KeyList': ['13']},
+        ]
+        data = _make_iphoto_data(library)
+        self.assertEquals(['5', '6'], [roll.albumid for roll in
+                                       data.root_album.albums
+                                       if roll.albumtype == 'Event'])
+        summer = data.getroll('5')
+        self.assertEquals(['10', '11', '13'],
+                          [image.id for image in summer.images])
+        self.assertEquals([1, 2, 3], [image.event_index
+                                      for image in summer.images])
+        self.assertEquals(['Summer'] * 3, [image.event_name
+                                           for image in summer.images])
+        self.assertEquals(1, data.images_by_id['12'].event_index)
+
+    def test_face_index(self):
+        """Tests that the face index is built with the images."""
+        library = _make_library()
+        library['Master Image List']['12']['Faces'] = [
+            {'face key': 'f2', 'rectangle': '{{0.1, 0.2}, {0.1, 0.1}}'}]
+        data = _make_iphoto_data(library)
+        face_index = data.face_index
+        self.assertEquals([u'Jane', u'John'], sorted(face_index.getfaces()))
+        self.assertEquals(2, face_index.getcount(u'Jane'))
+        self.assertEquals(['10', '11'], sorted(
+            [image.id for image in face_index.getimages(u'Jane')]))
+        self.assertEquals(1, face_index.getcooccurrence(u'John', u'Jane'))
+        self.assertEquals([(u'John', 1)], face_index.getcooccurring(u'Jane'))
+        self.assertEquals(0, face_index.getcount(u'Nobody'))
+        self.assertEquals(0, face_index.getcooccurrence(u'Jane', u'Nobody'))
+
+        face_albums = data.getfacealbums()
+        self.assertEquals([2, 2], [album.size for album in face_albums])
+        copied = pickle.loads(pickle.dumps(data, pickle.HIGHEST_PROTOCOL))
+        self.assertEquals(2, copied.face_index.getcount(u'John'))
+
+        # A library without faces builds its (empty) face albums once.
+        library = _make_library()
+        del library['List of Faces']
+        for image in library['Master Image List'].values():
+            image.pop('Faces', None)
+        data = _make_iphoto_data(library)
+        self.assertEquals([], data.getfacealbums())
+        self.assertTrue(data.face_albums is not None)
+        data.face_index = None
+        self.assertEquals([], data.getfacealbums())
+        self.assertTrue(data.face_index is None)
+
+    def test_place_albums(self):
+        """Tests IPhotoData.getplacealbums()."""
+        library = _make_library()
+        for (key, latitude, longitude) in (('10', 37.77, -122.42),
+                                           ('11', 37.78, -122.41),
+                                           ('13', 48.85, 2.35)):
+            library['Master Image List'][key]['latitude'] = str(latitude)
+            library['Master Image List'][key]['longitude'] = str(longitude)
+        data = _make_iphoto_data(library)
+        places = data.getplacealbums(radius_km=5.0)
+        self.assertEquals([2, 1], [place.size for place in places])
+        self.assertEquals(u'37.775 N 122.415 W', places[0].name)
+        self.assertEquals('Place', places[0].albumtype)
+        self.assertTrue(places[0] in data.images_by_id['10'].getcontainers())
+        self.assertTrue(places is data.getplacealbums(radius_km=5.0))
+        self.assertEquals(1, len(data.getplacealbums(radius_km=5.0,
+                                                     min_images=2)))
+        # Asking again does not add more containers.
+        containers = len(data.membership.containers)
+        image_containers = len(data.images_by_id['10'].getcontainers())
+        for _ in xrange(3):
+            self.assertTrue(places is data.getplacealbums(radius_km=5.0))
+            data.getplacealbums(radius_km=5.0, min_images=2)
+        self.assertEquals(containers, len(data.membership.containers))
+        self.assertEquals(image_containers,
+                          len(data.images_by_id['10'].getcontainers()))
+
+    def test_addalbum(self):
+        """Tests that IPhotoImage.addalbum() uses the index of the
+        library."""
+        data = _make_iphoto_data(_make_library())
+        image = data.images_by_id['10']
+        album = iphotodata.IPhotoPlace(0.0, 0.0, [image])
+        image.addalbum(album)
+        self.assertTrue(album in image.getcontainers())
+        self.assertTrue(album in data.membership.containers)
+        image = iphotodata.IPhotoImage('99', {}, {}, {}, None)
+        self.assertRaises(ValueError, image.addalbum, album)
+        image.addalbum(album, data.membership)
+        self.assertTrue(image.membership is data.membership)
+
+    def test_lazy_iphoto_image(self):
+        """Tests that a LazyIPhotoImage loads its data on first use."""
+        library = _make_library()
+        image_data = library['Master Image List']
+        image = iphotodata.LazyIPhotoImage('11', image_data,
+                                           library['List of Keywords'],
+                                           {'f1': 'Jane', 'f2': 'John'}, None)
+        self.assertTrue('_lazy_args' in image.__dict__)
+        image.event_name = 'Summer'
+        image.event_index = 2
+        self.assertEquals('b', image.caption)
+        self.assertFalse('_lazy_args' in image.__dict__)
+        self.assertEquals([u'Jane', u'John'], image.getfaces())
+        self.assertEquals('Summer', image.event_name)
+        self.assertEquals(2, image.event_index)
+        self.assertRaises(AttributeError, getattr, image, 'no_such_attribute')
+
+    def test_lazy_iphoto_image_threads(self):
+        """Tests that threads reading a LazyIPhotoImage while it loads wait
+        for it."""
+        library = _make_library()
+
+        class SlowImageData(object):
+            """Image entries that take a while to parse."""
+
+            def get(self, key):
+                time.sleep(0.05)
+                return library['Master Image List'].get(key)
+
+        image = iphotodata.LazyIPhotoImage('11', SlowImageData(),
+                                           library['List of Keywords'],
+                                           {'f1': 'Jane', 'f2': 'John'}, None)
+        captions = []
+        threads = [threading.Thread(target=lambda: captions.append(
+            image.caption)) for _ in xrange(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(['b'] * 4, captions)
+
 if __name__ == '__main__':
     unittest.main()
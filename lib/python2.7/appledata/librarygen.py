@@ -0,0 +1,314 @@
+"""Generates synthetic iPhoto and Aperture libraries for benchmarks and tests.
+
+Writes an AlbumData.xml (iPhoto) or ApertureData.xml (Aperture) file with a
+configurable number of images, events, albums, faces and keywords. Images can
+carry <data> blobs, and a fraction of them can have stray 0x00 characters in
+their captions, like some real AlbumData.xml files do. The file is written
+image by image, so libraries with millions of images can be generated without
+holding them in memory. The same seed always generates the same library.
+
+Usage: python -m appledata.librarygen [options] output_file
+"""
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import random
+import sys
+
+from optparse import OptionParser
+from xml.sax import saxutils
+
+_BLOB_LINE = 'AQEAAwAAAAIAAAAZAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA'
+
+# Apple time stamp of the first image (2010-07-01).
+_FIRST_DATE = 299635200.0
+
+_IPHOTO_VERSION = u'8.1.2'
+_APERTURE_VERSION = u'3.4.5'
+
+
+class Blob(object):
+    """A value that is written as a <data> element."""
+
+    def __init__(self, lines):
+        self.lines = lines
+
+
+class LibrarySpec(object):
+    """Describes the size and shape of a synthetic library."""
+
+    def __init__(self, images=1000, events=None, albums=10, faces=20,
+                 keywords=50, blob_lines=0, nul_rate=0.0, aperture=False,
+                 roll_fragments=1, seed=0):
+        self.images = images
+        # About 100 images per event, like a typical iPhoto library.
+        self.events = events if events else max(1, images / 100)
+        self.albums = albums
+        self.faces = faces
+        self.keywords = keywords
+        self.blob_lines = blob_lines
+        self.nul_rate = nul_rate
+        self.aperture = bool(aperture)
+        # iPhoto 9.1.2 splits events into many rolls with the same id.
+        self.roll_fragments = roll_fragments
+        self.seed = seed
+
+    def todict(self):
+        """Returns the spec as a dictionary, e.g. for JSON output."""
+        return dict(self.__dict__)
+
+    def get_event(self, image):
+        """Returns the index of the event that contains an image."""
+        return image * self.events / self.images
+
+
+def make_image_entry(spec, image, rand):
+    """Returns the Master Image List entry of an image, like
+    applexml.read_applexml() returns it."""
+    event = spec.get_event(image)
+    folder = u'/Users/Shared/Library/Masters/2010/%02d/%02d/Event %d' % (
+        event % 12 + 1, event % 28 + 1, event)
+    date = _FIRST_DATE + image * 600.0
+    movie = rand.random() < 0.05
+    extension = u'MOV' if movie else u'JPG'
+    caption = u'IMG_%06d' % (image)
+    if rand.random() < spec.nul_rate:
+        caption += u'\000'
+    entry = {
+        'Caption': caption,
+        'Comment': u'Comment for image %d' % (image) if image % 10 == 0 else u'',
+        'GUID': u'%08X-%04X-%04X-%04X-%012X' % (image, event, 0, 0, image),
+        'Roll': event,
+        'Rating': rand.randint(0, 5),
+        'MediaType': u'Movie' if movie else u'Image',
+        'ImagePath': u'%s/IMG_%06d.%s' % (folder, image, extension),
+        'ThumbPath': u'%s/IMG_%06d.jpg' % (
+            folder.replace(u'/Masters/', u'/Thumbnails/'), image),
+        'DateAsTimerInterval': date,
+        'ModDateAsTimerInterval': date + 3600.0,
+        'MetaModDateAsTimerInterval': date + 3600.0,
+        'Aspect Ratio': 1.5,
+    }
+    if rand.random() < 0.2:
+        # Edited images have the original in a separate file.
+        entry['OriginalPath'] = entry['ImagePath']
+        entry['ImagePath'] = entry['ImagePath'].replace(u'/Masters/', u'/Previews/')
+    if spec.keywords:
+        entry['Keywords'] = [unicode(rand.randrange(spec.keywords))
+                             for _ in xrange(rand.randint(0, 3))]
+    if spec.faces and rand.random() < 0.3:
+        entry['Faces'] = [{
+            'face key': rand.randrange(spec.faces),
+            'face index': index,
+            'rectangle': u'{{%.6f, %.6f}, {0.100000, 0.150000}}' % (
+                rand.random() * 0.9, rand.random() * 0.85)}
+                          for index in xrange(rand.randint(1, 3))]
+    if rand.random() < 0.3:
+        entry['latitude'] = 37.0 + rand.random()
+        entry['longitude'] = -122.0 - rand.random()
+    if spec.blob_lines:
+        entry['Blob'] = Blob(spec.blob_lines)
+    return entry
+
+
+def _write_value(out, value, indent):
+    """Writes a value as an Apple XML element."""
+    tabs = '\t' * indent
+    if isinstance(value, dict):
+        out.write('%s<dict>\n' % (tabs))
+        for key in sorted(value.keys()):
+            out.write('%s\t<key>%s</key>\n' % (tabs, saxutils.escape(key)))
+            _write_value(out, value[key], indent + 1)
+        out.write('%s</dict>\n' % (tabs))
+    elif isinstance(value, list):
+        out.write('%s<array>\n' % (tabs))
+        for item in value:
+            _write_value(out, item, indent + 1)
+        out.write('%s</array>\n' % (tabs))
+    elif isinstance(value, bool):
+        out.write('%s<%s/>\n' % (tabs, 'true' if value else 'false'))
+    elif isinstance(value, (int, long)):
+        out.write('%s<integer>%d</integer>\n' % (tabs, value))
+    elif isinstance(value, float):
+        out.write('%s<real>%f</real>\n' % (tabs, value))
+    elif isinstance(value, Blob):
+        out.write('%s<data>\n' % (tabs))
+        for _ in xrange(value.lines):
+            out.write('%s%s\n' % (tabs, _BLOB_LINE))
+        out.write('%s</data>\n' % (tabs))
+    else:
+        out.write('%s<string>%s</string>\n' % (
+            tabs, saxutils.escape(value).encode('utf-8')))
+
+
+def _write_key_value(out, key, value, indent):
+    out.write('%s<key>%s</key>\n' % ('\t' * indent, key))
+    _write_value(out, value, indent)
+
+
+def _write_key_list(out, image_ids, indent):
+    """Writes a KeyList array, without building the list of strings."""
+    tabs = '\t' * indent
+    out.write('%s<array>\n' % (tabs))
+    for image in image_ids:
+        out.write('%s\t<string>%d</string>\n' % (tabs, image))
+    out.write('%s</array>\n' % (tabs))
+
+
+def write_library(out, spec):
+    """Writes the XML file of a synthetic library to out."""
+    rand = random.Random(spec.seed)
+    out.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+              '<plist version="1.0">\n<dict>\n')
+    _write_key_value(out, 'Application Version',
+                     _APERTURE_VERSION if spec.aperture else _IPHOTO_VERSION, 1)
+    _write_key_value(out, 'Archive Path', u'/Users/Shared/Library', 1)
+    _write_key_value(out, 'List of Keywords', dict([
+        (unicode(i), u'Keyword %d' % (i)) for i in xrange(spec.keywords)]), 1)
+    _write_key_value(out, 'List of Faces', dict([
+        (unicode(i), {'key': i, 'name': u'Person %d' % (i), 'PhotoCount': 0,
+                      'Order': i})
+        for i in xrange(spec.faces)]), 1)
+
+    out.write('\t<key>Master Image List</key>\n\t<dict>\n')
+    for image in xrange(spec.images):
+        out.write('\t\t<key>%d</key>\n' % (image))
+        _write_value(out, make_image_entry(spec, image, rand), 2)
+    out.write('\t</dict>\n')
+
+    out.write('\t<key>List of Albums</key>\n\t<array>\n')
+    out.write('\t\t<dict>\n')
+    _write_key_value(out, 'AlbumId', 1, 3)
+    _write_key_value(out, 'AlbumName', u'Photos', 3)
+    if spec.aperture:
+        _write_key_value(out, 'Album Type', u'99', 3)
+    else:
+        _write_key_value(out, 'Master', True, 3)
+    out.write('\t\t\t<key>KeyList</key>\n')
+    _write_key_list(out, xrange(spec.images), 3)
+    out.write('\t\t</dict>\n')
+    _write_albums(out, spec, rand)
+    if spec.aperture:
+        # Aperture lists its projects (events) with the albums.
+        _write_events(out, spec, 2000, {'Album Type': u'4'}, 'AlbumId',
+                      'AlbumName')
+    out.write('\t</array>\n')
+
+    if not spec.aperture:
+        out.write('\t<key>List of Rolls</key>\n\t<array>\n')
+        _write_events(out, spec, 0, {}, 'RollID', 'RollName',
+                      spec.roll_fragments)
+        out.write('\t</array>\n')
+    out.write('</dict>\n</plist>\n')
+
+
+def _write_albums(out, spec, rand):
+    """Writes the regular albums, in a folder, with random images."""
+    if not spec.albums:
+        return
+    out.write('\t\t<dict>\n')
+    _write_key_value(out, 'AlbumId', 2, 3)
+    _write_key_value(out, 'AlbumName', u'Albums', 3)
+    _write_key_value(out, 'Album Type', u'6' if spec.aperture else u'Folder', 3)
+    out.write('\t\t</dict>\n')
+    for album in xrange(spec.albums):
+        size = min(spec.images, rand.randint(1, 200))
+        out.write('\t\t<dict>\n')
+        _write_key_value(out, 'AlbumId', 1000 + album, 3)
+        _write_key_value(out, 'AlbumName', u'Album %d' % (album), 3)
+        _write_key_value(out, 'Album Type', u'1' if spec.aperture else u'Regular', 3)
+        _write_key_value(out, 'Parent', 2, 3)
+        _write_key_value(out, 'Comments', u'Comment for album %d' % (album), 3)
+        out.write('\t\t\t<key>KeyList</key>\n')
+        _write_key_list(out, sorted(rand.sample(xrange(spec.images), size)), 3)
+        out.write('\t\t</dict>\n')
+
+
+def _write_events(out, spec, first_id, extra_keys, id_key, name_key,
+                  fragments=1):
+    """Writes the events, each with a consecutive range of images. Each event
+    is split into the given number of fragments with the same id."""
+    image = 0
+    for event in xrange(spec.events):
+        start = image
+        while image < spec.images and spec.get_event(image) == event:
+            image += 1
+        for fragment in xrange(fragments):
+            out.write('\t\t<dict>\n')
+            _write_key_value(out, id_key, first_id + event, 3)
+            _write_key_value(out, name_key, u'Event %d' % (event), 3)
+            for (key, value) in extra_keys.items():
+                _write_key_value(out, key, value, 3)
+            _write_key_value(out, 'RollDateAsTimerInterval',
+                             _FIRST_DATE + start * 600.0, 3)
+            _write_key_value(out, 'uuid', u'event-uuid-%d' % (event), 3)
+            out.write('\t\t\t<key>KeyList</key>\n')
+            _write_key_list(out, xrange(
+                start + (image - start) * fragment / fragments,
+                start + (image - start) * (fragment + 1) / fragments), 3)
+            out.write('\t\t</dict>\n')
+
+
+def add_spec_options(parser):
+    """Adds the options for a LibrarySpec to an OptionParser."""
+    parser.add_option('--events', type='int', default=None,
+                      help='Number of events (default: one per 100 images).')
+    parser.add_option('--albums', type='int', default=10,
+                      help='Number of regular albums.')
+    parser.add_option('--faces', type='int', default=20,
+                      help='Number of named faces.')
+    parser.add_option('--keywords', type='int', default=50,
+                      help='Number of keywords.')
+    parser.add_option('--blob_lines', type='int', default=0,
+                      help='Number of base64 lines in a <data> blob per image.')
+    parser.add_option('--nul_rate', type='float', default=0.0,
+                      help='Fraction of images with a 0x00 in their caption.')
+    parser.add_option('--aperture', action='store_true',
+                      help='Generate an Aperture ApertureData.xml file.')
+    parser.add_option('--roll_fragments', type='int', default=1,
+                      help='Number of rolls each iPhoto event is split into, '
+                      'like iPhoto 9.1.2 does.')
+    parser.add_option('--seed', type='int', default=0,
+                      help='Seed for the random number generator.')
+
+
+def get_spec(options, images):
+    """Returns the LibrarySpec for options added by add_spec_options()."""
+    return LibrarySpec(images=images, events=options.events,
+                       albums=options.albums, faces=options.faces,
+                       keywords=options.keywords,
+                       blob_lines=options.blob_lines,
+                       nul_rate=options.nul_rate, aperture=options.aperture,
+                       roll_fragments=options.roll_fragments,
+                       seed=options.seed)
+
+
+def main(args):
+    parser = OptionParser(usage='%prog [options] output_file')
+    parser.add_option('--images', type='int', default=1000,
+                      help='Number of images.')
+    add_spec_options(parser)
+    (options, args) = parser.parse_args(args)
+    if len(args) != 1:
+        parser.error('Specify the output file.')
+    out = open(args[0], 'w')
+    try:
+        write_library(out, get_spec(options, options.images))
+    finally:
+        out.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
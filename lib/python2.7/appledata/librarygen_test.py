@@ -0,0 +1,78 @@
+"""This module tests appledata/librarygen.py."""
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import appledata.iphotodata as iphotodata
+import appledata.librarygen as librarygen
+
+
+class LibraryGenTest(unittest.TestCase):
+    """Unit tests for librarygen.py code."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def _read_library(self, spec, file_name):
+        xml_file = os.path.join(self.folder, file_name)
+        out = open(xml_file, 'w')
+        librarygen.write_library(out, spec)
+        out.close()
+        return iphotodata.get_iphoto_data(xml_file)
+
+    def test_iphoto_library(self):
+        """Tests that a generated iPhoto library can be read."""
+        spec = librarygen.LibrarySpec(images=250, albums=3, faces=5,
+                                      blob_lines=2, nul_rate=0.5)
+        data = self._read_library(spec, 'AlbumData.xml')
+        self.assertFalse(data.aperture)
+        self.assertEquals(250, len(data.images))
+        self.assertEquals(2, len(data.rolls))
+        self.assertEquals(125, data.getroll('1').size)
+        self.assertEquals(u'IMG_000007', data.images_by_id['7'].caption)
+        self.assertTrue(data.images_by_id['7'].date)
+        self.assertEquals(5, len(data.albums))
+        self.assertTrue(data.getfacealbums())
+
+    def test_split_rolls(self):
+        """Tests that split events are merged back together."""
+        spec = librarygen.LibrarySpec(images=250, roll_fragments=7)
+        data = self._read_library(spec, 'AlbumData.xml')
+        self.assertEquals(2, len(data.rolls))
+        self.assertEquals(125, data.getroll('1').size)
+        self.assertEquals(range(1, 126), [image.event_index
+                                          for image in data.getroll('1').images])
+
+    def test_aperture_library(self):
+        """Tests that a generated Aperture library can be read."""
+        spec = librarygen.LibrarySpec(images=250, albums=3, aperture=True)
+        data = self._read_library(spec, 'ApertureData.xml')
+        self.assertTrue(data.aperture)
+        self.assertEquals(250, len(data.images))
+        events = [album for album in data.albums.values()
+                  if album.albumtype == 'Event']
+        self.assertEquals(2, len(events))
+        self.assertEquals(250, sum([event.size for event in events]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+"""Measures merging the split rolls of iPhoto 9.1.2 libraries.
+
+iPhoto 9.1.2 splits events into many small rolls with the same id. This
+generates a synthetic library with heavily split events, and times building
+its events with iphotodata.build_rolls(), which groups the fragments and
+numbers the images of each event once, against merging the fragments one at
+a time (which numbers all images of the event again for every fragment).
+
+Usage: python -m appledata.rollmerge_benchmark [--images N] [--events N]
+                                               [--roll_fragments N]
+"""
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import sys
+import tempfile
+import time
+
+from optparse import OptionParser
+
+import appledata.applexml as applexml
+import appledata.iphotodata as iphotodata
+import appledata.librarygen as librarygen
+
+
+def merge_one_at_a_time(roll_data, images):
+    """Builds the rolls by merging each fragment into its roll right away."""
+    rolls = {}
+    for data in roll_data:
+        roll = iphotodata.IPhotoRoll(data, images, None, None)
+        other_roll = rolls.get(roll.albumid)
+        if other_roll:
+            other_roll.merge(roll)
+        else:
+            rolls[roll.albumid] = roll
+    return rolls.values()
+
+
+def _time(function, *args):
+    """Returns the result of function, and the seconds it took."""
+    start = time.time()
+    result = function(*args)
+    return (result, time.time() - start)
+
+
+def main(args):
+    parser = OptionParser()
+    parser.add_option('--images', type='int', default=50000,
+                      help='Number of images in the synthetic library.')
+    librarygen.add_spec_options(parser)
+    parser.set_defaults(events=10, roll_fragments=1000, faces=0, keywords=0)
+    (options, _) = parser.parse_args(args)
+
+    (handle, xml_file) = tempfile.mkstemp(suffix='.xml')
+    out = os.fdopen(handle, 'w')
+    try:
+        librarygen.write_library(out, librarygen.get_spec(options,
+                                                          options.images))
+        out.close()
+        data = iphotodata.IPhotoData(applexml.read_applexml_fixed(xml_file),
+                                     None, None, False, None)
+    finally:
+        os.remove(xml_file)
+    roll_data = data.data2["List of Rolls"]
+    print '%d images, %d events split into %d rolls' % (
+        len(data.images), options.events, len(roll_data))
+
+    (rolls, bulk_time) = _time(iphotodata.build_rolls, roll_data,
+                               data.images_by_id, None, None)
+    print 'build_rolls():            %8.3f s' % (bulk_time)
+    (old_rolls, old_time) = _time(merge_one_at_a_time, roll_data,
+                                  data.images_by_id)
+    print 'One merge per fragment:   %8.3f s (%.1fx)' % (
+        old_time, old_time / max(bulk_time, 1e-6))
+    assert (sorted([roll.size for roll in rolls]) ==
+            sorted([roll.size for roll in old_rolls]))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
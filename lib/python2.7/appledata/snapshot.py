@@ -0,0 +1,226 @@
+'''Persistent snapshot cache of parsed iPhoto libraries.
+
+Parsing AlbumData.xml and building the IPhotoData object graph takes minutes
+for large libraries. This module saves the fully built graph in a binary
+(pickle) snapshot, and loads it back on the next run as long as the XML file
+is unchanged.
+
+A snapshot is keyed by the path, size, modification time and MD5 digest of the
+XML file, plus the options that influence how the graph is built. Any
+mismatch invalidates the snapshot, and the library is read again with
+iphotodata.get_iphoto_data().
+'''
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import cPickle
+import hashlib
+import os
+
+import appledata.iphotodata as iphotodata
+import tilutil.systemutils as su
+
+# Bump up the version number every time incompatible changes are made to the
+# IPhotoData object graph. Causes all snapshots to expire.
+SNAPSHOT_VERSION = "phoshare_snapshot_8"
+
+# Default folder for snapshot files.
+SNAPSHOT_FOLDER = u"~/Library/Caches/Phoshare"
+
+# Number of bytes to read at a time when computing the digest of a file.
+_DIGEST_CHUNK_SIZE = 1024 * 1024
+
+
+def get_file_digest(file_path):
+    """Returns the MD5 hex digest of the content of a file."""
+    digest = hashlib.md5()
+    f = open(file_path, 'rb')
+    try:
+        while True:
+            chunk = f.read(_DIGEST_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+    finally:
+        f.close()
+    return digest.hexdigest()
+
+
+class SnapshotKey(object):
+    """Identifies the XML file and options a snapshot was built from."""
+
+    def __init__(self, album_xml_file, ratings, aperture, projection=None):
+        self.version = SNAPSHOT_VERSION
+        self.path = os.path.abspath(album_xml_file)
+        file_stat = os.stat(album_xml_file)
+        self.st_size = file_stat.st_size
+        self.st_mtime = file_stat.st_mtime
+        self.ratings = sorted(ratings) if ratings else None
+        self.aperture = bool(aperture)
+        self.projection = projection
+        # The digest is expensive, so it is only computed when needed.
+        self.digest = None
+
+    def get_digest(self):
+        """Returns the content digest of the XML file."""
+        if self.digest is None:
+            self.digest = get_file_digest(self.path)
+        return self.digest
+
+    def matches(self, other):
+        """Tests if the snapshot with key other is current for this key."""
+        if (other.version != self.version or other.path != self.path or
+            other.st_size != self.st_size or other.st_mtime != self.st_mtime or
+            other.ratings != self.ratings or other.aperture != self.aperture or
+            other.projection != self.projection):
+            return False
+        return other.get_digest() == self.get_digest()
+
+
+def get_snapshot_path(album_xml_file, snapshot_folder=None):
+    """Returns the path of the snapshot file for an XML file."""
+    if not snapshot_folder:
+        snapshot_folder = su.expand_home_folder(SNAPSHOT_FOLDER)
+    name = hashlib.md5(su.fsenc(su.unicode_string(
+        os.path.abspath(album_xml_file)))).hexdigest()
+    return os.path.join(snapshot_folder, name + '.snapshot')
+
+
+def load_snapshot(snapshot_path, key):
+    """Loads the IPhotoData object graph from a snapshot file.
+
+    Returns: the IPhotoData, or None if there is no current snapshot for key.
+    """
+    if not os.path.exists(snapshot_path):
+        return None
+    snapshot_file = None
+    try:
+        snapshot_file = open(snapshot_path, 'rb')
+        # The key is pickled separately, so we don't need to load the whole
+        # graph for a stale snapshot.
+        saved_key = cPickle.load(snapshot_file)
+        if not isinstance(saved_key, SnapshotKey) or not key.matches(saved_key):
+            return None
+        return cPickle.load(snapshot_file)
+    except Exception, ex:
+        su.perr(u"Could not read library snapshot from %s: %s." % (
+            snapshot_path, unicode(ex)))
+        return None
+    finally:
+        if snapshot_file:
+            snapshot_file.close()
+
+
+def save_snapshot(snapshot_path, key, data):
+    """Saves the IPhotoData object graph into a snapshot file."""
+    key.get_digest()
+    temp_path = snapshot_path + '.tmp'
+    try:
+        snapshot_folder = os.path.dirname(snapshot_path)
+        if not os.path.exists(snapshot_folder):
+            os.makedirs(snapshot_folder)
+        out = open(temp_path, 'wb')
+        try:
+            cPickle.dump(key, out, cPickle.HIGHEST_PROTOCOL)
+            cPickle.dump(data, out, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            out.close()
+        # Replace the old snapshot only once the new one is complete.
+        os.rename(temp_path, snapshot_path)
+    except Exception, ex:
+        # The snapshot is only a cache; e.g., a graph too deep to pickle
+        # (RuntimeError) must not stop the export.
+        su.perr(u"Could not save library snapshot to %s: %s." % (
+            snapshot_path, unicode(ex)))
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def get_baseline_path(album_xml_file, export_folder, snapshot_folder=None):
+    """Returns the path of the snapshot file that records the library as it
+    was at the end of the last incremental export into export_folder."""
+    snapshot_path = get_snapshot_path(album_xml_file, snapshot_folder)
+    name = hashlib.md5(su.fsenc(su.unicode_string(
+        os.path.abspath(export_folder)))).hexdigest()
+    return '%s.%s.baseline' % (os.path.splitext(snapshot_path)[0], name)
+
+
+def load_baseline(baseline_path, export_options=None):
+    """Loads the IPhotoData object graph of the last incremental export.
+
+    Unlike load_snapshot(), this does not require the library to be unchanged.
+    It requires the same export_options (see save_baseline()), though: files
+    of containers or images the last export did not select, or made
+    differently, would otherwise count as unchanged.
+
+    Returns: the IPhotoData, or None if there is no usable baseline.
+    """
+    if not os.path.exists(baseline_path):
+        return None
+    baseline_file = None
+    try:
+        baseline_file = open(baseline_path, 'rb')
+        saved_key = cPickle.load(baseline_file)
+        if (not isinstance(saved_key, SnapshotKey) or
+            saved_key.version != SNAPSHOT_VERSION):
+            return None
+        if getattr(saved_key, 'export_options', None) != export_options:
+            su.pout(u"The export options changed since the last incremental "
+                    u"export.")
+            return None
+        return cPickle.load(baseline_file)
+    except Exception, ex:
+        su.perr(u"Could not read export baseline from %s: %s." % (
+            baseline_path, unicode(ex)))
+        return None
+    finally:
+        if baseline_file:
+            baseline_file.close()
+
+
+def save_baseline(baseline_path, album_xml_file, ratings, aperture, data,
+                  export_options=None):
+    """Saves the IPhotoData object graph of a completed incremental export.
+
+    Args:
+      export_options: picklable value of the options that selected and shaped
+          the exported files. load_baseline() only loads the baseline for the
+          same value.
+    """
+    key = SnapshotKey(album_xml_file, ratings, aperture)
+    key.export_options = export_options
+    save_snapshot(baseline_path, key, data)
+
+
+def get_iphoto_data(album_xml_file, ratings=None, verbose=False, aperture=False,
+                    projection=None, snapshot_folder=None, processes=1):
+    """Like iphotodata.get_iphoto_data(), but loads the IPhotoData object from
+    a snapshot if the XML file has not changed since the snapshot was saved.
+    Saves a new snapshot otherwise."""
+    key = SnapshotKey(album_xml_file, ratings, aperture, projection)
+    snapshot_path = get_snapshot_path(album_xml_file, snapshot_folder)
+    data = load_snapshot(snapshot_path, key)
+    if data:
+        if verbose:
+            su.pout(u"Loaded library snapshot from %s." % (snapshot_path))
+        return data
+    data = iphotodata.get_iphoto_data(album_xml_file, ratings=ratings,
+                                      verbose=verbose, aperture=aperture,
+                                      projection=projection,
+                                      processes=processes)
+    # Saved with the snapshot, so later runs do not rebuild it.
+    data.get_lookup_index()
+    save_snapshot(snapshot_path, key, data)
+    return data
@@ -0,0 +1,158 @@
+"""This module tests appledata/snapshot.py."""
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import appledata.snapshot as snapshot
+
+_ALBUM_DATA = '''<?xml version="1.0" encoding="UTF-8"?>
+<plist version="1.0">
+<dict>
+  <key>Application Version</key><string>8.1.2</string>
+  <key>List of Keywords</key>
+  <dict><key>1</key><string>Hidden</string></dict>
+  <key>List of Faces</key>
+  <dict><key>7</key><dict><key>key</key><integer>7</integer>
+    <key>name</key><string>Jane</string></dict></dict>
+  <key>Master Image List</key>
+  <dict>
+    <key>10</key>
+    <dict><key>Caption</key><string>%s</string>
+      <key>ImagePath</key><string>/Library/Masters/a.jpg</string>
+      <key>DateAsTimerInterval</key><real>300000000.0</real>
+      <key>Faces</key><array><dict><key>face key</key><integer>7</integer>
+        <key>rectangle</key><string>{{0.1, 0.2}, {0.3, 0.4}}</string></dict>
+      </array>
+    </dict>
+    <key>11</key>
+    <dict><key>Caption</key><string>b</string>
+      <key>ImagePath</key><string>/Library/Masters/b.mov</string>
+      <key>MediaType</key><string>Movie</string>
+    </dict>
+  </dict>
+  <key>List of Albums</key>
+  <array>
+    <dict><key>AlbumId</key><integer>1</integer>
+      <key>AlbumName</key><string>Photos</string>
+      <key>Master</key><true/>
+      <key>KeyList</key><array><string>10</string><string>11</string></array>
+    </dict>
+  </array>
+  <key>List of Rolls</key>
+  <array>
+    <dict><key>RollID</key><integer>5</integer>
+      <key>RollName</key><string>Event</string>
+      <key>KeyList</key><array><string>10</string><string>11</string></array>
+    </dict>
+  </array>
+</dict>
+</plist>
+'''
+
+
+class SnapshotTest(unittest.TestCase):
+    """Unit tests for snapshot.py code."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.xml_file = os.path.join(self.folder, 'AlbumData.xml')
+        self._write_album_data('a')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def _write_album_data(self, caption):
+        out = open(self.xml_file, 'w')
+        out.write(_ALBUM_DATA % (caption))
+        out.close()
+
+    def _get_iphoto_data(self):
+        return snapshot.get_iphoto_data(self.xml_file,
+                                        snapshot_folder=self.folder)
+
+    def test_get_iphoto_data(self):
+        """Tests that a snapshot is saved, loaded, and invalidated."""
+        snapshot_path = snapshot.get_snapshot_path(self.xml_file, self.folder)
+        data = self._get_iphoto_data()
+        self.assertTrue(os.path.exists(snapshot_path))
+        self.assertEquals(u'a', data.images_by_id['10'].caption)
+
+        key = snapshot.SnapshotKey(self.xml_file, None, False)
+        loaded = snapshot.load_snapshot(snapshot_path, key)
+        self.assertEquals('8.1.2', loaded.applicationVersion)
+        self.assertEquals(2, len(loaded.images))
+        self.assertEquals([u'Jane'], loaded.images_by_id['10'].getfaces())
+        self.assertTrue(loaded.images_by_id['11'].ismovie())
+        roll = loaded.getroll('5')
+        self.assertTrue(roll.images[0] is loaded.images_by_id['10'])
+        self.assertEquals(2, loaded.images_by_id['11'].event_index)
+
+        # Different options invalidate the snapshot.
+        self.assertEquals(None, snapshot.load_snapshot(
+            snapshot_path, snapshot.SnapshotKey(self.xml_file, [5], False)))
+
+        # A changed library invalidates the snapshot, even with the same size
+        # and modification time.
+        st = os.stat(self.xml_file)
+        self._write_album_data('c')
+        os.utime(self.xml_file, (st.st_atime, st.st_mtime))
+        key = snapshot.SnapshotKey(self.xml_file, None, False)
+        self.assertEquals(None, snapshot.load_snapshot(snapshot_path, key))
+        self.assertEquals(u'c', self._get_iphoto_data().images_by_id['10'].caption)
+
+    def test_baseline(self):
+        """Tests that a baseline is only loaded for the same export
+        options."""
+        baseline_path = snapshot.get_baseline_path(self.xml_file, u'/export',
+                                                   self.folder)
+        self.assertEquals(None, snapshot.load_baseline(baseline_path))
+        data = self._get_iphoto_data()
+        export_options = (('events', '.'), ('size', None))
+        snapshot.save_baseline(baseline_path, self.xml_file, None, False, data,
+                               export_options)
+        # The baseline does not need the library to be unchanged.
+        self._write_album_data('c')
+        loaded = snapshot.load_baseline(baseline_path, export_options)
+        self.assertEquals(u'a', loaded.images_by_id['10'].caption)
+        self.assertEquals(None, snapshot.load_baseline(
+            baseline_path, (('events', '.'), ('size', 1024))))
+        self.assertEquals(None, snapshot.load_baseline(baseline_path))
+
+    def test_save_snapshot_errors(self):
+        """Tests that a graph that can't be pickled leaves the previous
+        snapshot."""
+        snapshot_path = os.path.join(self.folder, 'test.snapshot')
+        key = snapshot.SnapshotKey(self.xml_file, None, False)
+        snapshot.save_snapshot(snapshot_path, key, [u'previous'])
+        deep = []
+        for _ in xrange(100000):
+            deep = [deep]
+        # RuntimeError (recursion limit), and TypeError.
+        for data in (deep, [threading.Lock()]):
+            snapshot.save_snapshot(snapshot_path, key, data)
+            self.assertEquals([u'previous'],
+                              snapshot.load_snapshot(snapshot_path, key))
+            self.assertEquals(['test.snapshot'], [
+                name for name in os.listdir(self.folder)
+                if name.startswith('test.')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,273 @@
+'''Remembers what was exported into an export folder.
+
+The manifest is an SQLite database in the root of the export folder. For
+every exported file it records the source file it was made from (path, inode,
+modification time and size), the modification time and size of the exported
+file, how it was made (copy, link, or resize), and a digest of the IPTC data
+it was checked to have.
+With --content_digest, it also records the digests of the content of both
+files (see duplicates.DigestMemo), so an export can tell whether either file
+changed when their times or sizes did.
+
+While the source and the exported file have not changed since they were
+recorded, an exported file is up to date without looking at its content or
+its IPTC data again. Records are only written after the actions of a plan ran
+(see exportplan), and committed in batches, so an aborted export leaves
+records that are either right or stale; stale records don't match the files,
+and those files are checked (and recorded again) like files without a
+record. Deleting the manifest (or --rebuild_manifest) rebuilds it the same
+way.
+
+Planning an export only reads the manifest. The database is created, or
+replaced if it is outdated or broken, when the first change is written while
+the plan runs.
+'''
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import sqlite3
+import threading
+
+import tilutil.systemutils as su
+
+# File name of the manifest in the export folder. Starts with a dot, so the
+# export does not delete it (see imageutils.is_ignore()).
+MANIFEST_NAME = u'.phoshare_manifest.db'
+
+# Bump up the version number when the tables change. Causes old manifests to
+# be rebuilt.
+MANIFEST_VERSION = u'3'
+
+# Number of changed records that are committed together.
+COMMIT_INTERVAL = 200
+
+_COLUMNS = ('source', 'source_ino', 'source_mtime', 'source_size',
+            'export_mtime', 'export_size', 'options', 'metadata',
+            'source_digest', 'export_digest')
+
+
+def get_options_key(link, size):
+    """Returns how a file is exported, as text."""
+    if size:
+        return u'resize:%d' % (size)
+    if link:
+        return u'link'
+    return u'copy'
+
+
+class ManifestRecord(object):
+    """What the manifest knows about an exported file."""
+    __slots__ = _COLUMNS
+
+    def __init__(self, values):
+        for (name, value) in zip(_COLUMNS, values):
+            setattr(self, name, value)
+
+
+class ExportManifest(object):
+    """The records of the files of an export folder.
+
+    All records are read when the manifest is opened, without changing the
+    database; it is only opened for writing when the first change is
+    written.
+    """
+
+    def __init__(self, folder, digests=None):
+        self.folder = folder
+        # duplicates.DigestMemo; if set, records include content digests.
+        self.digests = digests
+        self.path = os.path.join(folder, MANIFEST_NAME)
+        self._records = {}  # relative path -> ManifestRecord
+        self._connection = None  # opened by the first change
+        self._changes = 0  # changes since the last commit
+        # True if the records in the database are to be deleted when it is
+        # opened.
+        self._clear_database = False
+        # True if the database can't be read, and is replaced when it is
+        # opened.
+        self._replace_database = False
+        self._lock = threading.Lock()
+        self.hits = 0  # files found up to date by their record
+        if os.path.exists(self.path):
+            self._load()
+
+    def get_count(self):
+        """Returns the number of records."""
+        return len(self._records)
+
+    def _load(self):
+        """Reads the records. Outdated or broken databases are left alone
+        until the first change is written."""
+        connection = None
+        try:
+            connection = sqlite3.connect(self.path)
+            connection.text_factory = unicode
+            version = connection.execute(
+                "SELECT value FROM info WHERE name = 'version'").fetchone()
+            if not version or version[0] != MANIFEST_VERSION:
+                self._clear_database = True
+                return
+            for row in connection.execute(
+                'SELECT path, %s FROM files' % (', '.join(_COLUMNS))):
+                self._records[row[0]] = ManifestRecord(row[1:])
+        except sqlite3.DatabaseError, ex:
+            su.perr(u'Rebuilding the export manifest %s: %s' % (
+                self.path, ex))
+            self._records = {}
+            self._replace_database = True
+        finally:
+            if connection:
+                connection.close()
+
+    def _connect(self):
+        """Opens the database for writing, creating, clearing, or replacing
+        it as needed. Called with the lock held."""
+        if self._replace_database and os.path.exists(self.path):
+            os.remove(self.path)
+        self._replace_database = False
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        try:
+            connection.text_factory = unicode
+            connection.execute('CREATE TABLE IF NOT EXISTS info '
+                               '(name TEXT PRIMARY KEY, value TEXT)')
+            version = connection.execute(
+                "SELECT value FROM info WHERE name = 'version'").fetchone()
+            if not version or version[0] != MANIFEST_VERSION:
+                connection.execute('DROP TABLE IF EXISTS files')
+                connection.execute(
+                    "INSERT OR REPLACE INTO info VALUES ('version', ?)",
+                    (MANIFEST_VERSION,))
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, '
+                'source TEXT, source_ino INTEGER, source_mtime REAL, '
+                'source_size INTEGER, export_mtime REAL, export_size INTEGER, '
+                'options TEXT, metadata TEXT, source_digest TEXT, '
+                'export_digest TEXT)')
+            if self._clear_database:
+                connection.execute('DELETE FROM files')
+            connection.commit()
+        except sqlite3.Error:
+            # Not set up; the next change tries again.
+            connection.close()
+            raise
+        self._clear_database = False
+        self._connection = connection
+
+    def _get_key(self, path):
+        """Returns a path relative to the export folder."""
+        if path.startswith(self.folder + os.sep):
+            return path[len(self.folder) + 1:]
+        return path
+
+    def get(self, path):
+        """Returns the ManifestRecord of an exported file, or None."""
+        return self._records.get(self._get_key(path))
+
+    def get_current(self, path, source, options_key, stat_cache):
+        """Returns the record of an exported file if the file is up to date:
+        it was made from source as described by options_key, and neither
+        file changed since. Otherwise returns None."""
+        record = self._records.get(self._get_key(path))
+        if (not record or record.source != source or
+            record.options != options_key):
+            return None
+        export_stat = stat_cache.stat(path)
+        source_stat = stat_cache.stat(source)
+        if (not export_stat or not source_stat or
+            export_stat.st_mtime != record.export_mtime or
+            export_stat.st_size != record.export_size or
+            source_stat.st_ino != record.source_ino or
+            source_stat.st_mtime != record.source_mtime or
+            source_stat.st_size != record.source_size):
+            return None
+        self.hits += 1
+        return record
+
+    def record(self, path, source, options_key, metadata):
+        """Records an exported file, as it is now."""
+        source_stat = os.stat(source)
+        export_stat = os.stat(path)
+        source_digest = None
+        export_digest = None
+        if self.digests is not None:
+            source_digest = self.digests.get_digest(source, source_stat)
+            export_digest = self.digests.get_digest(path, export_stat)
+        record = ManifestRecord((
+            source, source_stat.st_ino, source_stat.st_mtime,
+            source_stat.st_size, export_stat.st_mtime, export_stat.st_size,
+            options_key, metadata, source_digest, export_digest))
+        key = self._get_key(path)
+        self._lock.acquire()
+        try:
+            if not self._connection:
+                self._connect()
+            self._connection.execute(
+                'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, '
+                '?, ?, ?)', (key,) + tuple([getattr(record, name)
+                                               for name in _COLUMNS]))
+            self._records[key] = record
+            self._changed()
+        finally:
+            self._lock.release()
+
+    def forget(self, path):
+        """Removes the record of a file that was deleted."""
+        key = self._get_key(path)
+        self._lock.acquire()
+        try:
+            if self._records.pop(key, None):
+                if not self._connection:
+                    self._connect()
+                self._connection.execute('DELETE FROM files WHERE path = ?',
+                                         (key,))
+                self._changed()
+        finally:
+            self._lock.release()
+
+    def clear(self, records_only=False):
+        """Forgets all records, so they are rebuilt. Unless records_only is
+        set (e.g., for a dry run), the database drops them when the first
+        change is written."""
+        self._lock.acquire()
+        try:
+            self._records = {}
+            if records_only:
+                return
+            if self._connection:
+                self._connection.execute('DELETE FROM files')
+                self._changed()
+            else:
+                self._clear_database = True
+        finally:
+            self._lock.release()
+
+    def _changed(self):
+        self._changes += 1
+        if self._changes >= COMMIT_INTERVAL:
+            self._connection.commit()
+            self._changes = 0
+
+    def close(self):
+        """Commits the changes."""
+        self._lock.acquire()
+        try:
+            if self._connection:
+                self._connection.commit()
+                self._connection.close()
+                self._connection = None
+                self._changes = 0
+        finally:
+            self._lock.release()
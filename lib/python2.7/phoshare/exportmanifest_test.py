@@ -0,0 +1,167 @@
+"""This module tests phoshare/exportmanifest.py."""
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import appledata.duplicates as duplicates
+import phoshare.exportmanifest as exportmanifest
+import tilutil.systemutils as su
+
+
+def _write(path, data, mtime):
+    out = open(path, 'wb')
+    out.write(data)
+    out.close()
+    os.utime(path, (mtime, mtime))
+
+
+class ExportManifestTest(unittest.TestCase):
+    """Unit tests for exportmanifest.py code."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.source = os.path.join(self.folder, 'source.jpg')
+        _write(self.source, 'image', 1000000000)
+        self.export = os.path.join(self.folder, 'export')
+        os.mkdir(self.export)
+        self.target = os.path.join(self.export, 'a.jpg')
+        shutil.copy2(self.source, self.target)
+        self.key = exportmanifest.get_options_key(False, None)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def _get_current(self, manifest, key=None):
+        return manifest.get_current(self.target, self.source, key or self.key,
+                                    su.StatCache())
+
+    def test_record(self):
+        """Tests recording files, and finding them up to date."""
+        manifest = exportmanifest.ExportManifest(self.export)
+        self.assertEquals(None, self._get_current(manifest))
+        # Nothing is written before the first record.
+        self.assertFalse(os.path.exists(manifest.path))
+        manifest.record(self.target, self.source, self.key, u'digest')
+        record = self._get_current(manifest)
+        self.assertEquals(u'digest', record.metadata)
+        self.assertEquals(1, manifest.hits)
+        # Made differently.
+        self.assertEquals(None, self._get_current(
+            manifest, exportmanifest.get_options_key(False, 1024)))
+        manifest.close()
+
+        # The records are read back, with paths relative to the folder.
+        manifest = exportmanifest.ExportManifest(self.export)
+        self.assertEquals(1, manifest.get_count())
+        self.assertEquals(u'digest', self._get_current(manifest).metadata)
+        self.assertEquals(u'a.jpg', manifest._get_key(self.target))
+
+        # A changed source or exported file needs to be checked again.
+        _write(self.source, 'image', 1000000100)
+        self.assertEquals(None, self._get_current(manifest))
+        manifest.record(self.target, self.source, self.key, None)
+        self.assertNotEquals(None, self._get_current(manifest))
+        _write(self.target, 'other image', 1000000100)
+        self.assertEquals(None, self._get_current(manifest))
+        os.remove(self.target)
+        self.assertEquals(None, self._get_current(manifest))
+        manifest.close()
+
+    def test_forget_and_clear(self):
+        """Tests removing records."""
+        manifest = exportmanifest.ExportManifest(self.export)
+        manifest.record(self.target, self.source, self.key, None)
+        manifest.forget(self.target)
+        manifest.forget(self.target)
+        self.assertEquals(0, manifest.get_count())
+        manifest.record(self.target, self.source, self.key, None)
+        manifest.close()
+
+        # A dry run forgets the records, but keeps them in the database.
+        manifest = exportmanifest.ExportManifest(self.export)
+        manifest.clear(records_only=True)
+        self.assertEquals(None, self._get_current(manifest))
+        manifest.close()
+        manifest = exportmanifest.ExportManifest(self.export)
+        self.assertEquals(1, manifest.get_count())
+        # The database drops the records when the first change is written.
+        mtime = os.path.getmtime(manifest.path)
+        manifest.clear()
+        self.assertEquals(mtime, os.path.getmtime(manifest.path))
+        manifest.record(self.source, self.source, self.key, None)
+        manifest.close()
+        manifest = exportmanifest.ExportManifest(self.export)
+        self.assertEquals(1, manifest.get_count())
+        self.assertEquals(None, manifest.get(self.target))
+        # Deleted files are forgotten without other changes.
+        manifest.forget(self.source)
+        manifest.close()
+        manifest = exportmanifest.ExportManifest(self.export)
+        self.assertEquals(0, manifest.get_count())
+        manifest.close()
+
+    def test_content_digests(self):
+        """Tests recording the digests of the content of the files."""
+        manifest = exportmanifest.ExportManifest(self.export)
+        manifest.record(self.target, self.source, self.key, None)
+        self.assertEquals(None, manifest.get(self.target).source_digest)
+        memo = duplicates.DigestMemo()
+        manifest.digests = memo
+        manifest.record(self.target, self.source, self.key, None)
+        manifest.close()
+        manifest = exportmanifest.ExportManifest(self.export)
+        record = manifest.get(self.target)
+        self.assertEquals(u'78805a221a988e79ef3f42d7c5bfd418',
+                          record.source_digest)
+        self.assertEquals(record.source_digest, record.export_digest)
+        self.assertEquals(2, memo.reads)
+        manifest.close()
+
+    def test_corrupt_manifest(self):
+        """Tests that a manifest that can't be read is rebuilt, but only
+        when the first change is written."""
+        manifest_path = os.path.join(self.export, exportmanifest.MANIFEST_NAME)
+        _write(manifest_path, 'not a database' * 100, 1000000000)
+        manifest = exportmanifest.ExportManifest(self.export)
+        self.assertEquals(0, manifest.get_count())
+        manifest.close()
+        self.assertEquals('not a database' * 100, open(manifest_path).read())
+        manifest = exportmanifest.ExportManifest(self.export)
+        manifest.record(self.target, self.source, self.key, None)
+        manifest.close()
+        manifest = exportmanifest.ExportManifest(self.export)
+        self.assertEquals(1, manifest.get_count())
+        manifest.close()
+
+        # The records of an older version are not read, and not dropped
+        # before the first change.
+        connection = sqlite3.connect(manifest_path)
+        connection.execute("UPDATE info SET value = '0'")
+        connection.commit()
+        connection.close()
+        mtime = os.path.getmtime(manifest_path)
+        manifest = exportmanifest.ExportManifest(self.export)
+        self.assertEquals(0, manifest.get_count())
+        manifest.close()
+        self.assertEquals(mtime, os.path.getmtime(manifest_path))
+
+
+if __name__ == '__main__':
+    unittest.main()
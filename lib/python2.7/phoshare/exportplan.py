@@ -0,0 +1,492 @@
+'''Plans and runs the changes to an export folder.
+
+Exporting happens in two phases. Planning walks the export tree, decides what
+has to change, and records it in an ExportPlan, without touching the export
+folder. Executing runs the actions of the plan. A dry run only plans, and a
+plan can be saved as JSON, to be reviewed, and run later (see --plan and
+--run_plan).
+
+Every action is a dictionary that can be serialized as JSON. It has an
+"action" and a "target" path:
+
+  mkdir     creates the target folder.
+  create    creates the target file from "source". "mode" is "copy", "link"
+            (a hard link), or "resize" (to "size" pixels).
+  update    like create, but replaces an existing target file.
+  metadata  writes IPTC data into the target file: "caption", "keywords",
+            "rating", "gps", "rectangles" and "persons" (None for values that
+            don't change).
+  delete    deletes the target file, or the (empty) target folder.
+  record    records the target file, made from "source", in the export
+            manifest (see exportmanifest), with its "options" and
+            "metadata" digest.
+
+Actions run on a number of threads (see execute_plan()), but each action waits
+for the earlier actions of the plan it depends on: a folder is created before
+the files in it, a file is created before its metadata is written or a link
+to it is made, and the contents of a folder are deleted before the folder.
+The --max_create, --max_update and --max_delete limits are applied while
+planning, on one thread, so running the plan cannot exceed them.
+'''
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import heapq
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+
+import tilutil.exiftool as exiftool
+import tilutil.filecopy as filecopy
+import tilutil.imageutils as imageutils
+import tilutil.systemutils as su
+
+_logger = logging.getLogger('google.exportplan')
+
+# Version of the JSON format of plans.
+PLAN_VERSION = 1
+
+# Default number of threads that run the actions of a plan.
+DEFAULT_THREADS = 4
+
+# Default bound on the size of the files that are copied at the same time.
+DEFAULT_BYTES_IN_FLIGHT = 256 * 1024 * 1024
+
+
+class ExportPlan(object):
+    """The actions that bring an export folder up to date."""
+
+    def __init__(self, actions=None, manifest_path=None):
+        self.actions = actions or []
+        # Path of the exportmanifest.ExportManifest the record actions are
+        # for.
+        self.manifest_path = manifest_path
+        self._folders = set()  # folders with a mkdir action
+        self._written = set()  # files with a create or update action
+        self._metadata = set()  # files with a metadata action
+        for action in self.actions:
+            if action['action'] == 'mkdir':
+                self._folders.add(action['target'])
+            elif action['action'] in ('create', 'update'):
+                self._written.add(action['target'])
+            elif action['action'] == 'metadata':
+                self._metadata.add(action['target'])
+
+    def __len__(self):
+        return len(self.actions)
+
+    def will_write(self, path):
+        """Returns True if the plan creates or updates a file."""
+        return path in self._written
+
+    def will_write_metadata(self, path):
+        """Returns True if the plan writes IPTC data into a file."""
+        return path in self._metadata
+
+    def add_folder(self, folder):
+        """Plans to create a folder, unless that is planned already."""
+        if folder in self._folders:
+            return
+        self._folders.add(folder)
+        su.pout(u"Creating folder " + folder)
+        self.actions.append({'action': 'mkdir', 'target': folder})
+
+    def add_export(self, source, target, link, size, options):
+        """Plans to create or update an exported file, if the create or update
+        limits of options allow it.
+
+        Returns: True if the target file exists, or will be created.
+        """
+        if size:
+            mode = 'resize'
+        elif link:
+            mode = 'link'
+        else:
+            mode = 'copy'
+        if su.get_stat_cache().exists(target):
+            _logger.info(u'Needs update: %s (%s)', target, mode)
+            if not imageutils.should_update(options):
+                return True
+            action = 'update'
+        else:
+            _logger.info(u'New file: %s (%s)', target, mode)
+            if not imageutils.should_create(options):
+                return False
+            action = 'create'
+        export_action = {'action': action, 'mode': mode, 'source': source,
+                         'target': target}
+        if size:
+            export_action['size'] = size
+        self.actions.append(export_action)
+        self._written.add(target)
+        return True
+
+    def add_metadata(self, target, caption, keywords, rating, gps, rectangles,
+                     persons, image_width, image_height):
+        """Plans to write IPTC data into a file. See
+        exiftool.update_iptcdata() for the values. If image_width and
+        image_height are None, the dimensions are read from the file when the
+        plan runs."""
+        self._metadata.add(target)
+        self.actions.append({
+            'action': 'metadata', 'target': target, 'caption': caption,
+            'keywords': keywords, 'rating': rating,
+            'gps': [gps.latitude, gps.longitude] if gps else None,
+            'rectangles': rectangles, 'persons': persons,
+            'image_width': image_width, 'image_height': image_height})
+
+    def add_delete(self, target):
+        """Plans to delete a file, or an empty folder."""
+        self.actions.append({'action': 'delete', 'target': target})
+
+    def add_record(self, target, source, options_key, metadata):
+        """Plans to record an exported file in the export manifest, once the
+        actions on it ran."""
+        self.actions.append({'action': 'record', 'target': target,
+                             'source': source, 'options': options_key,
+                             'metadata': metadata})
+
+    def get_summary(self):
+        """Returns the number of actions of each kind, as text."""
+        counts = {}
+        for action in self.actions:
+            counts[action['action']] = counts.get(action['action'], 0) + 1
+        return u', '.join([u'%d %s' % (counts[action], action)
+                           for action in sorted(counts)]) or u'nothing to do'
+
+    def save(self, plan_path):
+        """Writes the plan as JSON."""
+        out = open(plan_path, 'w')
+        try:
+            json.dump({'version': PLAN_VERSION, 'actions': self.actions,
+                       'manifest': self.manifest_path}, out, indent=1,
+                      sort_keys=True)
+        finally:
+            out.close()
+
+
+def load_plan(plan_path):
+    """Reads a plan written by ExportPlan.save().
+
+    Raises: ValueError if the file is not a plan.
+    """
+    plan_file = open(plan_path)
+    try:
+        data = json.load(plan_file)
+    finally:
+        plan_file.close()
+    if not isinstance(data, dict) or data.get('version') != PLAN_VERSION:
+        raise ValueError(u'%s is not an export plan.' % (plan_path))
+    return ExportPlan(data['actions'], data.get('manifest'))
+
+
+def _make_folder(action):
+    if not os.path.isdir(action['target']):
+        os.makedirs(action['target'])
+    return True
+
+
+def _export_file(action):
+    source = action['source']
+    target = action['target']
+    if action['action'] == 'update' and os.path.lexists(target):
+        os.remove(target)
+    mode = action['mode']
+    if mode == 'link':
+        _logger.debug(u'os.link(%s, %s)', source, target)
+        os.link(source, target)
+    elif mode == 'resize':
+        result = imageutils.resize_image(source, target, action['size'])
+        if result:
+            su.perr(u'%s: %s' % (source, result))
+            return False
+    else:
+        method = filecopy.copy_file(source, target)
+        _logger.debug(u'copy_file(%s, %s): %s', source, target, method)
+    return True
+
+
+def _write_metadata(action):
+    gps = action['gps']
+    if gps:
+        gps = imageutils.GpsLocation(gps[0], gps[1])
+    rectangles = action['rectangles']
+    if rectangles is not None:
+        rectangles = [list(rectangle) for rectangle in rectangles]
+    image_width = action['image_width']
+    image_height = action['image_height']
+    if image_width is None:
+        if rectangles:
+            (image_width, image_height) = imageutils.get_image_width_height(
+                action['target'])
+        else:
+            image_width = image_height = -1
+    return exiftool.update_iptcdata(
+        action['target'], action['caption'], action['keywords'], None,
+        action['rating'], gps, rectangles, action['persons'], image_width,
+        image_height, hierarchical_subject=[])
+
+
+def _delete(action):
+    target = action['target']
+    if os.path.isdir(target) and not os.path.islink(target):
+        os.rmdir(target)
+    else:
+        os.remove(target)
+    return True
+
+
+_EXECUTORS = {
+    'mkdir': _make_folder,
+    'create': _export_file,
+    'update': _export_file,
+    'metadata': _write_metadata,
+    'delete': _delete,
+}
+
+
+def execute_action(action, manifest=None):
+    """Runs one action, and updates the export manifest (an
+    exportmanifest.ExportManifest), if set. Returns True if it succeeded.
+
+    A record action fails if the manifest can't be written (e.g., the database
+    is locked by another client of a network volume). A delete succeeds even
+    if its record can't be removed: a record of a missing file is never
+    current.
+    """
+    try:
+        if action['action'] == 'record':
+            if manifest:
+                manifest.record(action['target'], action['source'],
+                                action['options'], action['metadata'])
+            return True
+        succeeded = _EXECUTORS[action['action']](action)
+        if succeeded and manifest and action['action'] == 'delete':
+            try:
+                manifest.forget(action['target'])
+            except sqlite3.Error, ex:
+                su.perr(u'Could not remove %s from the export manifest: %s' % (
+                    action['target'], ex))
+        return succeeded
+    except (OSError, IOError, sqlite3.Error), ex:
+        su.perr(u'Could not %s %s: %s' % (action['action'], action['target'],
+                                          ex))
+        return False
+    finally:
+        su.get_stat_cache().invalidate(action['target'])
+
+
+def _get_path_key(path):
+    """Returns a key that is the same for all spellings of a path on a case
+    insensitive file system (like the default HFS+ and APFS volumes), so
+    actions on the same file are never run at the same time."""
+    if isinstance(path, unicode):
+        path = unicodedata.normalize('NFC', path)
+    return os.path.normcase(path).lower()
+
+
+def _get_dependencies(actions):
+    """Returns, for each action, the set of earlier actions (indices) it has
+    to wait for: the last action on its target, on its source, and on the
+    folder of its target, and for a delete, the actions on the files in the
+    folder it deletes. Paths are compared without case (see
+    _get_path_key())."""
+    last_actions = {}  # target key -> index of the last action on it
+    folder_actions = {}  # folder key -> indices of the actions on files in it
+    dependencies = []
+    for (index, action) in enumerate(actions):
+        target = _get_path_key(action['target'])
+        folder = os.path.dirname(target)
+        waits_for = set()
+        source = action.get('source')
+        for path in (target, source and _get_path_key(source), folder):
+            if path in last_actions:
+                waits_for.add(last_actions[path])
+        if action['action'] == 'delete':
+            waits_for.update(folder_actions.pop(target, ()))
+        dependencies.append(waits_for)
+        last_actions[target] = index
+        folder_actions.setdefault(folder, []).append(index)
+    return dependencies
+
+
+def _get_copy_size(action):
+    """Returns the number of bytes an action copies."""
+    if action['action'] in ('create', 'update') and action['mode'] != 'link':
+        return su.get_stat_cache().getsize(action['source'])
+    return 0
+
+
+class ExecutionStats(object):
+    """What a run of a plan did."""
+
+    def __init__(self):
+        self.actions = 0  # actions that succeeded
+        self.failures = 0  # actions that failed or were skipped
+        self.copied_bytes = 0  # size of the copied or resized files
+        self.seconds = 0.0
+        self.aborted = False  # the run stopped before all actions ran
+
+    def get_summary(self):
+        """Returns the statistics, and the throughput, as text."""
+        megabytes = self.copied_bytes / 1024.0 / 1024.0
+        return u'%d actions in %.1f s, copied %.1f MB (%.1f MB/s)' % (
+            self.actions, self.seconds, megabytes,
+            megabytes / max(self.seconds, 0.001))
+
+
+class _PlanRunner(object):
+    """Runs the actions of a plan on a number of threads.
+
+    An action is ready when the actions it depends on are done, and ready
+    actions start in plan order. A copy only starts while the files being
+    copied stay below a number of bytes; a larger file is copied alone.
+    """
+
+    def __init__(self, actions, max_bytes_in_flight, check_abort, manifest):
+        self._actions = actions
+        self._manifest = manifest
+        self._max_bytes = max_bytes_in_flight
+        self._check_abort = check_abort
+        su.get_stat_cache().prefetch([action['source'] for action in actions
+                                      if 'source' in action])
+        self._sizes = [_get_copy_size(action) for action in actions]
+        dependencies = _get_dependencies(actions)
+        self._waiting = [len(waits_for) for waits_for in dependencies]
+        self._dependents = [[] for _ in actions]
+        for (index, waits_for) in enumerate(dependencies):
+            for other in waits_for:
+                self._dependents[other].append(index)
+        self._skipped = [False] * len(actions)  # a dependency failed
+        self._ready = [index for index in xrange(len(actions))
+                       if not self._waiting[index]]  # a heap
+        self._bytes_in_flight = 0
+        self._running = 0
+        self._aborted = False
+        self._condition = threading.Condition()
+        self.stats = ExecutionStats()
+
+    def _get_size(self, index):
+        if self._skipped[index]:
+            return 0
+        return self._sizes[index]
+
+    def _start_next(self):
+        """Waits for the next action that can start. Returns its index, or
+        None if no actions are left."""
+        self._condition.acquire()
+        try:
+            while not self._aborted:
+                if self._ready:
+                    index = self._ready[0]
+                    size = self._get_size(index)
+                    if (not self._bytes_in_flight or
+                        self._bytes_in_flight + size <= self._max_bytes):
+                        if self._check_abort and self._check_abort():
+                            self._aborted = True
+                            self._condition.notify_all()
+                            break
+                        heapq.heappop(self._ready)
+                        self._bytes_in_flight += size
+                        self._running += 1
+                        return index
+                elif not self._running:
+                    break
+                self._condition.wait()
+            return None
+        finally:
+            self._condition.release()
+
+    def _finish(self, index, succeeded):
+        """Records the result of an action, and readies the actions that
+        waited for it."""
+        self._condition.acquire()
+        try:
+            self._bytes_in_flight -= self._get_size(index)
+            self._running -= 1
+            if succeeded:
+                self.stats.actions += 1
+                self.stats.copied_bytes += self._sizes[index]
+            else:
+                self.stats.failures += 1
+            for dependent in self._dependents[index]:
+                if not succeeded:
+                    self._skipped[dependent] = True
+                self._waiting[dependent] -= 1
+                if not self._waiting[dependent]:
+                    heapq.heappush(self._ready, dependent)
+            self._condition.notify_all()
+        finally:
+            self._condition.release()
+
+    def _work(self):
+        while True:
+            index = self._start_next()
+            if index is None:
+                return
+            succeeded = False
+            try:
+                if not self._skipped[index]:
+                    succeeded = execute_action(self._actions[index],
+                                               self._manifest)
+            except Exception, ex:  # IGNORE:W0703
+                # Any error fails just this action (and the ones waiting for
+                # it), so the worker keeps going and no action hangs.
+                action = self._actions[index]
+                su.perr(u'Could not %s %r: %r' % (action['action'],
+                                                  action['target'], ex))
+                _logger.debug(u'Action %d failed', index, exc_info=True)
+            finally:
+                self._finish(index, succeeded)
+
+    def run(self, threads):
+        """Runs the actions on the calling thread and threads - 1 others."""
+        start = time.time()
+        workers = [threading.Thread(target=self._work)
+                   for _ in xrange(threads - 1)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        self._work()
+        for worker in workers:
+            worker.join()
+        self.stats.seconds = time.time() - start
+        self.stats.aborted = self._aborted
+        return self.stats
+
+
+def execute_plan(plan, check_abort=None, threads=1,
+                 max_bytes_in_flight=DEFAULT_BYTES_IN_FLIGHT, manifest=None):
+    """Runs the actions of a plan. Actions that depend on a failed action
+    (they read or write its target, or its target is in a folder that could
+    not be created) are skipped.
+
+    Args:
+      plan: ExportPlan.
+      check_abort: if set, called before each action. Stops the run if it
+          returns True.
+      threads: number of actions that run at the same time.
+      max_bytes_in_flight: bound on the size of the files that are copied at
+          the same time.
+      manifest: exportmanifest.ExportManifest for the record actions.
+    Returns: ExecutionStats.
+    """
+    runner = _PlanRunner(plan.actions, max_bytes_in_flight, check_abort,
+                         manifest)
+    return runner.run(max(1, threads))
@@ -0,0 +1,251 @@
+"""This module tests phoshare/exportplan.py."""
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import phoshare.exportplan as exportplan
+import tilutil.systemutils as su
+
+
+class _Options(object):
+    """The options ExportPlan.add_export() looks at."""
+
+    def __init__(self, update=True, max_create=-1, max_update=-1):
+        self.dryrun = False
+        self.update = update
+        self.max_create = max_create
+        self.max_update = max_update
+
+
+class _LockedManifest(object):
+    """An export manifest whose database is locked."""
+
+    def record(self, path, source, options_key, metadata):
+        raise sqlite3.OperationalError('database is locked')
+
+    def forget(self, path):
+        raise sqlite3.OperationalError('database is locked')
+
+
+class ExportPlanTest(unittest.TestCase):
+    """Unit tests for exportplan.py code."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.source = os.path.join(self.folder, 'source.jpg')
+        out = open(self.source, 'wb')
+        out.write('image')
+        out.close()
+        self.export = os.path.join(self.folder, 'export')
+        su.reset_stat_cache()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+        su.reset_stat_cache()
+
+    def _path(self, *names):
+        return os.path.join(self.export, *names)
+
+    def test_plan(self):
+        """Tests planning, saving, loading, and running a plan."""
+        plan = exportplan.ExportPlan()
+        plan.add_folder(self._path('Event'))
+        plan.add_folder(self._path('Event'))
+        options = _Options(max_create=2)
+        self.assertTrue(plan.add_export(self.source, self._path('Event', 'a.jpg'),
+                                        False, None, options))
+        self.assertTrue(plan.add_export(self._path('Event', 'a.jpg'),
+                                        self._path('Event', 'b.jpg'),
+                                        True, None, options))
+        # Over the create limit.
+        self.assertFalse(plan.add_export(self.source,
+                                         self._path('Event', 'c.jpg'),
+                                         False, None, options))
+        self.assertTrue(plan.will_write(self._path('Event', 'b.jpg')))
+        self.assertFalse(plan.will_write(self._path('Event', 'c.jpg')))
+        self.assertEquals(u'2 create, 1 mkdir', plan.get_summary())
+        # Nothing was touched yet.
+        self.assertFalse(os.path.exists(self.export))
+
+        plan_path = os.path.join(self.folder, 'plan.json')
+        plan.save(plan_path)
+        loaded_plan = exportplan.load_plan(plan_path)
+        self.assertEquals(plan.actions, loaded_plan.actions)
+        self.assertTrue(loaded_plan.will_write(self._path('Event', 'b.jpg')))
+
+        stats = exportplan.execute_plan(loaded_plan)
+        self.assertEquals(0, stats.failures)
+        self.assertEquals(3, stats.actions)
+        # The link does not copy anything.
+        self.assertEquals(len('image'), stats.copied_bytes)
+        self.assertEquals('image', open(self._path('Event', 'a.jpg')).read())
+        self.assertEquals(os.stat(self._path('Event', 'a.jpg')).st_ino,
+                          os.stat(self._path('Event', 'b.jpg')).st_ino)
+
+        # Existing files are updated, and obsolete ones deleted.
+        plan = exportplan.ExportPlan()
+        self.assertTrue(plan.add_export(self.source,
+                                        self._path('Event', 'b.jpg'),
+                                        False, None, _Options()))
+        self.assertEquals('update', plan.actions[0]['action'])
+        plan.add_delete(self._path('Event', 'a.jpg'))
+        self.assertEquals(0, exportplan.execute_plan(plan).failures)
+        self.assertEquals(['b.jpg'], os.listdir(self._path('Event')))
+        self.assertNotEquals(os.stat(self.source).st_ino,
+                             os.stat(self._path('Event', 'b.jpg')).st_ino)
+
+        # Without --update, existing files stay as they are.
+        plan = exportplan.ExportPlan()
+        self.assertTrue(plan.add_export(self.source,
+                                        self._path('Event', 'b.jpg'),
+                                        False, None, _Options(update=False)))
+        self.assertEquals(0, len(plan))
+
+    def test_failed_actions(self):
+        """Tests that actions depending on a failed action are skipped."""
+        plan = exportplan.ExportPlan()
+        plan.add_export(os.path.join(self.folder, 'missing.jpg'),
+                        self._path('a.jpg'), False, None, _Options())
+        plan.add_export(self._path('a.jpg'), self._path('b.jpg'), True, None,
+                        _Options())
+        plan.add_folder(self._path('Event'))
+        plan.add_export(self.source, self._path('Event', 'c.jpg'), False, None,
+                        _Options())
+        os.mkdir(self.export)
+        stats = exportplan.execute_plan(plan)
+        self.assertEquals(2, stats.failures)
+        self.assertFalse(stats.aborted)
+        self.assertEquals(['Event'], os.listdir(self.export))
+        self.assertEquals(['c.jpg'], os.listdir(self._path('Event')))
+
+    def test_manifest_errors(self):
+        """Tests that manifest errors fail the record actions, but not the
+        file actions."""
+        os.mkdir(self.export)
+        obsolete = self._path('b.jpg')
+        open(obsolete, 'w').close()
+        plan = exportplan.ExportPlan()
+        plan.add_export(self.source, self._path('a.jpg'), False, None,
+                        _Options())
+        plan.add_record(self._path('a.jpg'), self.source, u'', None)
+        plan.add_delete(obsolete)
+        stats = exportplan.execute_plan(plan, threads=2,
+                                        manifest=_LockedManifest())
+        self.assertEquals(1, stats.failures)
+        self.assertEquals(2, stats.actions)
+        self.assertEquals(['a.jpg'], os.listdir(self.export))
+
+    def test_unexpected_errors(self):
+        """Tests that any error raised by an action just fails it."""
+        for threads in (1, 3):
+            plan = exportplan.ExportPlan()
+            plan.add_folder(self._path('Event %d' % (threads)))
+            # Not a known action.
+            plan.actions.append({'action': 'frobnicate',
+                                 'target': self._path('a.jpg')})
+            plan.add_export(self.source, self._path('a.jpg'), False, None,
+                            _Options())
+            plan.add_export(self.source,
+                            self._path('Event %d' % (threads), 'b.jpg'), False,
+                            None, _Options())
+            stats = exportplan.execute_plan(plan, threads=threads)
+            self.assertEquals(2, stats.failures)
+            self.assertEquals(2, stats.actions)
+            self.assertEquals(['b.jpg'], os.listdir(
+                self._path('Event %d' % (threads))))
+
+    def test_get_dependencies(self):
+        """Tests which actions wait for which."""
+        plan = exportplan.ExportPlan()
+        plan.add_delete(self._path('Old', 'a.jpg'))  # 0
+        plan.add_delete(self._path('Old', 'b.jpg'))  # 1
+        plan.add_delete(self._path('Old'))  # 2
+        plan.add_folder(self._path('Event'))  # 3
+        options = _Options()
+        plan.add_export(self.source, self._path('Event', 'a.jpg'), False, None,
+                        options)  # 4
+        plan.add_export(self._path('Event', 'a.jpg'),
+                        self._path('Event', 'b.jpg'), True, None,
+                        options)  # 5
+        plan.add_export(self.source, self._path('c.jpg'), False, None,
+                        options)  # 6
+        plan.add_metadata(self._path('Event', 'a.jpg'), u'caption', None, -1,
+                          None, None, None, None, None)  # 7
+        self.assertEquals(
+            [set(), set(), set([0, 1]), set(), set([3]), set([3, 4]), set(),
+             set([3, 4])],
+            exportplan._get_dependencies(plan.actions))
+
+        # Paths that only differ in case are the same file on case
+        # insensitive volumes.
+        plan = exportplan.ExportPlan()
+        plan.add_folder(self._path('Event'))  # 0
+        plan.add_export(self.source, self._path('event', 'A.JPG'), False, None,
+                        options)  # 1
+        plan.add_export(self.source, self._path('Event', 'a.jpg'), False, None,
+                        options)  # 2
+        plan.add_delete(self._path('EVENT'))  # 3
+        self.assertEquals([set(), set([0]), set([0, 1]), set([0, 1, 2])],
+                          exportplan._get_dependencies(plan.actions))
+
+    def test_parallel_copies(self):
+        """Tests running a plan on several threads, with a bound on the
+        bytes in flight."""
+        plan = exportplan.ExportPlan()
+        options = _Options()
+        for folder in xrange(5):
+            folder_path = self._path('Event %d' % (folder))
+            plan.add_folder(folder_path)
+            for name in xrange(20):
+                target = os.path.join(folder_path, '%d.jpg' % (name))
+                plan.add_export(self.source, target, False, None, options)
+                plan.add_export(target, target + '.link', True, None, options)
+        stats = exportplan.execute_plan(plan, threads=4,
+                                        max_bytes_in_flight=12)
+        self.assertEquals(0, stats.failures)
+        self.assertEquals(205, stats.actions)
+        self.assertEquals(100 * len('image'), stats.copied_bytes)
+        for folder in xrange(5):
+            folder_path = self._path('Event %d' % (folder))
+            self.assertEquals(40, len(os.listdir(folder_path)))
+            self.assertEquals(
+                os.stat(os.path.join(folder_path, '7.jpg')).st_ino,
+                os.stat(os.path.join(folder_path, '7.jpg.link')).st_ino)
+
+        # Actions stop when the run is aborted.
+        plan = exportplan.ExportPlan()
+        plan.add_delete(self._path('Event 0', '0.jpg'))
+        plan.add_delete(self._path('Event 0', '1.jpg'))
+        stats = exportplan.execute_plan(plan, lambda: True, threads=2)
+        self.assertEquals(0, stats.actions)
+        self.assertTrue(stats.aborted)
+        self.assertEquals(40, len(os.listdir(self._path('Event 0'))))
+
+    def test_load_plan(self):
+        """Tests loading a file that is not a plan."""
+        plan_path = os.path.join(self.folder, 'plan.json')
+        out = open(plan_path, 'w')
+        out.write('[]')
+        out.close()
+        self.assertRaises(ValueError, exportplan.load_plan, plan_path)
+
+
+if __name__ == '__main__':
+    unittest.main()
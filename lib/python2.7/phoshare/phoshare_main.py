@@ -16,6 +16,7 @@
 #   limitations under the License.
 
 import getpass
+import hashlib
 import logging
 import os
 import re
@@ -26,10 +27,16 @@ import unicodedata
 from optparse import OptionParser
 import MacOS
 
+import appledata.applexml as applexml
+import appledata.duplicates as duplicates
+import appledata.imagequery as imagequery
 import appledata.iphotodata as iphotodata
+import appledata.snapshot as snapshot
 import tilutil.exiftool as exiftool
 import tilutil.systemutils as su
 import tilutil.imageutils as imageutils
+import phoshare.exportmanifest as exportmanifest
+import phoshare.exportplan as exportplan
 import phoshare.phoshare_version
 
 # Maximum diff in file size to be not considered a change (to allow for
@@ -60,8 +67,10 @@ def region_matches(region1, region2):
             return False
     return True
 
-def delete_album_file(album_file, albumdirectory, msg, options):
-    """sanity check - only delete from album directory."""
+def delete_album_file(album_file, albumdirectory, msg, options, plan):
+    """Plans to delete a file or folder (see exportplan.ExportPlan).
+
+    sanity check - only delete from album directory."""
     if not album_file.startswith(albumdirectory):
         print >> sys.stderr, (
             "Internal error - attempting to delete file "
@@ -72,31 +81,36 @@ def delete_album_file(album_file, albumdirectory, msg, options):
 
     if not imageutils.should_delete(options):
         return False
-    if options.dryrun:
-        return True
 
-    try:
-        if os.path.isdir(album_file):
+    if os.path.isdir(album_file):
+        try:
             file_list = os.listdir(album_file)
-            for subfile in file_list:
-                delete_album_file(os.path.join(album_file, subfile),
-                                  albumdirectory, msg, options)
-            os.rmdir(album_file)
-        else:
-            os.remove(album_file)
-        return True
-    except OSError, ex:
-        print >> sys.stderr, "Could not delete %s: %s" % (su.fsenc(album_file),
-                                                          ex)
-    return False
+        except OSError, ex:
+            print >> sys.stderr, "Could not delete %s: %s" % (
+                su.fsenc(album_file), ex)
+            return False
+        for subfile in file_list:
+            delete_album_file(os.path.join(album_file, subfile),
+                              albumdirectory, msg, options, plan)
+    plan.add_delete(album_file)
+    return True
 
 class ExportFile(object):
     """Describes an exported image."""
 
-    def __init__(self, photo, container, export_directory, base_name, options):
+    def __init__(self, photo, container, export_directory, base_name, options,
+                 duplicate_index=None):
         """Creates a new ExportFile object."""
         self.photo = photo
         self.container = container
+        # With --duplicates link, the duplicates.DuplicateIndex and the group
+        # of the image, if it has duplicates.
+        self.duplicate_index = None
+        self.duplicate_group = None
+        if duplicate_index and options.duplicates == 'link':
+            self.duplicate_group = duplicate_index.getgroup(photo)
+            if self.duplicate_group is not None:
+                self.duplicate_index = duplicate_index
         # We cannot resize movie files.
         if options.size and not imageutils.is_movie_file(photo.image_path):
             self.size = options.size
@@ -109,10 +123,11 @@ class ExportFile(object):
         # Location of "Original" file, if any.
         originals_folder = u"Originals"
         if options.picasa:
-            if (os.path.exists(os.path.join(export_directory,
-                                            u".picasaoriginals")) or
-                not os.path.exists(os.path.join(export_directory,
-                                                u"Originals"))):
+            stat_cache = su.get_stat_cache()
+            if (stat_cache.exists(os.path.join(export_directory,
+                                               u".picasaoriginals")) or
+                not stat_cache.exists(os.path.join(export_directory,
+                                                   u"Originals"))):
                 originals_folder = u".picasaoriginals"
         if photo.originalpath:
             self.original_export_file = os.path.join(
@@ -125,39 +140,52 @@ class ExportFile(object):
         """Gets the associated iPhotoImage."""
         return self.photo
 
-    def _check_need_to_export(self, source_file, options):
+    def get_stat_paths(self, options):
+        """Returns the paths plan() looks up (see
+        systemutils.StatCache.prefetch())."""
+        paths = [self.photo.image_path, self.export_file]
+        if (options.originals and self.photo.originalpath and
+            not self.photo.rotation_is_only_edit):
+            paths.append(self.photo.originalpath)
+            paths.append(self.original_export_file)
+            paths.append(os.path.dirname(self.original_export_file))
+        return paths
+
+    def _check_need_to_export(self, source_file, options, link):
         """Returns true if the image file needs to be exported.
 
         Args:
           source_file: path to image file, with aliases resolved.
           options: processing options.
+          link: True if the export is a link to source_file.
         """
-        if not os.path.exists(self.export_file):
+        stat_cache = su.get_stat_cache()
+        if not stat_cache.exists(self.export_file):
             return True
+        source_stat = stat_cache.checked_stat(source_file)
         # In link mode, check the inode.
-        if options.link:
-            export_stat = os.stat(self.export_file)
-            source_stat = os.stat(source_file)
+        if link:
+            export_stat = stat_cache.stat(self.export_file)
             if export_stat.st_ino != source_stat.st_ino:
                 su.pout('Changed:  %s: inodes don\'t match: %d vs. %d' %
                     (self.export_file, export_stat.st_ino, source_stat.st_ino))
                 return True
         if (not options.reverse
-            and os.path.getmtime(self.export_file) + _MTIME_FUDGE <
-            os.path.getmtime(source_file)):
+            and stat_cache.getmtime(self.export_file) + _MTIME_FUDGE <
+            stat_cache.getmtime(source_file)):
             su.pout('Changed:  %s: newer version is available: %s vs. %s' %
                     (self.export_file,
-                     time.ctime(os.path.getmtime(self.export_file)),
-                     time.ctime(os.path.getmtime(source_file))))
+                     time.ctime(stat_cache.getmtime(self.export_file)),
+                     time.ctime(stat_cache.getmtime(source_file))))
             return True
 
         if (options.reverse
-            and os.path.getmtime(source_file) + _MTIME_FUDGE <
-            os.path.getmtime(self.export_file)):
+            and stat_cache.getmtime(source_file) + _MTIME_FUDGE <
+            stat_cache.getmtime(self.export_file)):
             su.pout('Changed:  %s: newer version is available: %s vs. %s' %
                     (self.export_file,
-                     time.ctime(os.path.getmtime(source_file)),
-                     time.ctime(os.path.getmtime(self.export_file))))
+                     time.ctime(stat_cache.getmtime(source_file)),
+                     time.ctime(stat_cache.getmtime(self.export_file))))
             return True
         
         if not self.size and not options.reverse:
@@ -165,10 +193,10 @@ class ExportFile(object):
             # stale files if titles get swapped between images. Double
             # check the size, allowing for some difference for meta data
             # changes made in the exported copy
-            source_size = os.path.getsize(source_file)
-            export_size = os.path.getsize(self.export_file)
+            source_size = stat_cache.getsize(source_file)
+            export_size = stat_cache.getsize(self.export_file)
             diff = abs(source_size - export_size)
-            if diff > _MAX_FILE_DIFF or (diff > 32 and options.link):
+            if diff > _MAX_FILE_DIFF or (diff > 32 and link):
                 su.pout('Changed:  %s: file size: %d vs. %d' %
                         (self.export_file, export_size, source_size))
                 return True
@@ -197,35 +225,30 @@ class ExportFile(object):
         #    return True
         return False
 
-    def _generate_original(self, options):
-        """Exports the original file."""
+    def _check_need_to_export_original(self, original_source_file, options):
+        """Returns true if the original file needs to be exported."""
         do_original_export = False
-        export_dir = os.path.split(self.original_export_file)[0]
-        if not os.path.exists(export_dir):
-            su.pout("Creating folder " + export_dir)
-            if not options.dryrun:
-                os.mkdir(export_dir)
-        original_source_file = su.resolve_alias(self.photo.originalpath)
-        if os.path.exists(self.original_export_file):
+        stat_cache = su.get_stat_cache()
+        if stat_cache.exists(self.original_export_file):
+            source_stat = stat_cache.checked_stat(original_source_file)
             # In link mode, check the inode.
             if options.link:
-                export_stat = os.stat(self.original_export_file)
-                source_stat = os.stat(original_source_file)
+                export_stat = stat_cache.stat(self.original_export_file)
                 if export_stat.st_ino != source_stat.st_ino:
                     su.pout('Changed:  %s: inodes don\'t match: %d vs. %d' %
                             (self.original_export_file, export_stat.st_ino, source_stat.st_ino))
                     do_original_export = True
-            if (os.path.getmtime(self.original_export_file) + _MTIME_FUDGE <
-                os.path.getmtime(original_source_file)):
+            if (stat_cache.getmtime(self.original_export_file) + _MTIME_FUDGE <
+                stat_cache.getmtime(original_source_file)):
                 su.pout('Changed:  %s: newer version is available: %s vs. %s' %
                         (self.original_export_file,
-                         time.ctime(os.path.getmtime(
+                         time.ctime(stat_cache.getmtime(
                              self.original_export_file)),
-                         time.ctime(os.path.getmtime(original_source_file))))
+                         time.ctime(stat_cache.getmtime(original_source_file))))
                 do_original_export = True
             elif not self.size:
-                source_size = os.path.getsize(original_source_file)
-                export_size = os.path.getsize(self.original_export_file)
+                source_size = stat_cache.getsize(original_source_file)
+                export_size = stat_cache.getsize(self.original_export_file)
                 diff = abs(source_size - export_size)
                 if diff > _MAX_FILE_DIFF or (diff > 0 and options.link):
                     su.pout(u'Changed:  %s: file size: %d vs. %d' %
@@ -234,58 +257,257 @@ class ExportFile(object):
                     do_original_export = True
         else:
             do_original_export = True
+        return do_original_export
+
+    def _check_content(self, export_file, source_file, options_key, link,
+                       size, manifest, digests):
+        """Decides whether an exported file changed by the digests of the
+        content of the files (--content_digest), instead of their sizes and
+        inodes.
+
+        A file whose manifest record has content digests changed if either
+        file differs from its recorded content. Without such a record, a file
+        that has the content of its source is up to date, and a link that
+        does not needs to be made again.
+
+        Args:
+          digests: duplicates.DigestMemo that remembers the digests.
+        Returns:
+          (True if the file needs to be exported, False if it is up to date,
+          or None if the digests can't tell; the manifest record of the file
+          if the digests match it, or None).
+        """
+        stat_cache = su.get_stat_cache()
+        export_stat = stat_cache.stat(export_file)
+        if not export_stat:
+            return (True, None)
+        source_digest = digests.get_digest(
+            source_file, stat_cache.checked_stat(source_file))
+        export_digest = digests.get_digest(export_file, export_stat)
+        if not source_digest or not export_digest:
+            return (None, None)
+        record = manifest.get(export_file) if manifest else None
+        if (record and record.source_digest and
+            record.source == source_file and record.options == options_key):
+            if record.source_digest != source_digest:
+                su.pout(u'Changed:  %s: content of %s changed' % (
+                    export_file, source_file))
+                return (True, None)
+            if record.export_digest != export_digest:
+                su.pout(u'Changed:  %s: content changed since the export' % (
+                    export_file))
+                return (True, None)
+            return (False, record)
+        if not size:
+            if source_digest == export_digest:
+                return (False, None)
+            if link:
+                su.pout(u'Changed:  %s: content differs from %s' % (
+                    export_file, source_file))
+                return (True, None)
+        return (None, None)
+
+    def _plan_original(self, options, plan, manifest, digests):
+        """Plans the export of the original file."""
+        stat_cache = su.get_stat_cache()
+        export_dir = os.path.split(self.original_export_file)[0]
+        if not stat_cache.exists(export_dir):
+            plan.add_folder(export_dir)
+        original_source_file = su.resolve_alias(self.photo.originalpath)
+        options_key = exportmanifest.get_options_key(options.link, self.size)
+        record = None
+        if manifest:
+            record = manifest.get_current(self.original_export_file,
+                                          original_source_file, options_key,
+                                          stat_cache)
+        # Record of the file that is known to be right, but needs to be
+        # recorded again.
+        content_record = None
+        changed = None
+        if not record and digests is not None:
+            (changed, content_record) = self._check_content(
+                self.original_export_file, original_source_file, options_key,
+                options.link, self.size, manifest, digests)
+        if record:
+            do_original_export = False
+        elif changed is not None:
+            do_original_export = changed
+        else:
+            do_original_export = self._check_need_to_export_original(
+                original_source_file, options)
+        known_record = record or content_record
+        metadata = known_record.metadata if known_record else None
 
         do_iptc = (options.iptc == 1 and
                    do_original_export) or options.iptc == 2
-        if do_iptc and (options.link or options.iptc_masters):
-            if self.check_iptc_data(original_source_file, options,
+        if do_iptc and options.link:
+            (changed, metadata) = self._check_metadata(
+                original_source_file, options, plan, known_record,
+                is_original=True, file_updated=do_original_export)
+            if changed:
+                do_original_export = True
+        elif do_iptc and options.iptc_masters:
+            if self.check_iptc_data(original_source_file, options, plan,
                                     is_original=True, file_updated=do_original_export):
                 do_original_export = True
-        exists = True  # True if the file exists or was updated.
+        exists = True  # True if the file exists or will be exported.
         if do_original_export:
-            exists = imageutils.copy_or_link_file(original_source_file,
-                                                  self.original_export_file,
-                                                  options.dryrun,
-                                                  options.link,
-                                                  self.size,
-                                                  options)
+            exists = plan.add_export(original_source_file,
+                                     self.original_export_file, options.link,
+                                     self.size, options)
         else:
             _logger.debug(u'%s up to date.', self.original_export_file)
         if exists and do_iptc and not options.link:
-            self.check_iptc_data(self.original_export_file, options,
-                                 is_original=True, file_updated=do_original_export)
+            (_, metadata) = self._check_metadata(
+                self.original_export_file, options, plan, known_record,
+                is_original=True, file_updated=do_original_export,
+                iptc_file=self._get_iptc_file(original_source_file,
+                                              self.original_export_file, plan))
+        if manifest:
+            self._plan_record(plan, record, self.original_export_file,
+                              original_source_file, options_key, metadata,
+                              do_original_export, exists)
+
+    def _get_iptc_file(self, source_file, export_file, plan):
+        """Returns the file to read the current IPTC data of an exported file
+        from: the source file if the plan exports it again."""
+        if plan.will_write(export_file):
+            return source_file
+        return export_file
+
+    def _get_metadata_digest(self, options, is_original):
+        """Returns a digest of the IPTC data check_iptc_data() makes sure an
+        exported file has."""
+        do_faces = options.faces and not is_original
+        values = (
+            imageutils.get_photo_caption(self.photo, self.container,
+                                         options.captiontemplate),
+            bool(options.aperture),
+            self.get_export_keywords(options.face_keywords),
+            self.photo.rating,
+            self.photo.gps.to_string() if options.gps and self.photo.gps else None,
+            (self.photo.face_rectangles, self.photo.faces) if do_faces else None)
+        return hashlib.md5(repr(values)).hexdigest()
+
+    def _check_metadata(self, export_file, options, plan, record,
+                        is_original=False, file_updated=False, iptc_file=None):
+        """Like check_iptc_data(), but does not read the IPTC data of an
+        unchanged file if its manifest record shows it has the right data.
+
+        Returns: (True if the IPTC data needs an update, digest of the IPTC
+        data the file has once the plan ran, or None if not known).
+        """
+        digest = self._get_metadata_digest(options, is_original)
+        if record and not file_updated and record.metadata == digest:
+            return (False, digest)
+        changed = self.check_iptc_data(export_file, options, plan,
+                                       is_original, file_updated, iptc_file)
+        if changed and not plan.will_write_metadata(export_file):
+            # The update was not planned (e.g., because of --max_update).
+            digest = None
+        return (changed, digest)
+
+    def _plan_record(self, plan, record, export_file, source_file,
+                     options_key, metadata, do_export, exists):
+        """Plans to record an exported file in the export manifest, unless
+        its record is up to date, or the file is not."""
+        written = plan.will_write(export_file)
+        if not exists or (do_export and not written):
+            return
+        if (record and not written and
+            not plan.will_write_metadata(export_file) and
+            record.metadata == metadata):
+            return
+        plan.add_record(export_file, source_file, options_key, metadata)
+
+    def plan(self, options, plan, manifest=None, digests=None):
+        """Plans the actions that make sure all files exist in other album
+        (see exportplan.ExportPlan).
 
-    def generate(self, options):
-        """makes sure all files exist in other album, and generates if
-           necessary."""
+        Args:
+          manifest: exportmanifest.ExportManifest of the export folder. Files
+              that did not change since they were recorded are not checked
+              again, and changed files are recorded again.
+          digests: duplicates.DigestMemo, for --content_digest (see
+              _check_content()).
+        """
         try:
+            stat_cache = su.get_stat_cache()
             source_file = su.resolve_alias(self.photo.image_path)
-            do_export = self._check_need_to_export(source_file, options)
+            link = options.link
+            size = self.size
+            duplicate_file = None
+            if self.duplicate_index:
+                # Link to the file exported for a duplicate of the image.
+                duplicate_file = self.duplicate_index.get_export(
+                    self.duplicate_group)
+                if duplicate_file:
+                    source_file = duplicate_file
+                    link = True
+                    size = None
+            options_key = exportmanifest.get_options_key(link, size)
+            record = None
+            content_record = None
+            if duplicate_file and plan.will_write(duplicate_file):
+                # The file to link to is exported by this plan, so the link
+                # has to be made again.
+                do_export = True
+            else:
+                if manifest:
+                    record = manifest.get_current(self.export_file,
+                                                  source_file, options_key,
+                                                  stat_cache)
+                changed = None
+                if not record and digests is not None:
+                    (changed, content_record) = self._check_content(
+                        self.export_file, source_file, options_key, link,
+                        size, manifest, digests)
+                if record:
+                    do_export = False
+                elif changed is not None:
+                    do_export = changed
+                else:
+                    do_export = self._check_need_to_export(source_file,
+                                                           options, link)
+            known_record = record or content_record
+            metadata = known_record.metadata if known_record else None
 
             # if we use links, we update the IPTC data in the original file
             do_iptc = (options.iptc == 1 and do_export) or options.iptc == 2
             if do_iptc and options.link:
-                if self.check_iptc_data(source_file, options, file_updated=do_export):
+                (changed, metadata) = self._check_metadata(
+                    source_file, options, plan, known_record,
+                    file_updated=do_export)
+                if changed:
                     do_export = True
 
-            exists = True  # True if the file exists or was updated.
+            exists = True  # True if the file exists or will be exported.
             if do_export:
-                exists = imageutils.copy_or_link_file(source_file,
-                                                      self.export_file,
-                                                      options.dryrun,
-                                                      options.link,
-                                                      self.size,
-                                                      options)
+                exists = plan.add_export(source_file, self.export_file, link,
+                                         size, options)
             else:
                 _logger.debug(u'%s up to date.', self.export_file)
+            if self.duplicate_index and exists:
+                if duplicate_file:
+                    self.duplicate_index.add_linked(self.duplicate_group)
+                else:
+                    self.duplicate_index.set_export(self.duplicate_group,
+                                                    self.export_file)
 
             # if we copy, we update the IPTC data in the copied file
             if exists and do_iptc and not options.link:
-                self.check_iptc_data(self.export_file, options, file_updated=do_export)
+                (_, metadata) = self._check_metadata(
+                    self.export_file, options, plan, known_record,
+                    file_updated=do_export,
+                    iptc_file=self._get_iptc_file(source_file,
+                                                  self.export_file, plan))
+            if manifest:
+                self._plan_record(plan, record, self.export_file, source_file,
+                                  options_key, metadata, do_export, exists)
 
             if (options.originals and self.photo.originalpath and
                 not self.photo.rotation_is_only_edit):
-                self._generate_original(options)
+                self._plan_original(options, plan, manifest, digests)
         except (OSError, MacOS.Error) as ose:
             su.perr(u"Failed to export %s to %s: %s" % (self.photo.image_path, self.export_file,
                                                         ose))
@@ -342,14 +564,22 @@ class ExportFile(object):
 
         return (None, None)
     
-    def check_iptc_data(self, export_file, options, is_original=False, file_updated=False):
+    def check_iptc_data(self, export_file, options, plan, is_original=False,
+                        file_updated=False, iptc_file=None):
         """Tests if a file has the proper keywords and caption in the meta
-           data."""
+           data, and plans an update of the meta data if it doesn't.
+
+        Args:
+          iptc_file: if set, the file to read the current meta data from,
+              e.g., the source of a copy that is not made yet.
+        """
         if not su.getfileextension(export_file) in _EXIF_EXTENSIONS:
             return False
         messages = []
 
-        iptc_data = exiftool.get_iptc_data(export_file)
+        if not iptc_file:
+            iptc_file = export_file
+        iptc_data = exiftool.get_iptc_data(iptc_file)
          
         new_caption = imageutils.get_photo_caption(self.photo, self.container,
                                                    options.captiontemplate)
@@ -413,11 +643,17 @@ class ExportFile(object):
             (not options.reverse and iptc_data.hierarchical_subject) or
             new_gps or new_rating != -1 or new_rectangles != None or new_persons != None):
             su.pout(u'Updating IPTC for %s because of\n%s' % (export_file, u'\n'.join(messages)))
-            if (file_updated or imageutils.should_update(options)) and not options.dryrun:
-                exiftool.update_iptcdata(export_file, new_caption, new_keywords,
-                                         new_date, new_rating, new_gps,
-                                         new_rectangles, new_persons, iptc_data.image_width,
-                                         iptc_data.image_height, hierarchical_subject=[])
+            if file_updated or imageutils.should_update(options):
+                if iptc_file == export_file:
+                    (image_width, image_height) = (iptc_data.image_width,
+                                                   iptc_data.image_height)
+                else:
+                    # The export may be resized; read its dimensions once it
+                    # exists.
+                    (image_width, image_height) = (None, None)
+                plan.add_metadata(export_file, new_caption, new_keywords,
+                                  new_rating, new_gps, new_rectangles,
+                                  new_persons, image_width, image_height)
             return True
         return False
 
@@ -430,22 +666,36 @@ _YEAR_PATTERN_INDEX = re.compile(r'([0-9][0-9][0-9][0-9]) (.*)')
 class ExportDirectory(object):
     """Tracks an album folder in the export location."""
 
-    def __init__(self, name, iphoto_container, albumdirectory):
+    def __init__(self, name, iphoto_container, albumdirectory,
+                 duplicate_index=None):
         self.name = name
         self.iphoto_container = iphoto_container
         self.albumdirectory = albumdirectory
         self.files = {} # lower case file names -> ExportFile
+        # duplicates.DuplicateIndex, for --duplicates.
+        self.duplicate_index = duplicate_index
 
     def add_iphoto_images(self, images, options):
         """Works through an image folder tree, and builds data for exporting."""
         entries = 0
         template = options.nametemplate
+        skip_duplicates = (self.duplicate_index and
+                           options.duplicates == 'skip')
+        duplicate_groups = set()  # groups with an image in this folder
 
         if images is not None:
             entry_digits = len(str(len(images)))
             for image in images:
                 if image.ismovie() and not options.movies:
                     continue
+                if skip_duplicates:
+                    group = self.duplicate_index.getgroup(image)
+                    if group in duplicate_groups:
+                        _logger.debug(u'Skipping duplicate %s.', image.image_path)
+                        self.duplicate_index.add_skipped(group)
+                        continue
+                    if group is not None:
+                        duplicate_groups.add(group)
                 entries += 1
                 image_basename = self.make_album_basename(
                     image,
@@ -453,7 +703,8 @@ class ExportDirectory(object):
                     str(entries).zfill(entry_digits),
                     template)
                 picture_file = ExportFile(image, self.iphoto_container, self.albumdirectory,
-                                          image_basename, options)
+                                          image_basename, options,
+                                          self.duplicate_index)
                 self.files[image_basename.lower()] = picture_file
 
         return entries
@@ -476,14 +727,11 @@ class ExportDirectory(object):
             index += 1
         return base_name
 
-    def load_album(self, options):
+    def load_album(self, options, plan):
         """walks the album directory tree, and scans it for existing files."""
         if not os.path.exists(self.albumdirectory):
-            su.pout("Creating folder " + self.albumdirectory)
-            if not options.dryrun:
-                os.makedirs(self.albumdirectory)
-            else:
-                return
+            plan.add_folder(self.albumdirectory)
+            return
         file_list = os.listdir(self.albumdirectory)
         if file_list is None:
             return
@@ -500,11 +748,12 @@ class ExportDirectory(object):
                 if (options.originals and
                     (f == "Originals" or (options.picasa and
                                           f == ".picasaoriginals"))):
-                    self.scan_originals(album_file, options)
+                    self.scan_originals(album_file, options, plan)
                     continue
                 else:
                     delete_album_file(album_file, self.albumdirectory,
-                                      "Obsolete export directory", options)
+                                      "Obsolete export directory", options,
+                                      plan)
                     continue
 
             base_name = unicodedata.normalize("NFC",
@@ -514,9 +763,9 @@ class ExportDirectory(object):
             # everything else must have a master, or will have to go
             if master_file is None or not master_file.is_part_of(album_file):
                 delete_album_file(album_file, self.albumdirectory,
-                                  "Obsolete exported file", options)
+                                  "Obsolete exported file", options, plan)
 
-    def scan_originals(self, folder, options):
+    def scan_originals(self, folder, options, plan):
         """Scan a folder of Original images, and delete obsolete ones."""
         file_list = os.listdir(folder)
         if not file_list:
@@ -531,7 +780,7 @@ class ExportDirectory(object):
             if os.path.isdir(originalfile):
                 delete_album_file(originalfile, self.albumdirectory,
                                   "Obsolete export Originals directory",
-                                  options)
+                                  options, plan)
                 continue
 
             base_name = unicodedata.normalize("NFC",
@@ -543,14 +792,34 @@ class ExportDirectory(object):
                 originalfile != master_file.original_export_file or
                 master_file.photo.rotation_is_only_edit):
                 delete_album_file(originalfile, originalfile,
-                                  "Obsolete Original", options)
+                                  "Obsolete Original", options, plan)
 
-    def generate_files(self, options):
-        """Generates the files in the export location."""
-        if not os.path.exists(self.albumdirectory) and not options.dryrun:
-            os.makedirs(self.albumdirectory)
-        for f in sorted(self.files):
-            self.files[f].generate(options)
+    def plan_files(self, options, plan, library_diff=None, manifest=None,
+                   digests=None):
+        """Plans the files in the export location.
+
+        Args:
+          options: processing options.
+          plan: exportplan.ExportPlan to add the actions to.
+          library_diff: if set, an iphotodata.LibraryDiff against the library
+              of the last export. Unless this folder's album changed, only the
+              files of added or modified images are checked.
+          manifest: exportmanifest.ExportManifest of the export folder.
+          digests: duplicates.DigestMemo, for --content_digest.
+        """
+        if not os.path.exists(self.albumdirectory):
+            plan.add_folder(self.albumdirectory)
+        if library_diff and library_diff.is_changed_container(self.iphoto_container):
+            library_diff = None
+        export_files = [self.files[f] for f in sorted(self.files)
+                        if not library_diff or
+                        library_diff.is_changed_image(self.files[f].photo)]
+        stat_paths = []
+        for export_file in export_files:
+            stat_paths.extend(export_file.get_stat_paths(options))
+        su.get_stat_cache().prefetch(stat_paths)
+        for export_file in export_files:
+            export_file.plan(options, plan, manifest, digests)
 
 
 class IPhotoFace(iphotodata.IPhotoContainer):
@@ -571,6 +840,15 @@ class ExportLibrary(object):
         self.albumdirectory = albumdirectory
         self.named_folders = {}
         self._abort = False
+        # duplicates.DuplicateIndex of the library, for --duplicates.
+        self.duplicate_index = None
+        # Changes to the export folder, run by generate_files().
+        self.plan = exportplan.ExportPlan()
+        # exportmanifest.ExportManifest of the export folder, unless
+        # options.manifest is off.
+        self.manifest = None
+        # duplicates.DigestMemo, for --content_digest.
+        self.digests = None
 
     def abort(self):
         """Signals that a currently running export should be aborted as soon
@@ -678,7 +956,8 @@ class ExportLibrary(object):
             # now the album itself
             picture_directory = ExportDirectory(
                 sub_name, sub_album,
-                os.path.join(self.albumdirectory, sub_name))
+                os.path.join(self.albumdirectory, sub_name),
+                self.duplicate_index)
             if picture_directory.add_iphoto_images(sub_album.images,
                                                    options) > 0:
                 self.named_folders[sub_name] = picture_directory
@@ -686,16 +965,24 @@ class ExportLibrary(object):
         return len(self.named_folders)
 
     def load_album(self, options):
-        """Loads an existing album (export folder)."""
-        if not os.path.exists(self.albumdirectory) and not options.dryrun:
-            os.makedirs(self.albumdirectory)
+        """Loads an existing album (export folder), and plans to delete
+        obsolete files."""
+        if not os.path.exists(self.albumdirectory):
+            self.plan.add_folder(self.albumdirectory)
+        # The manifest does not know about changes in the reverse direction.
+        if options.manifest and not options.reverse:
+            self.manifest = exportmanifest.ExportManifest(self.albumdirectory,
+                                                          self.digests)
+            if options.rebuild_manifest:
+                self.manifest.clear(options.dryrun)
+            self.plan.manifest_path = self.manifest.path
 
         album_directories = {}
         for folder in sorted(self.named_folders.values()):
             if self._check_abort():
                 return
             album_directories[folder.albumdirectory] = True
-            folder.load_album(options)
+            folder.load_album(options, self.plan)
 
         self.check_directories(self.albumdirectory, "", album_directories,
                                options)
@@ -724,7 +1011,7 @@ class ExportLibrary(object):
                 elif not self.check_directories(album_file, rel_path_file,
                                                 album_directories, options):
                     delete_album_file(album_file, directory,
-                                      "Obsolete directory", options)
+                                      "Obsolete directory", options, self.plan)
                 else:
                     contains_albums = True
             else:
@@ -732,22 +1019,98 @@ class ExportLibrary(object):
                 if imageutils.is_ignore(f):
                     continue
                 delete_album_file(album_file, directory, "Obsolete",
-                                  options)
+                                  options, self.plan)
 
         return contains_albums
 
-    def generate_files(self, options):
-        """Walks through the export tree and sync the files."""
-        if not os.path.exists(self.albumdirectory) and not options.dryrun:
-            os.makedirs(self.albumdirectory)
-        for ndir in sorted(self.named_folders):
-            if self._check_abort():
-                break
-            self.named_folders[ndir].generate_files(options)
-
+    def generate_files(self, options, library_diff=None):
+        """Walks through the export tree and plans the changes to the files,
+        then runs the plan, unless options.dryrun is set. With options.plan,
+        saves the plan first.
 
-def export_iphoto(library, data, excludes, options):
-    """Main routine for exporting iPhoto images."""
+        Returns: the exportplan.ExecutionStats of the run, or None if the plan
+        was not run (dry run, or the export was cancelled while planning).
+        """
+        if self._check_abort():
+            return None
+        if not os.path.exists(self.albumdirectory):
+            self.plan.add_folder(self.albumdirectory)
+        try:
+            for ndir in sorted(self.named_folders):
+                if self._check_abort():
+                    return None
+                self.named_folders[ndir].plan_files(options, self.plan,
+                                                    library_diff, self.manifest,
+                                                    self.digests)
+            su.pout(u'Planned: %s.' % (self.plan.get_summary()))
+            if self.manifest and self.manifest.hits:
+                su.pout(u'%d files are up to date according to the export '
+                        u'manifest.' % (self.manifest.hits))
+            if options.plan:
+                plan_path = su.expand_home_folder(options.plan)
+                self.plan.save(plan_path)
+                su.pout(u'Saved the plan to %s.' % (plan_path))
+            if options.dryrun:
+                return None
+            return run_plan(self.plan, options, self._check_abort,
+                            self.manifest)
+        finally:
+            if self.manifest:
+                self.manifest.close()
+
+
+def run_plan(plan, options, check_abort=None, manifest=None):
+    """Runs an exportplan.ExportPlan on options.copy_threads threads, and
+    reports the throughput and failed actions. Updates the
+    exportmanifest.ExportManifest, if set. Returns the
+    exportplan.ExecutionStats."""
+    stats = exportplan.execute_plan(
+        plan, check_abort, options.copy_threads,
+        options.copy_mb_in_flight * 1024 * 1024, manifest)
+    if stats.actions:
+        su.pout(u'Ran %s.' % (stats.get_summary()))
+    if stats.failures:
+        su.perr(u'%d of %d planned actions failed or were skipped.' % (
+            stats.failures, len(plan)))
+    return stats
+
+
+def find_duplicates(data, memo):
+    """Returns the duplicates.DuplicateIndex of a library. Uses and updates
+    the file digests of a duplicates.DigestMemo."""
+    su.pout(u"Looking for duplicate images...")
+    reads = memo.reads
+    duplicate_index = duplicates.find_duplicates(data.images, memo,
+                                                 su.get_stat_cache())
+    su.pout(u"Found %d duplicate images (%.1f MB) in %d groups, read %d files." % (
+        duplicate_index.get_duplicate_count(),
+        duplicate_index.get_duplicate_bytes() / 1024.0 / 1024.0,
+        len(duplicate_index.groups), memo.reads - reads))
+    return duplicate_index
+
+def export_iphoto(library, data, excludes, options, library_diff=None):
+    """Main routine for exporting iPhoto images.
+
+    If library_diff is set, only files of changed albums and images are
+    checked (see ExportDirectory.plan_files()).
+
+    Returns: what library.generate_files() returns, the
+    exportplan.ExecutionStats of the run for an ExportLibrary.
+    """
+
+    duplicate_index = None
+    memo = None
+    if ((options.duplicates or options.content_digest) and
+        isinstance(library, ExportLibrary)):
+        # The saved file digests, shared by both.
+        memo_path = duplicates.get_memo_path()
+        memo = duplicates.load_memo(memo_path)
+    if options.duplicates and memo is not None:
+        duplicate_index = find_duplicates(data, memo)
+        library.duplicate_index = duplicate_index
+    if (options.content_digest and memo is not None and
+        not options.reverse):
+        library.digests = memo
 
     print "Scanning iPhoto data for photos to export..."
     if options.events:
@@ -770,11 +1133,83 @@ def export_iphoto(library, data, excludes, options):
                                unicode(options.facealbum_prefix),
                                ".", excludes, options)
 
+    if options.placealbums:
+        library.process_albums(
+            data.getplacealbums(options.place_radius, options.place_min_images),
+            ["Place"], unicode(options.placealbum_prefix), ".", excludes,
+            options)
+
+    if options.query:
+        try:
+            query_album = iphotodata.IPhotoQueryAlbum(
+                su.unicode_string(options.query_album),
+                data.run_query(su.unicode_string(options.query)))
+            library.process_albums([query_album], ["Query"], u'', ".", None,
+                                   options)
+        except ValueError, ex:
+            su.perr(u'Invalid query: %s' % (ex))
+
     print "Scanning existing files in export folder..."
     library.load_album(options)
 
     print "Exporting photos from iPhoto to export folder..."
-    library.generate_files(options)
+    if library_diff:
+        stats = library.generate_files(options, library_diff)
+    else:
+        stats = library.generate_files(options)
+    if duplicate_index:
+        su.pout(u'Duplicates: %d skipped, %d linked, %.1f MB saved.' % (
+            duplicate_index.skipped, duplicate_index.linked,
+            duplicate_index.saved_bytes / 1024.0 / 1024.0))
+    if memo is not None:
+        if library.digests is not None and memo.lookups:
+            su.pout(u'Content digests: %s.' % (memo.get_summary()))
+        if memo.reads:
+            duplicates.save_memo(memo_path, memo)
+    stat_cache = su.get_stat_cache()
+    if stat_cache.requests:
+        su.pout(u'Looked up %d file states with %d stat calls (%d calls saved).' % (
+            stat_cache.requests, stat_cache.syscalls,
+            stat_cache.get_saved_syscalls()))
+    return stats
+
+# Options that select the exported containers and images, or change how their
+# files are made. An --incremental export only uses the baseline of the last
+# one if these were the same.
+_EXPORT_OPTIONS = (
+    'albums', 'captiontemplate', 'duplicates', 'events', 'exclude',
+    'face_keywords', 'facealbum_prefix', 'facealbums', 'faces', 'folderhints',
+    'folderpatterns', 'foldertemplate', 'gps', 'ignore', 'iptc',
+    'iptc_masters', 'link', 'movies', 'nametemplate', 'originals', 'picasa',
+    'place_min_images', 'place_radius', 'placealbum_prefix', 'placealbums',
+    'query', 'query_album', 'ratings', 'size', 'smarts')
+
+def get_export_options(options):
+    """Returns the (name, value) pairs of the options that select and shape
+    the exported files, for the baseline of --incremental exports."""
+    return tuple([(name, getattr(options, name, None))
+                  for name in _EXPORT_OPTIONS])
+
+def get_excluded_xml_paths(options, events_in_albums=False):
+    """Returns the key paths in the library XML file that are not needed for
+    the options (see applexml.make_projection()).
+
+    Args:
+      events_in_albums: True if the library lists its events in its "List of
+          Albums" (see iphotodata.has_events_in_albums()), so the images of the
+          albums are needed for the events.
+    """
+    excluded_paths = []
+    if not (options.albums or options.smarts or options.checkalbumsize or
+            options.query or events_in_albums):
+        # Only events are exported, so we only need the album tree.
+        excluded_paths.append(("List of Albums", None, "KeyList"))
+        excluded_paths.append(("List of Albums", None, "KeyListString"))
+    if not (options.faces or options.face_keywords or options.facealbums or
+            options.query or 'face_list' in options.captiontemplate):
+        excluded_paths.append(("List of Faces",))
+        excluded_paths.append(("Master Image List", None, "Faces"))
+    return excluded_paths
 
 USAGE = """usage: %prog [options]
 Exports images and movies from an iPhoto library into a folder.
@@ -799,6 +1234,20 @@ def get_option_parser():
         '--checkalbumsize',
         help='''If set, list any event or album containing more than the
             specified number of images.''')
+    p.add_option("--content_digest", action="store_true",
+                 help="""Decide whether exported files changed by comparing
+                 digests of their content, instead of their sizes (and inodes
+                 with --link). Digests are remembered by file, so files that
+                 did not change are not read again, but the first run reads
+                 all files.""")
+    p.add_option("--copy_mb_in_flight", type='int',
+                 default=exportplan.DEFAULT_BYTES_IN_FLIGHT / 1024 / 1024,
+                 help="""Maximum size (MB) of the files copied at the same
+                 time. Default: 256.""")
+    p.add_option("--copy_threads", type='int',
+                 default=exportplan.DEFAULT_THREADS,
+                 help="""Number of files copied, linked, or deleted at the
+                 same time. Default: 4.""")
     p.add_option(
         "-d", "--delete", action="store_true",
         help="Delete obsolete files that are no longer in your iPhoto library.")
@@ -806,6 +1255,11 @@ def get_option_parser():
         "--dryrun", action="store_true",
         help="""Show what would have been done, but don't change or copy any
              files.""")
+    p.add_option("--duplicates", type='choice', choices=['skip', 'link'],
+                 help="""Find images with identical files. "skip" exports
+                 only the first of identical images in a folder, "link"
+                 exports identical images as hard links to one file ("link"
+                 cannot be used with --link, --iptc or --iptcall).""")
     p.add_option("-e", "--events",
                  help="""Export matching events. The argument is
                  a regular expression. Use -e . to export all events.""")
@@ -837,6 +1291,14 @@ def get_option_parser():
                  help="""Pattern for folders to ignore in the export folder (use
                       with --delete if you have extra folders folders that you 
                       don't want iphoto_export to delete.""")
+    p.add_option("--incremental", action="store_true",
+                 help="""Only check the files of events, albums, and images that
+                 changed since the last --incremental export into the same
+                 folder with the same selection and export options. Files that
+                 are missing from the export folder for other reasons are not
+                 recreated. Only runs with --update, and
+                 without --dryrun, --max_create, or --max_update, are recorded
+                 for the next run.""")
     p.add_option("--iphoto",
                  help="""Path to iPhoto library, e.g.
                  "%s/Pictures/iPhoto Library".""",
@@ -854,6 +1316,10 @@ def get_option_parser():
     p.add_option("--iptc_masters",
                  action="store_true",
                  help="""Check and update IPTC data in the master files in the library.""")
+    p.add_option("--lazy", action="store_true",
+                 help="""Only read the images of the library that are exported.
+                 Speeds up exports of a few events or albums from a large
+                 library. Does not use the library snapshot.""")
     p.add_option(
       "-l", "--link", action="store_true",
       help="""Use links instead of copying files. Use with care, as changes made
@@ -868,8 +1334,22 @@ def get_option_parser():
     p.add_option(
       "-n", "--nametemplate", default="{title}",
       help="""Template for naming image files. Default: "{title}".""")
+    p.add_option("--no_manifest", action="store_false", dest="manifest",
+                 default=True,
+                 help="""Don't use or update the manifest of exported files in
+                 the export folder (%s), which lets unchanged files skip the
+                 checks of their size, dates, and IPTC data."""
+                 % (exportmanifest.MANIFEST_NAME))
+    p.add_option("--no_snapshot", action="store_false", dest="snapshot",
+                 default=True,
+                 help="""Always read the library XML file, instead of loading
+                 the library from the snapshot saved by a previous run.""")
     p.add_option("-o", "--originals", action="store_true",
                       help="Export original files into Originals.")
+    p.add_option("--parse_processes", type='int', default=1,
+                 help="""Number of processes that parse the images of the
+                 library XML file in parallel, or 0 for one per CPU. Not used
+                 with --lazy.""")
     p.add_option("--picasa", action="store_true",
                       help="Store originals in .picasaoriginals")
     p.add_option('--picasapassword',
@@ -877,14 +1357,47 @@ def get_option_parser():
     p.add_option('--picasaweb',
                  help="""Export to PicasaWeb albums of specified user
                  (available in future version of Phoshare).""")
+    p.add_option("--plan",
+                 help="""Save the changes of the export to the export folder
+                 into this file (JSON), before they are made. Use with
+                 --dryrun to review the changes, and run them later with
+                 --run_plan.""")
+    p.add_option("--placealbums", action="store_true",
+                 help="""Create albums (folders) for places: groups of images
+                 taken close to each other (see --place_radius).""")
+    p.add_option("--placealbum_prefix", default="",
+                 help='Prefix for place folders (use with --placealbums)')
+    p.add_option("--place_radius", type='float', default=1.0,
+                 help="""Images taken less than this many km apart are in the
+                 same place (use with --placealbums). Default: 1.""")
+    p.add_option("--place_min_images", type='int', default=1,
+                 help="""Minimum number of images of a place album (use with
+                 --placealbums). Default: 1.""")
     p.add_option("--pictures", action="store_false", dest="movies",
                  default=True,
                  help="Export pictures only (no movies).")
+    p.add_option("--query",
+                 help="""Export the images that match a query into one
+                 folder (see --query_album). The query is a list of
+                 field:value terms, for example
+                 'after:2010-06-01 keyword:Beach face:"Jane Doe" rating:4'.
+                 Fields: after, before, rating, keyword, face, type (photo or
+                 movie), gps (lat1,lon1,lat2,lon2), album, event.""")
+    p.add_option("--query_album", default="Query",
+                 help='Folder name for the images of --query. Default: "Query".')
     p.add_option("--ratings",
                  help="""Only export pictures with matching rating (comma separate list)""")
+    p.add_option("--rebuild_manifest", action="store_true",
+                 help="""Check all exported files again, and record them in a
+                 new manifest of exported files.""")
     p.add_option("--reverse",
                  help="""Reverse sync mode - check if changes in the export folders need to
                  be sync'ed back to the library. Implies --dryrun.""")
+    p.add_option("--run_plan",
+                 help="""Make the changes of a plan saved with --plan, instead
+                 of exporting. The plan is not checked against the library
+                 again, so run it before the library or the export folder
+                 change.""")
     p.add_option(
       "--size", type='int', help="""Resize images so that neither width or
       height exceeds this size. Converts all images to jpeg.""")
@@ -916,6 +1429,38 @@ def run_phoshare(cmd_args):
                          phoshare.phoshare_version.PHOSHARE_BUILD)
         return 1
 
+    logging_handler = logging.StreamHandler()
+    logging_handler.setLevel(logging.DEBUG if options.verbose else logging.INFO)
+    _logger.addHandler(logging_handler)
+
+    if options.copy_threads < 1:
+        parser.error("--copy_threads must be at least 1.")
+
+    if options.run_plan:
+        try:
+            plan = exportplan.load_plan(su.expand_home_folder(options.run_plan))
+        except (IOError, ValueError), ex:
+            su.perr(u'Could not load plan: %s' % (ex))
+            return 1
+        su.pout(u'Plan: %s.' % (plan.get_summary()))
+        if not options.dryrun:
+            manifest = None
+            memo = None
+            if plan.manifest_path and options.manifest:
+                if options.content_digest:
+                    memo_path = duplicates.get_memo_path()
+                    memo = duplicates.load_memo(memo_path)
+                manifest = exportmanifest.ExportManifest(
+                    os.path.dirname(plan.manifest_path), memo)
+            try:
+                run_plan(plan, options, manifest=manifest)
+            finally:
+                if manifest:
+                    manifest.close()
+                if memo is not None and memo.reads:
+                    duplicates.save_memo(memo_path, memo)
+        return 0
+
     if options.iptc > 0 and not exiftool.check_exif_tool():
         print >> sys.stderr, ("Exiftool is needed for the --itpc or --iptcall" +
           " options.")
@@ -924,16 +1469,21 @@ def run_phoshare(cmd_args):
     if options.size and options.link:
         parser.error("Cannot use --size and --link together.")
 
+    if options.duplicates == 'link' and (options.link or options.iptc):
+        # The IPTC data of linked duplicates could not differ.
+        parser.error("Cannot use --duplicates link with --link, --iptc, or "
+                     "--iptcall.")
+
     if not options.iphoto:
         parser.error("Need to specify the iPhoto library with the --iphoto "
                      "option.")
 
     if options.export or options.picasaweb or options.checkalbumsize:
         if not (options.albums or options.events or options.smarts or
-                options.facealbums):
+                options.facealbums or options.placealbums or options.query):
             parser.error("Need to specify at least one event, album, or smart "
                          "album for exporting, using the -e, -a, or -s "
-                         "options.")
+                         "options, or a --query.")
     else:
         parser.error("No action specified. Use --export to export from your "
                      "iPhoto library.")
@@ -948,19 +1498,35 @@ def run_phoshare(cmd_args):
     if options.ratings:
         options.ratings = [int(r) for r in options.ratings.split(",")]
 
+    if options.query:
+        try:
+            imagequery.parse_query(su.unicode_string(options.query))
+        except ValueError, ex:
+            parser.error("Invalid --query: %s" % (ex))
+
     if options.reverse:
         if not options.dryrun:
             su.pout(u"Turning on dryrun mode because of --reverse option.")
         options.dryrun = True
 
-    logging_handler = logging.StreamHandler()
-    logging_handler.setLevel(logging.DEBUG if options.verbose else logging.INFO)
-    _logger.addHandler(logging_handler)
+    # File states are cached for one run only.
+    su.reset_stat_cache()
 
     album_xml_file = iphotodata.get_album_xmlfile(
         su.expand_home_folder(options.iphoto))
-    data = iphotodata.get_iphoto_data(album_xml_file, ratings=options.ratings,
-                                       verbose=options.verbose, aperture=options.aperture)
+    projection = applexml.make_projection(get_excluded_xml_paths(
+        options, iphotodata.has_events_in_albums(album_xml_file,
+                                                 options.aperture)))
+    processes = options.parse_processes or None
+    if options.snapshot and not options.lazy:
+        data = snapshot.get_iphoto_data(album_xml_file, ratings=options.ratings,
+                                        verbose=options.verbose, aperture=options.aperture,
+                                        projection=projection, processes=processes)
+    else:
+        data = iphotodata.get_iphoto_data(album_xml_file, ratings=options.ratings,
+                                           verbose=options.verbose, aperture=options.aperture,
+                                           lazy=options.lazy, projection=projection,
+                                           processes=processes)
     if options.originals and options.export:
         data.load_aperture_originals()
         
@@ -973,8 +1539,32 @@ def run_phoshare(cmd_args):
         data.checkalbumsizes(int(options.checkalbumsize))
 
     if options.export:
-        album = ExportLibrary(su.expand_home_folder(options.export))
-        export_iphoto(album, data, options.exclude, options)
+        export_folder = su.expand_home_folder(options.export)
+        album = ExportLibrary(export_folder)
+        library_diff = None
+        if options.incremental:
+            baseline_path = snapshot.get_baseline_path(album_xml_file, export_folder)
+            export_options = get_export_options(options)
+            previous_data = snapshot.load_baseline(baseline_path,
+                                                   export_options)
+            if previous_data:
+                library_diff = data.get_diff(previous_data)
+                library_diff.print_summary()
+                data.update_lookup_index(previous_data, library_diff)
+            else:
+                su.pout(u"No matching previous incremental export, checking all "
+                        u"files.")
+            # Skipped creates or updates would not be retried by the next
+            # incremental run, so only record complete runs.
+            is_complete_run = (not options.dryrun and options.update and
+                               options.max_create == -1 and options.max_update == -1)
+        stats = export_iphoto(album, data, options.exclude, options,
+                              library_diff)
+        # Files of failed or cancelled actions have to be retried next time.
+        if (options.incremental and is_complete_run and stats is not None and
+            not stats.aborted and not stats.failures):
+            snapshot.save_baseline(baseline_path, album_xml_file, options.ratings,
+                                   options.aperture, data, export_options)
     if options.picasaweb:
         try:
             import phoshare.picasaweb as picasaweb
@@ -14,8 +14,15 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import os
+import shutil
+import tempfile
 import unittest
 
+import appledata.applexml as applexml
+import appledata.iphotodata as iphotodata
+import appledata.librarygen as librarygen
+import appledata.snapshot as snapshot
 import phoshare.phoshare_main as pm
 
 class PhoshareMainTest(unittest.TestCase):
@@ -39,5 +46,111 @@ class PhoshareMainTest(unittest.TestCase):
         self.assertFalse(pm.region_matches([1, 2, 3], []))
         self.assertFalse(pm.region_matches([], [1, 2, 3]))
 
+    def test_get_excluded_xml_paths(self):
+        """Tests phoshare_main.get_excluded_xml_paths."""
+        parser = pm.get_option_parser()
+        (options, _) = parser.parse_args(['-e', '.'])
+        self.assertEquals([("List of Albums", None, "KeyList"),
+                           ("List of Albums", None, "KeyListString"),
+                           ("List of Faces",),
+                           ("Master Image List", None, "Faces")],
+                          pm.get_excluded_xml_paths(options))
+        (options, _) = parser.parse_args(['-e', '.', '-a', '.', '--facealbums'])
+        self.assertEquals([], pm.get_excluded_xml_paths(options))
+        (options, _) = parser.parse_args(
+            ['-e', '.', '--captiontemplate', '{title} {opt_face_list}'])
+        self.assertEquals(2, len(pm.get_excluded_xml_paths(options)))
+        # Libraries that list their events with the albums need the images of
+        # the albums.
+        (options, _) = parser.parse_args(['-e', '.'])
+        self.assertEquals([("List of Faces",),
+                           ("Master Image List", None, "Faces")],
+                          pm.get_excluded_xml_paths(options, True))
+
+    def test_get_export_options(self):
+        """Tests phoshare_main.get_export_options."""
+        parser = pm.get_option_parser()
+        (options, _) = parser.parse_args(['-e', '.', '-u', '--incremental'])
+        export_options = pm.get_export_options(options)
+        # Options that don't change the exported files don't matter.
+        (options, _) = parser.parse_args(['-e', '.', '--copy_threads', '2'])
+        self.assertEquals(export_options, pm.get_export_options(options))
+        for args in (['-e', '.', '-a', '.'], ['-e', 'Trip'],
+                     ['-e', '.', '--size', '1024'], ['-e', '.', '-o'],
+                     ['-e', '.', '-n', '{index}']):
+            (options, _) = parser.parse_args(args)
+            self.assertNotEquals(export_options, pm.get_export_options(options))
+
+    def test_events_only_projection(self):
+        """Tests that an events-only projection keeps the images of the
+        events of iPhoto and Aperture libraries."""
+        folder = tempfile.mkdtemp()
+        try:
+            (options, _) = pm.get_option_parser().parse_args(['-e', '.'])
+            for (name, aperture) in (('AlbumData.xml', False),
+                                     ('ApertureData.xml', True)):
+                xml_file = os.path.join(folder, name)
+                out = open(xml_file, 'w')
+                librarygen.write_library(out, librarygen.LibrarySpec(
+                    images=300, albums=2, aperture=aperture))
+                out.close()
+                self.assertEquals(aperture,
+                                  iphotodata.has_events_in_albums(xml_file))
+                projection = applexml.make_projection(pm.get_excluded_xml_paths(
+                    options, iphotodata.has_events_in_albums(xml_file)))
+                data = iphotodata.get_iphoto_data(xml_file,
+                                                  projection=projection)
+                events = [album for album in data.root_album.albums
+                          if album.albumtype == 'Event']
+                self.assertEquals(3, len(events))
+                self.assertEquals(300, sum([len(event.images)
+                                            for event in events]))
+        finally:
+            shutil.rmtree(folder)
+
+    def test_incremental_baseline(self):
+        """Tests that an --incremental export only saves its baseline when
+        all files were exported."""
+        folder = tempfile.mkdtemp()
+        home = os.environ.get('HOME')
+        try:
+            os.environ['HOME'] = folder
+            library = os.path.join(folder, 'Library')
+            out = open(os.path.join(folder, 'AlbumData.xml'), 'w')
+            librarygen.write_library(out, librarygen.LibrarySpec(
+                images=5, albums=1, faces=0, keywords=0))
+            out.close()
+            xml_file = os.path.join(library, 'AlbumData.xml')
+            os.mkdir(library)
+            data = open(os.path.join(folder, 'AlbumData.xml')).read()
+            out = open(xml_file, 'w')
+            out.write(data.replace('/Users/Shared/Library', library))
+            out.close()
+            image_files = []
+            for image in iphotodata.get_iphoto_data(xml_file).images:
+                image_files.append(image.image_path)
+                if image.originalpath:
+                    image_files.append(image.originalpath)
+            for image_file in image_files[1:]:
+                if not os.path.exists(os.path.dirname(image_file)):
+                    os.makedirs(os.path.dirname(image_file))
+                open(image_file, 'w').close()
+            export_folder = os.path.join(folder, 'Export')
+            args = ['--iphoto', library, '--export', export_folder, '-e', '.',
+                    '-u', '--incremental']
+            baseline_path = snapshot.get_baseline_path(xml_file,
+                                                       export_folder)
+
+            # A file could not be copied.
+            pm.run_phoshare(args)
+            self.assertFalse(os.path.exists(baseline_path))
+
+            open(image_files[0], 'w').close()
+            pm.run_phoshare(args)
+            self.assertTrue(os.path.exists(baseline_path))
+        finally:
+            os.environ['HOME'] = home
+            shutil.rmtree(folder)
+
 if __name__ == '__main__':
     unittest.main()
@@ -27,6 +27,8 @@ import traceback
 from Tkinter import *  #IGNORE:W0401
 
 import appledata.iphotodata as iphotodata
+import appledata.snapshot as snapshot
+import phoshare.exportplan as exportplan
 import phoshare.phoshare_main as phoshare_main
 import phoshare.phoshare_version as phoshare_version
 import tilutil.exiftool as exiftool
@@ -724,6 +726,8 @@ Metadata options will be disabled if exiftool is not available.""")
             self.albums = ''
             self.events = '.'
             self.smarts = ''
+            self.query = None
+            self.query_album = 'Query'
             self.ignore = []
             self.delete = False
             self.update = False
@@ -731,7 +735,15 @@ Metadata options will be disabled if exiftool is not available.""")
             self.max_delete = -1
             self.max_update = -1
             self.link = False
+            self.duplicates = None
             self.dryrun = False
+            self.plan = None
+            self.run_plan = None
+            self.manifest = True
+            self.rebuild_manifest = False
+            self.content_digest = False
+            self.copy_threads = exportplan.DEFAULT_THREADS
+            self.copy_mb_in_flight = exportplan.DEFAULT_BYTES_IN_FLIGHT / 1024 / 1024
             self.folderhints = False
             self.folderpatterns = None
             self.captiontemplate = u'{description}'
@@ -749,6 +761,10 @@ Metadata options will be disabled if exiftool is not available.""")
             self.faces = False
             self.facealbums = False
             self.facealbum_prefix = ''
+            self.placealbums = False
+            self.placealbum_prefix = ''
+            self.place_radius = 1.0
+            self.place_min_images = 1
             self.face_keywords = False
             self.ratings = '' # TODO
             self.verbose = False
@@ -899,7 +915,7 @@ Metadata options will be disabled if exiftool is not available.""")
                 self.thread_queue.put(("done", (False, mode, str(e))))
                 return
 
-            data = iphotodata.get_iphoto_data(album_xml_file)
+            data = snapshot.get_iphoto_data(album_xml_file)
             msg = "Version %s library with %d images" % (
                 data.applicationVersion, len(data.images))
             self.write(msg + '\n')
@@ -987,6 +1003,8 @@ Metadata options will be disabled if exiftool is not available.""")
             print " ".join(args)
 
             self.logging_handler.setLevel(logging.DEBUG if options.verbose else logging.INFO)
+            # File states are cached for one run only.
+            su.reset_stat_cache()
 	    if options.originals and options.export:
 		data.load_aperture_originals()
             self.active_library = phoshare_main.ExportLibrary(export_folder)
@@ -0,0 +1,234 @@
+'''Copies files with the fastest method the operating system offers.
+
+shutil.copy2() moves every byte through a Python buffer. copy_file() first
+tries methods that let the kernel copy the data:
+
+  clonefile        Mac OS X 10.12 or later: clones the file (APFS), sharing
+                   the data until either copy changes.
+  clone            Linux: the FICLONE ioctl, a copy-on-write clone (Btrfs,
+                   XFS).
+  copy_file_range  Linux: copies inside the kernel, and lets network file
+                   systems copy on the server.
+  sendfile         Linux: copies inside the kernel.
+
+A method that does not work for a file system (or the whole system) is not
+tried again for it, and shutil.copy2() remains the fallback. Permissions and
+times are copied like shutil.copy2() does.
+'''
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import ctypes
+import errno
+import os
+import shutil
+import sys
+
+import tilutil.systemutils as su
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# ioctl request of a Linux copy-on-write clone of a whole file.
+_FICLONE = 0x40049409
+
+# Bytes moved by one copy_file_range() or sendfile() call.
+_CHUNK_SIZE = 1 << 30
+
+# Errors that mean a method does not work for the file systems (or the
+# system); the next method is tried.
+_FALLBACK_ERRORS = frozenset([
+    errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL,
+    getattr(errno, 'ENOTSUP', errno.EOPNOTSUPP)])
+
+# Name of the fallback method.
+COPY2 = 'copy2'
+
+# Methods that are not tried again: names (the system does not have them),
+# or (name, source device, target device).
+_unsupported = set()
+
+
+def _load_libc():
+    try:
+        return ctypes.CDLL(None, use_errno=True)
+    except OSError:
+        return None
+
+_libc = _load_libc()
+
+
+def _get_function(name, restype, argtypes):
+    """Returns a C library function, or None if there is none."""
+    function = getattr(_libc, name, None) if _libc else None
+    if function is not None:
+        function.restype = restype
+        function.argtypes = argtypes
+    return function
+
+_clonefile = None
+_copy_file_range = None
+_sendfile = None
+if sys.platform == 'darwin':
+    _clonefile = _get_function('clonefile', ctypes.c_int,
+                               [ctypes.c_char_p, ctypes.c_char_p,
+                                ctypes.c_uint32])
+elif sys.platform.startswith('linux'):
+    _copy_file_range = _get_function(
+        'copy_file_range', ctypes.c_ssize_t,
+        [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p,
+         ctypes.c_size_t, ctypes.c_uint])
+    _sendfile = _get_function(
+        'sendfile', ctypes.c_ssize_t,
+        [ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t])
+
+
+def _encode(path):
+    if isinstance(path, unicode):
+        return su.fsenc(path)
+    return path
+
+
+def _raise_errno():
+    error = ctypes.get_errno()
+    raise OSError(error, os.strerror(error))
+
+
+def _clone(in_fd, out_fd):
+    fcntl.ioctl(out_fd, _FICLONE, in_fd)
+
+
+def _copy_range(in_fd, out_fd):
+    while True:
+        copied = _copy_file_range(in_fd, None, out_fd, None, _CHUNK_SIZE, 0)
+        if copied < 0:
+            _raise_errno()
+        if copied == 0:
+            return
+
+
+def _send(in_fd, out_fd):
+    while True:
+        copied = _sendfile(out_fd, in_fd, None, _CHUNK_SIZE)
+        if copied < 0:
+            _raise_errno()
+        if copied == 0:
+            return
+
+
+def _get_methods():
+    """Returns the (name, function) of the methods that copy between open
+    files on this system."""
+    methods = []
+    if fcntl and sys.platform.startswith('linux'):
+        methods.append(('clone', _clone))
+    if _copy_file_range:
+        methods.append(('copy_file_range', _copy_range))
+    if _sendfile:
+        methods.append(('sendfile', _send))
+    return methods
+
+_METHODS = _get_methods()
+
+
+def get_method_names():
+    """Returns the names of the methods copy_file() can use on this system,
+    in the order it tries them, without the COPY2 fallback."""
+    names = [name for (name, _) in _METHODS]
+    if _clonefile:
+        names.insert(0, 'clonefile')
+    return names
+
+
+def _is_supported(name, devices):
+    return name not in _unsupported and (name,) + devices not in _unsupported
+
+
+def _set_unsupported(name, devices, error):
+    if error == errno.ENOSYS:
+        _unsupported.add(name)
+    else:
+        _unsupported.add((name,) + devices)
+
+
+def _copy_data(source, target, names, devices):
+    """Copies the data of source into target with the first of the methods
+    that works. Returns its name, or None if none did."""
+    if (_clonefile and 'clonefile' in names and
+        _is_supported('clonefile', devices) and not os.path.lexists(target)):
+        if _clonefile(_encode(source), _encode(target), 0) == 0:
+            return 'clonefile'
+        error = ctypes.get_errno()
+        if error not in _FALLBACK_ERRORS:
+            raise OSError(error, os.strerror(error), target)
+        _set_unsupported('clonefile', devices, error)
+    methods = [(name, function) for (name, function) in _METHODS
+               if name in names and _is_supported(name, devices)]
+    if not methods:
+        return None
+    in_file = open(source, 'rb')
+    try:
+        out_file = open(target, 'wb')
+        try:
+            in_fd = in_file.fileno()
+            out_fd = out_file.fileno()
+            size = os.fstat(in_fd).st_size
+            for (name, function) in methods:
+                try:
+                    function(in_fd, out_fd)
+                    # Some file systems report 0 bytes copied instead of an
+                    # error.
+                    if os.fstat(out_fd).st_size == size:
+                        return name
+                    _set_unsupported(name, devices, errno.EINVAL)
+                except (IOError, OSError), ex:
+                    if ex.errno not in _FALLBACK_ERRORS:
+                        raise
+                    _set_unsupported(name, devices, ex.errno)
+                # Start over with the next method.
+                os.lseek(in_fd, 0, os.SEEK_SET)
+                os.lseek(out_fd, 0, os.SEEK_SET)
+                os.ftruncate(out_fd, 0)
+        finally:
+            out_file.close()
+    finally:
+        in_file.close()
+    return None
+
+
+def copy_file(source, target, names=None):
+    """Copies a file, with its permissions and times, like shutil.copy2().
+
+    Args:
+      source: path of the file to copy.
+      target: path of the copy (not a folder).
+      names: if set, the names of the methods to try (see
+          get_method_names()); by default all of them.
+    Returns:
+      the name of the method that copied the data, or COPY2.
+    """
+    if names is None:
+        names = get_method_names()
+    if names:
+        devices = (os.stat(source).st_dev,
+                   os.stat(os.path.dirname(os.path.abspath(target))).st_dev)
+        method = _copy_data(source, target, names, devices)
+        if method:
+            shutil.copystat(source, target)
+            return method
+    shutil.copy2(source, target)
+    return COPY2
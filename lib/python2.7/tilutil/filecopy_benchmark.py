@@ -0,0 +1,122 @@
+"""Measures the copy methods of filecopy on large files.
+
+Copies a movie-sized file and a set of RAW-sized files with each method that
+works on this system, and with shutil.copy2(), into a folder on the same file
+system, and optionally into a folder on another file system (e.g., a USB disk
+or a network share), and prints the throughput.
+
+The source files stay in the page cache after the first copy, so the numbers
+show the cost of the copy itself more than the speed of the source disk.
+
+Usage: python -m tilutil.filecopy_benchmark [--folder DIR] [--other_folder DIR]
+                                            [--movie_mb N] [--raws N]
+                                            [--raw_mb N]
+"""
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from optparse import OptionParser
+
+import tilutil.filecopy as filecopy
+
+_MB = 1024 * 1024
+
+
+def write_file(path, megabytes):
+    """Writes a file of random-ish data."""
+    block = os.urandom(_MB)
+    out = open(path, 'wb')
+    try:
+        for _ in xrange(megabytes):
+            out.write(block)
+    finally:
+        out.close()
+
+
+def time_copies(sources, folder, name):
+    """Copies files into a folder with one method. Returns (seconds, method
+    used for the last file)."""
+    method = None
+    start = time.time()
+    for source in sources:
+        target = os.path.join(folder, os.path.basename(source))
+        if os.path.exists(target):
+            os.remove(target)
+        method = filecopy.copy_file(source, target, [name])
+    elapsed = time.time() - start
+    for source in sources:
+        os.remove(os.path.join(folder, os.path.basename(source)))
+    return (elapsed, method)
+
+
+def main(args):
+    parser = OptionParser()
+    parser.add_option('--folder',
+                      help='Folder for the source files and the copies on the '
+                      'same file system. Default: a temporary folder.')
+    parser.add_option('--other_folder',
+                      help='Folder on another file system for the copies.')
+    parser.add_option('--movie_mb', type='int', default=4096,
+                      help='Size of the movie file (MB).')
+    parser.add_option('--raws', type='int', default=40,
+                      help='Number of RAW files.')
+    parser.add_option('--raw_mb', type='int', default=25,
+                      help='Size of each RAW file (MB).')
+    (options, _) = parser.parse_args(args)
+
+    folder = tempfile.mkdtemp(dir=options.folder)
+    try:
+        movie = os.path.join(folder, 'movie.mov')
+        write_file(movie, options.movie_mb)
+        raws = []
+        for index in xrange(options.raws):
+            raws.append(os.path.join(folder, 'IMG_%04d.CR2' % (index)))
+            write_file(raws[-1], options.raw_mb)
+
+        targets = [('same file system', folder)]
+        if options.other_folder:
+            targets.append(('other file system', options.other_folder))
+        for (label, target_folder) in targets:
+            copy_folder = tempfile.mkdtemp(dir=target_folder)
+            try:
+                print '%s (%s):' % (label, copy_folder)
+                for (files, sources, megabytes) in (
+                    ('movie', [movie], options.movie_mb),
+                    ('%d RAWs' % (options.raws), raws,
+                     options.raws * options.raw_mb)):
+                    for name in (filecopy.get_method_names() +
+                                 [filecopy.COPY2]):
+                        (elapsed, method) = time_copies(sources, copy_folder,
+                                                        name)
+                        if method != name:
+                            print '  %-8s %-16s not supported' % (files, name)
+                            continue
+                        print '  %-8s %-16s %8.2f s %9.1f MB/s' % (
+                            files, name, elapsed,
+                            megabytes / max(elapsed, 1e-6))
+            finally:
+                shutil.rmtree(copy_folder)
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
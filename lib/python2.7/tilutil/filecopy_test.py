@@ -0,0 +1,76 @@
+"""This module tests tilutil/filecopy.py."""
+
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import tilutil.filecopy as filecopy
+
+
+class FileCopyTest(unittest.TestCase):
+    """Unit tests for filecopy.py code."""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.source = os.path.join(self.folder, u'source.jpg')
+        out = open(self.source, 'wb')
+        # More than one chunk of the fallback copy of shutil.
+        out.write(''.join([chr(i % 251) for i in xrange(100000)]))
+        out.close()
+        os.chmod(self.source, 0640)
+        os.utime(self.source, (1000000000, 1000000000))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def _check_copy(self, target):
+        self.assertEquals(open(self.source, 'rb').read(),
+                          open(target, 'rb').read())
+        source_stat = os.stat(self.source)
+        target_stat = os.stat(target)
+        self.assertEquals(source_stat.st_mode, target_stat.st_mode)
+        self.assertEquals(source_stat.st_mtime, target_stat.st_mtime)
+
+    def test_copy_file(self):
+        """Tests copying with each method, and with the fallback."""
+        for name in filecopy.get_method_names() + [filecopy.COPY2]:
+            target = os.path.join(self.folder, u'%s.jpg' % (name))
+            method = filecopy.copy_file(self.source, target, [name])
+            # A method that does not work for the file system falls back
+            # to shutil.copy2().
+            self.assertTrue(method in (name, filecopy.COPY2))
+            self._check_copy(target)
+
+    def test_overwrite(self):
+        """Tests copying over an existing file."""
+        target = os.path.join(self.folder, 'target.jpg')
+        out = open(target, 'wb')
+        out.write('x' * 200000)
+        out.close()
+        filecopy.copy_file(self.source, target)
+        self._check_copy(target)
+
+    def test_missing_source(self):
+        """Tests that a missing source file raises an error."""
+        self.assertRaises(EnvironmentError, filecopy.copy_file,
+                          os.path.join(self.folder, 'missing.jpg'),
+                          os.path.join(self.folder, 'target.jpg'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -20,8 +20,8 @@
 import logging
 import os
 import re
-import shutil
 import sys
+import tilutil.filecopy as filecopy
 import tilutil.systemutils as su
 import unicodedata
 
@@ -567,8 +567,8 @@ def copy_or_link_file(source, target, dryrun=False, link=False, size=None,
                 _logger.error(u'%s: %s' % (source, result))
                 return False
         else:
-            _logger.debug(u'shutil.copy2(%s, %s)', source, target)
-            shutil.copy2(source, target)
+            method = filecopy.copy_file(source, target)
+            _logger.debug(u'copy_file(%s, %s): %s', source, target, method)
         return True
     except (OSError, IOError) as ex:
         _logger.error(u'%s: %s' % (source, str(ex)))
@@ -18,15 +18,18 @@ Created on May 29, 2009
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import errno
 import filecmp
 import logging
 import os
+import stat
 import subprocess
 import sys
 import unicodedata
 import MacOS
 
 from Carbon.File import FSResolveAliasFile
+from multiprocessing.pool import ThreadPool
 
 _sysenc = sys.getfilesystemencoding()
 
@@ -163,3 +166,127 @@ def expand_home_folder(path):
     if path.startswith("~"):
         return os.environ.get('HOME') + path[1:]
     return path
+
+
+# Threads StatCache.prefetch() uses. The stat() calls wait for the disk (or
+# the network, for libraries on a server), not for the CPU.
+DEFAULT_PREFETCH_THREADS = 8
+
+
+def _lstat(path):
+    """Returns (stat result or None, number of system calls made). The lstat()
+    result is used unless the path is a symbolic link, which is followed with
+    a second call, so links behave like with os.stat()."""
+    try:
+        result = os.lstat(path)
+        if not stat.S_ISLNK(result.st_mode):
+            return (result, 1)
+        return (os.stat(path), 2)
+    except OSError:
+        return (None, 1)
+
+
+class StatCache(object):
+    """Remembers the stat results of paths, so that each path is stat'ed
+    at most once. Paths that do not exist are remembered too.
+
+    The cache does not notice changes made to the files after they were
+    stat'ed; call invalidate() after changing a file.
+
+    requests counts the lookups made through the cache, and syscalls the
+    stat system calls it really made, so requests - syscalls is the number of
+    calls the cache saved.
+    """
+
+    def __init__(self):
+        self._stats = {}  # path -> stat result, or None if it does not exist
+        self.requests = 0
+        self.syscalls = 0
+
+    def stat(self, path):
+        """Returns the stat result of a path (following symbolic links), or
+        None if it does not exist."""
+        self.requests += 1
+        try:
+            return self._stats[path]
+        except KeyError:
+            pass
+        (result, calls) = _lstat(path)
+        self.syscalls += calls
+        self._stats[path] = result
+        return result
+
+    def checked_stat(self, path):
+        """Like os.stat(): returns the stat result of a path, or raises
+        OSError if it does not exist."""
+        result = self.stat(path)
+        if result is None:
+            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+        return result
+
+    def prefetch(self, paths, threads=DEFAULT_PREFETCH_THREADS):
+        """Stats the paths that are not cached yet, using a pool of threads,
+        so later lookups of these paths do not wait for the disk."""
+        missing = [path for path in set(paths) if path not in self._stats]
+        if not missing:
+            return
+        if threads <= 1 or len(missing) < 2 * threads:
+            results = map(_lstat, missing)
+        else:
+            pool = ThreadPool(threads)
+            try:
+                results = pool.map(_lstat, missing,
+                                   max(1, len(missing) / (4 * threads)))
+            finally:
+                pool.close()
+                pool.join()
+        for (path, (result, calls)) in zip(missing, results):
+            self._stats[path] = result
+            self.syscalls += calls
+
+    def get_saved_syscalls(self):
+        """Returns how many stat calls the cache saved (or a negative number
+        if more paths were prefetched than looked up)."""
+        return self.requests - self.syscalls
+
+    def exists(self, path):
+        """Like os.path.exists()."""
+        return self.stat(path) is not None
+
+    def getsize(self, path):
+        """Like os.path.getsize(), but returns 0 for a missing file."""
+        result = self.stat(path)
+        return result.st_size if result else 0
+
+    def isdir(self, path):
+        """Like os.path.isdir()."""
+        result = self.stat(path)
+        return result is not None and stat.S_ISDIR(result.st_mode)
+
+    def getmtime(self, path):
+        """Like os.path.getmtime(), but returns None for a missing file."""
+        result = self.stat(path)
+        return result.st_mtime if result else None
+
+    def invalidate(self, path=None):
+        """Forgets the result for a path, or for all paths."""
+        if path is None:
+            self._stats.clear()
+        else:
+            self._stats.pop(path, None)
+
+
+_stat_cache = StatCache()
+
+
+def get_stat_cache():
+    """Returns the StatCache shared by the modules of a run."""
+    return _stat_cache
+
+
+def reset_stat_cache():
+    """Starts a new run: replaces the shared StatCache with an empty one, and
+    returns it."""
+    global _stat_cache
+    _stat_cache = StatCache()
+    return _stat_cache
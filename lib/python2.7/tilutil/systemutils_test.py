@@ -14,6 +14,9 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import os
+import shutil
+import tempfile
 import unittest
 
 import tilutil.systemutils as su
@@ -26,5 +29,67 @@ class SystemUtilsTest(unittest.TestCase):
         self.assertEquals("/usr", su.resolve_alias("/usr"))
         self.assertEquals("/private/tmp", su.resolve_alias("/tmp"))
 
+    def test_stat_cache(self):
+        """Tests that StatCache stats each path once."""
+        (handle, path) = tempfile.mkstemp()
+        os.write(handle, 'abc')
+        os.close(handle)
+        try:
+            stat_cache = su.StatCache()
+            self.assertTrue(stat_cache.exists(path))
+            self.assertEquals(3, stat_cache.getsize(path))
+            self.assertEquals(os.path.getmtime(path), stat_cache.getmtime(path))
+            self.assertFalse(stat_cache.isdir(path))
+            self.assertTrue(stat_cache.isdir(os.path.dirname(path)))
+            os.remove(path)
+            self.assertTrue(stat_cache.exists(path))
+            stat_cache.invalidate(path)
+            self.assertFalse(stat_cache.exists(path))
+            self.assertEquals(0, stat_cache.getsize(path))
+            self.assertEquals(None, stat_cache.getmtime(path))
+            self.assertFalse(stat_cache.isdir(path))
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_stat_cache_prefetch(self):
+        """Tests StatCache.prefetch() and the syscall counters."""
+        folder = tempfile.mkdtemp()
+        try:
+            paths = []
+            for i in xrange(40):
+                path = os.path.join(folder, 'file%d' % (i))
+                out = open(path, 'w')
+                out.write('x' * i)
+                out.close()
+                paths.append(path)
+            link = os.path.join(folder, 'link')
+            os.symlink(paths[5], link)
+            missing = os.path.join(folder, 'missing')
+            stat_cache = su.StatCache()
+            stat_cache.prefetch(paths + [link, missing, paths[0]], threads=4)
+            # One call per path, and one more to follow the link.
+            self.assertEquals(43, stat_cache.syscalls)
+            self.assertEquals(0, stat_cache.requests)
+            for (i, path) in enumerate(paths):
+                self.assertEquals(i, stat_cache.getsize(path))
+                self.assertEquals(i, stat_cache.getsize(path))
+            self.assertEquals(5, stat_cache.getsize(link))
+            self.assertFalse(stat_cache.exists(missing))
+            self.assertRaises(OSError, stat_cache.checked_stat, missing)
+            self.assertEquals(43, stat_cache.syscalls)
+            self.assertEquals(83, stat_cache.requests)
+            self.assertEquals(40, stat_cache.get_saved_syscalls())
+        finally:
+            shutil.rmtree(folder)
+
+    def test_shared_stat_cache(self):
+        """Tests that reset_stat_cache() starts a new shared cache."""
+        stat_cache = su.reset_stat_cache()
+        self.assertTrue(stat_cache is su.get_stat_cache())
+        stat_cache.exists('/')
+        self.assertFalse(su.reset_stat_cache() is stat_cache)
+        self.assertEquals(0, su.get_stat_cache().requests)
+
 if __name__ == '__main__':
     unittest.main()